@@ -47,10 +47,15 @@ kwargs = dict(name='wstunnel',
 kwargs["download_url"] = 'https://github.com/ffalcinelli/wstunnel/tarball/{0}'.format(kwargs.get("version"))
 
 install_requires = ["PyYAML>=3.10",
-                    "tornado>=3.0.2",
+                    "tornado>=3.0.2,<5",
                     "nose>=1.3.0",
                     "mock>=1.0.1"]
 
+if wstunnel.PY2:
+    install_requires.append("futures>=2.1")
+else:
+    kwargs["extras_require"] = {"uvloop": ["uvloop"]}
+
 if not sys.platform.startswith("win"):
 
     kwargs["install_requires"] = install_requires
@@ -58,6 +63,7 @@ if not sys.platform.startswith("win"):
         "console_scripts": [
             "wstuncltd = wstunnel.daemon.wstuncltd:main",
             "wstunsrvd = wstunnel.daemon.wstunsrvd:main",
+            "wstunbench = wstunnel.benchmark.tunnel:main",
         ]
     }
 else:
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Forwarding engine written with async/await on asyncio streams, requiring Python 3.5+.
+
+The endpoints speak the same WebSocket protocol as the callback ones, so either side of a tunnel can run on any
+engine. They run on the asyncio loop under a tornado AsyncIOLoop, the asyncio or uvloop event loop, and forward
+single connections only: multiplexing, compression, pools, coalescing, scheduling, shaping and keep alive
+pings are left to the callback engine. Back pressure comes from awaiting the drain of each write.
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import re
+import socket
+import ssl
+import struct
+import time
+from urllib.parse import urlsplit
+from tornado.ioloop import IOLoop
+from tornado.netutil import ssl_options_to_context
+from wstunnel.compression import DEFAULT_MAX_SIZE
+from wstunnel.exception import EndpointNotAvailableException, MappedServiceNotAvailableException
+from wstunnel.filters import filter_chain, to_bytes
+from wstunnel.flow import DEFAULT_HIGH_WATERMARK
+from wstunnel.metrics import TunnelMetrics
+from wstunnel.resolver import DEFAULT_CONNECT_TIMEOUT
+from wstunnel.toolbox import bind_sockets, random_free_port, tuple_to_address
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+CLOSE_NORMAL, CLOSE_PROTOCOL_ERROR, CLOSE_TOO_BIG = 1000, 1002, 1009
+
+_LENGTH16 = struct.Struct("!H")
+_LENGTH64 = struct.Struct("!Q")
+
+
+class HandshakeError(Exception):
+    """
+    Raised when the peer does not agree on the WebSocket upgrade, with the HTTP status it answered
+    """
+
+    def __init__(self, code, message):
+        super(HandshakeError, self).__init__("HTTP %d: %s" % (code, message))
+        self.code = code
+
+
+def asyncio_loop(io_loop=None):
+    """
+    Return the asyncio loop a tornado IOLoop, the current one by default, runs on
+    """
+    loop = getattr(io_loop or IOLoop.current(), "asyncio_loop", None)
+    if loop is None:
+        raise ValueError("The async engine runs on the asyncio or uvloop event loop")
+    return loop
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+
+
+def apply_mask(mask, data):
+    """
+    XOR data with the 4 bytes mask repeated, as WebSocket frames sent by clients are
+    """
+    size = len(data)
+    key = int.from_bytes((mask * (size // 4 + 1))[:size], "big")
+    return (int.from_bytes(data, "big") ^ key).to_bytes(size, "big")
+
+
+async def read_head(reader):
+    """
+    Read the head of an HTTP message, returning the start line and the headers with lowercase names
+    """
+    lines = (await reader.readuntil(b"\r\n\r\n")).decode("latin1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+class WebSocketStream(object):
+    """
+    WebSocket messages over an asyncio stream pair. Clients mask the frames they send, servers do not.
+    Pings are answered while receiving, and messages over max_message_size close the connection.
+    """
+
+    def __init__(self, reader, writer, mask=False, max_message_size=DEFAULT_MAX_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.mask = mask
+        self.max_message_size = max_message_size
+        self.closing = False
+
+    def write_frame(self, opcode, payload):
+        size = len(payload)
+        mask_bit = 0x80 if self.mask else 0
+        if size < 126:
+            header = bytes((0x80 | opcode, mask_bit | size))
+        elif size < 0x10000:
+            header = bytes((0x80 | opcode, mask_bit | 126)) + _LENGTH16.pack(size)
+        else:
+            header = bytes((0x80 | opcode, mask_bit | 127)) + _LENGTH64.pack(size)
+        if self.mask:
+            key = os.urandom(4)
+            header += key
+            payload = apply_mask(key, payload)
+        self.writer.write(header)
+        self.writer.write(payload)
+
+    async def send(self, data):
+        """
+        Send data as a binary message, waiting for the write buffer to drain under its limit
+        """
+        self.write_frame(BINARY, data)
+        await self.writer.drain()
+
+    async def recv(self):
+        """
+        Return the next message, or None once the connection is closed
+        """
+        fragments = []
+        size = 0
+        try:
+            while True:
+                first, second = await self.reader.readexactly(2)
+                fin, opcode, length = first & 0x80, first & 0x0f, second & 0x7f
+                if length == 126:
+                    length, = _LENGTH16.unpack(await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = _LENGTH64.unpack(await self.reader.readexactly(8))
+                key = await self.reader.readexactly(4) if second & 0x80 else None
+                if opcode >= CLOSE and (length > 125 or not fin):
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+                size += length if opcode < CLOSE else 0
+                if size > self.max_message_size:
+                    logger.error("WebSocket message over %d bytes, closing", self.max_message_size)
+                    self.close(CLOSE_TOO_BIG)
+                    return None
+                payload = await self.reader.readexactly(length)
+                if key is not None:
+                    payload = apply_mask(key, payload)
+                if opcode == CLOSE:
+                    self.close()
+                    return None
+                elif opcode == PING:
+                    self.write_frame(PONG, payload)
+                elif opcode != PONG:
+                    fragments.append(payload)
+                    if fin:
+                        return b"".join(fragments)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.closing = True
+            return None
+
+    def close(self, code=CLOSE_NORMAL):
+        """
+        Send a close frame, unless already sent or received, and close the stream
+        """
+        if not self.closing:
+            self.closing = True
+            try:
+                self.write_frame(CLOSE, _LENGTH16.pack(code))
+            except ConnectionError:
+                pass
+        self.writer.close()
+
+
+async def websocket_connect(url, connect_timeout=DEFAULT_CONNECT_TIMEOUT, validate_cert=True, ca_certs=None,
+                            family=socket.AF_UNSPEC):
+    """
+    Open a WebSocketStream to the given ws:// or wss:// url
+    """
+    parts = urlsplit(url)
+    secure = parts.scheme == "wss"
+    context = None
+    if secure:
+        context = ssl.create_default_context(cafile=ca_certs)
+        if not validate_cert:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or (443 if secure else 80), ssl=context, family=family),
+        connect_timeout)
+    key = base64.b64encode(os.urandom(16))
+    writer.write(("GET %s HTTP/1.1\r\n"
+                  "Host: %s\r\n"
+                  "Upgrade: websocket\r\n"
+                  "Connection: Upgrade\r\n"
+                  "Sec-WebSocket-Key: %s\r\n"
+                  "Sec-WebSocket-Version: 13\r\n\r\n" % (parts.path or "/", parts.netloc, key.decode())).encode())
+    try:
+        status, headers = await asyncio.wait_for(read_head(reader), connect_timeout)
+        _, code, message = (status.split(" ", 2) + [""])[:3]
+        if int(code) != 101:
+            raise HandshakeError(int(code), message)
+        if headers.get("sec-websocket-accept", "").encode() != accept_key(key):
+            raise HandshakeError(int(code), "Invalid Sec-WebSocket-Accept")
+    except Exception:
+        writer.close()
+        raise
+    return WebSocketStream(reader, writer, mask=True)
+
+
+async def forward(reader, writer, ws, filters, metrics):
+    """
+    Pump data between a socket and a WebSocket until either side closes
+    """
+
+    async def socket_to_ws():
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                return
+            if filters.socket_to_ws is not None:
+                data = to_bytes(filters.socket_to_ws(data))
+            if data:
+                metrics.bytes_socket_to_ws += len(data)
+                await ws.send(data)
+
+    async def ws_to_socket():
+        while True:
+            message = await ws.recv()
+            if message is None:
+                return
+            metrics.bytes_ws_to_socket += len(message)
+            data = message if filters.ws_to_socket is None else to_bytes(filters.ws_to_socket(message))
+            if data:
+                writer.write(data)
+                await writer.drain()
+
+    metrics.connections_active += 1
+    metrics.connections_total += 1
+    pumps = [asyncio.ensure_future(socket_to_ws()), asyncio.ensure_future(ws_to_socket())]
+    try:
+        done, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        for pump in done:
+            if pump.exception() is not None and not isinstance(pump.exception(), ConnectionError):
+                logger.error("Forwarding stopped: %r", pump.exception())
+    finally:
+        for pump in pumps:
+            pump.cancel()
+        metrics.connections_active -= 1
+        filters.close()
+        ws.close()
+        writer.close()
+
+
+class AsyncEndpoint(object):
+    """
+    Serves the connections accepted on bound sockets with a coroutine, on the asyncio loop of io_loop.
+    Stopping closes the forwarded connections too.
+    """
+
+    def __init__(self, io_loop=None, reuse_port=False, high_watermark=DEFAULT_HIGH_WATERMARK,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, filter_profile=None):
+        self.io_loop = io_loop
+        self.reuse_port = reuse_port
+        self.high_watermark = high_watermark
+        self.connect_timeout = connect_timeout
+        self.metrics = TunnelMetrics()
+        self.metrics.filter_profile = self.filter_profile = filter_profile
+        self.proxies = {}
+        self.serving = False
+        self._servers = []
+        self._sockets = []
+        self._connections = set()
+
+    def serve(self, sockets, handler, ssl_context=None):
+        loop = asyncio_loop(self.io_loop)
+
+        def on_connection(reader, writer):
+            connection = asyncio.ensure_future(handler(reader, writer), loop=loop)
+            self._connections.add(connection)
+            connection.add_done_callback(self._connections.discard)
+
+        for sock in sockets:
+            self._sockets.append(sock)
+            self._servers.append(asyncio.ensure_future(asyncio.start_server(on_connection, sock=sock,
+                                                                            ssl=ssl_context), loop=loop))
+
+    def start(self, num_processes=1, dispatcher=None):
+        if num_processes != 1 or dispatcher is not None:
+            raise ValueError("The async engine serves in a single process, run workers with SO_REUSEPORT instead")
+        self.serving = True
+
+    def stop(self):
+        for server in self._servers:
+            if server.done() and not server.cancelled() and server.exception() is None:
+                server.result().close()
+            else:
+                server.cancel()
+        for sock in self._sockets:
+            sock.close()
+        for connection in list(self._connections):
+            connection.cancel()
+        self._servers, self._sockets = [], []
+        self.serving = False
+
+    def bind_stats(self, region, worker):
+        """
+        Make a forked worker account the metrics of its proxies in its slots of the shared stats region
+        """
+        self.metrics.bind(region, worker)
+        for key, ws_proxy in self.proxies.items():
+            ws_proxy["metrics"] = self.metrics.resource(key)
+
+    def add_proxy(self, key, ws_proxy):
+        ws_proxy["filters"] = filter_chain(ws_proxy.get("filters"))
+        ws_proxy["metrics"] = self.metrics.resource(key)
+        if self.filter_profile is not None:
+            ws_proxy["filters"].instrument(self.filter_profile, key)
+        self.proxies[key] = ws_proxy
+
+    def get_proxy(self, key):
+        return self.proxies.get(key)
+
+    def install_filter(self, filtr):
+        """
+        Install the given filter into each proxy
+        """
+        for ws_proxy in self.proxies.values():
+            ws_proxy["filters"].append(filtr)
+
+    def uninstall_filter(self, filtr):
+        """
+        Uninstall the given filter from each proxy
+        """
+        for ws_proxy in self.proxies.values():
+            if filtr in ws_proxy["filters"]:
+                ws_proxy["filters"].remove(filtr)
+
+    def limit_writes(self, ws_proxy, *writers):
+        for writer in writers:
+            writer.transport.set_write_buffer_limits(high=ws_proxy.get("high_watermark", self.high_watermark))
+
+
+class AsyncTunnelClient(AsyncEndpoint):
+    """
+    Client endpoint of the async engine: forwards the connections accepted on the port of each proxy through a
+    WebSocket to its ws_url. proxies maps ports to ws urls, as for WSTunnelClient.
+    """
+
+    def __init__(self, proxies=None, address='', family=socket.AF_UNSPEC, io_loop=None, ws_options=None,
+                 **kwargs):
+        super(AsyncTunnelClient, self).__init__(io_loop=io_loop, **kwargs)
+        self.address = address
+        self.family = family
+        self.ws_options = ws_options or {}
+        for port, ws_url in (proxies or {}).items():
+            self.add_proxy(port, {"port": port, "ws_url": ws_url})
+
+    def add_proxy(self, key, ws_proxy):
+        """
+        Bind the port of a proxy, given as a dict with port, ws_url and filters. It is served once started.
+        """
+        ws_proxy["sockets"] = bind_sockets(int(ws_proxy.get("port", 0)),
+                                           address=ws_proxy.get("address", self.address),
+                                           family=self.family,
+                                           reuse_port=self.reuse_port)
+        super(AsyncTunnelClient, self).add_proxy(key, ws_proxy)
+        if self.serving:
+            self.serve_proxy(ws_proxy)
+
+    def remove_proxy(self, key):
+        ws_proxy = self.proxies.pop(key, None)
+        if ws_proxy:
+            for sock in ws_proxy["sockets"]:
+                sock.close()
+
+    @property
+    def address_list(self):
+        """
+        Returns the address (<host>, <port> tuple) list of all the addresses used
+        """
+        return [sock.getsockname()[:2] for ws_proxy in self.proxies.values() for sock in ws_proxy["sockets"]]
+
+    def start(self, num_processes=1, dispatcher=None):
+        super(AsyncTunnelClient, self).start(num_processes, dispatcher)
+        for ws_proxy in self.proxies.values():
+            self.serve_proxy(ws_proxy)
+
+    def serve_proxy(self, ws_proxy):
+        self.serve(ws_proxy["sockets"], lambda reader, writer: self.handle_connection(ws_proxy, reader, writer))
+        logger.info("Started async proxy %s --> %s" % (" | ".join(tuple_to_address(sock.getsockname())
+                                                                  for sock in ws_proxy["sockets"]),
+                                                       ws_proxy["ws_url"]))
+
+    async def handle_connection(self, ws_proxy, reader, writer):
+        """
+        Open a WebSocket for a client connection and forward its data
+        """
+        metrics = ws_proxy["metrics"]
+        logger.info("Got connection from %s" % tuple_to_address(writer.get_extra_info("peername")))
+        started = time.time()
+        try:
+            ws = await websocket_connect(ws_proxy["ws_url"],
+                                         connect_timeout=ws_proxy.get("connect_timeout", self.connect_timeout),
+                                         validate_cert=self.ws_options.get("validate_cert", True),
+                                         ca_certs=self.ws_options.get("ca_certs"))
+        except Exception as e:
+            metrics.handshake_failures += 1
+            if isinstance(e, HandshakeError) and e.code == 502:
+                metrics.connect_failures += 1
+                logger.error(MappedServiceNotAvailableException(cause=e))
+            else:
+                logger.error(EndpointNotAvailableException("The server endpoint is not available", cause=e))
+            writer.close()
+            return
+        metrics.connect_latency.observe(time.time() - started)
+        self.limit_writes(ws_proxy, writer, ws.writer)
+        await forward(reader, writer, ws, ws_proxy["filters"].for_connection(), metrics)
+
+
+class AsyncTunnelServer(AsyncEndpoint):
+    """
+    Server endpoint of the async engine: upgrades the requests for the path of each proxy to WebSockets and
+    forwards their messages to its address. proxies maps paths to (host, port) pairs, as for WSTunnelServer,
+    and its keys are matched as the tornado routes are, as regular expressions of the whole path.
+    The service is connected before completing the upgrade, answering 502 when it is not available.
+    """
+
+    def __init__(self, port=0, address='', proxies=None, io_loop=None, ssl_options=None, **kwargs):
+        super(AsyncTunnelServer, self).__init__(io_loop=io_loop, **kwargs)
+        self.port = port
+        self.address = address
+        self.ssl_options = ssl_options
+        for resource, addr in (proxies or {}).items():
+            self.add_proxy(resource, {"address": addr})
+
+    @property
+    def port(self):
+        return self._port
+
+    @port.setter
+    def port(self, value):
+        self._port = value if value else random_free_port()
+
+    def remove_proxy(self, key):
+        del self.proxies[key]
+
+    def route(self, path):
+        """
+        Return the first proxy whose key matches the whole path, None when there is not any
+        """
+        for key, ws_proxy in self.proxies.items():
+            if re.match(key if key.endswith("$") else key + "$", path):
+                return ws_proxy
+        return None
+
+    def start(self, num_processes=1, dispatcher=None):
+        super(AsyncTunnelServer, self).start(num_processes, dispatcher)
+        context = None
+        if self.ssl_options is not None:
+            context = ssl_options_to_context(self.ssl_options)
+        logger.info("Binding on port {}".format(self.port))
+        self.serve(bind_sockets(self.port, address=self.address, reuse_port=self.reuse_port), self.handle_connection,
+                   context)
+
+    def reject(self, writer, code, message):
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" %
+                      (code, message, len(message), message)).encode("latin1"))
+        writer.close()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Upgrade a request to a WebSocket and forward its messages to the service of the requested path
+        """
+        try:
+            request, headers = await asyncio.wait_for(read_head(reader), self.connect_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        method, path, _ = (request.split(" ", 2) + ["", ""])[:3]
+        ws_proxy = self.route(path.split("?", 1)[0])
+        if ws_proxy is None:
+            self.reject(writer, 404, "Not Found")
+            return
+        metrics = ws_proxy["metrics"]
+        if method != "GET" or headers.get("upgrade", "").lower() != "websocket" \
+                or "upgrade" not in headers.get("connection", "").lower() \
+                or headers.get("sec-websocket-version") != "13" or "sec-websocket-key" not in headers:
+            metrics.handshake_failures += 1
+            self.reject(writer, 400, "Bad Request")
+            return
+        address = ws_proxy["address"]
+        logger.info("Forwarding connection to server %s" % tuple_to_address(address))
+        started = time.time()
+        try:
+            service_reader, service_writer = await asyncio.wait_for(
+                asyncio.open_connection(address[0], address[1]), ws_proxy.get("connect_timeout", self.connect_timeout))
+        except (asyncio.TimeoutError, OSError) as e:
+            metrics.connect_failures += 1
+            metrics.handshake_failures += 1
+            e = MappedServiceNotAvailableException(cause=e)
+            logger.error("Rejecting upgrade for %s: %s" % (tuple_to_address(address), e))
+            self.reject(writer, 502, str(e))
+            return
+        metrics.connect_latency.observe(time.time() - started)
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      "Sec-WebSocket-Accept: %s\r\n\r\n" %
+                      accept_key(headers["sec-websocket-key"].encode()).decode()).encode())
+        self.limit_writes(ws_proxy, writer, service_writer)
+        await forward(service_reader, service_writer, WebSocketStream(reader, writer),
+                      ws_proxy["filters"].for_connection(), metrics)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks for the tunnel hot paths. Each module can be run as a script, e.g.
+
+    $ python -m wstunnel.benchmark.copies
+    $ python -m wstunnel.benchmark.engines
+    $ python -m wstunnel.benchmark.tunnel
+    $ python -m wstunnel.benchmark.micro
+    $ python -m wstunnel.benchmark.replay logs/capture-1234.ring
+"""
+__author__ = 'fabio'
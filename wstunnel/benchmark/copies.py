@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Count the buffer copies and allocations made by the filter chain for each MB forwarded,
+comparing the forwarding code before the zero copy data path with the current one.
+
+    $ python -m wstunnel.benchmark.copies
+"""
+import argparse
+import timeit
+from wstunnel.filters import BaseFilter, FilterChain, to_bytes
+
+__author__ = 'fabio'
+
+MB = 1024 * 1024
+MARKER = b"WSTN"
+
+
+def legacy_path(filters):
+    """
+    The socket to WebSocket forwarding code as it was before the zero copy data path:
+    a chunk copy followed by each filter in turn
+    """
+
+    def forward(message):
+        data = None if message is None else bytes(message)
+        for filtr in filters:
+            data = filtr.socket_to_ws(data=data)
+        return data
+
+    return forward
+
+
+def current_path(filters):
+    """
+    The current socket to WebSocket forwarding code: the compiled filter chain, if any,
+    plus the conversion required by the stream write
+    """
+    chain = FilterChain(filters)
+
+    def forward(message):
+        return to_bytes(message if chain.socket_to_ws is None else chain.socket_to_ws(message))
+
+    return forward
+
+
+class ObserverFilter(BaseFilter):
+    """
+    Only inspects data, like DumpFilter does
+    """
+
+    def __init__(self, passthrough=False):
+        super(ObserverFilter, self).__init__()
+        self.passthrough = passthrough
+        self.seen = 0
+
+    def socket_to_ws(self, data):
+        self.seen += len(data)
+        return data
+
+
+class PatchFilter(BaseFilter):
+    """
+    Rewrites the first bytes of each chunk, either building a new chunk or in place
+    """
+
+    def __init__(self, inplace=False):
+        super(PatchFilter, self).__init__()
+        self.inplace = inplace
+
+    def socket_to_ws(self, data):
+        if self.inplace:
+            data[:len(MARKER)] = MARKER
+            return data
+        return MARKER + data[len(MARKER):]
+
+
+class ProbeFilter(BaseFilter):
+    """
+    Wraps a filter recording every buffer going in and out of it
+    """
+
+    def __init__(self, filtr, buffers):
+        super(ProbeFilter, self).__init__()
+        self.filtr = filtr
+        self.buffers = buffers
+        self.passthrough = filtr.passthrough
+        self.inplace = filtr.inplace
+
+    def socket_to_ws(self, data):
+        self.buffers.append(data)
+        result = self.filtr.socket_to_ws(data=data)
+        self.buffers.append(result)
+        return result
+
+
+def count_buffers(make_path, filters, chunk):
+    """
+    Forward a chunk and return the (copies, allocations) made: allocations are the distinct buffer objects
+    created along the path, copies are the ones duplicating the chunk content (i.e. not views).
+    Every buffer is kept alive until counted, so that object ids are not reused.
+    """
+    buffers = [chunk]
+    probes = [ProbeFilter(filtr, buffers) for filtr in filters]
+    buffers.append(make_path(probes)(chunk))
+    unique = dict((id(b), b) for b in buffers if b is not None)
+    allocations = len(unique) - 1
+    copies = len([b for b in unique.values() if not isinstance(b, memoryview)]) - 1
+    return copies, allocations
+
+
+SCENARIOS = [
+    ("no filters", lambda new: []),
+    ("observer", lambda new: [ObserverFilter(passthrough=new)]),
+    ("2 patch filters", lambda new: [PatchFilter(inplace=new), PatchFilter(inplace=new)]),
+    ("observer + 2 patch filters", lambda new: [ObserverFilter(passthrough=new),
+                                                PatchFilter(inplace=new),
+                                                PatchFilter(inplace=new)]),
+]
+
+
+def run(chunk_size=16 * 1024, chunk_type=bytes):
+    """
+    Return one result dict for each scenario, path and chunk type
+    """
+    results = []
+    chunks = MB // chunk_size
+    for name, make_filters in SCENARIOS:
+        for label, make_path, new in (("before", legacy_path, False), ("after", current_path, True)):
+            filters = make_filters(new)
+            copies, allocations = count_buffers(make_path, filters, chunk_type(b"x" * chunk_size))
+            path = make_path(filters)
+            elapsed = min(timeit.repeat(lambda: path(chunk_type(b"x" * chunk_size)), number=chunks, repeat=3))
+            results.append({"scenario": name,
+                            "path": label,
+                            "chunk_type": chunk_type.__name__,
+                            "copies_per_mb": copies * chunks,
+                            "allocations_per_mb": allocations * chunks,
+                            "bytes_copied_per_mb": copies * MB,
+                            "ms_per_mb": elapsed * 1000})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter chain copies and allocations per MB forwarded")
+    parser.add_argument("--chunk-size", type=int, default=16 * 1024, help="size of each forwarded chunk")
+    options = parser.parse_args()
+
+    row = "{scenario:<28} {chunk_type:<10} {path:<7} {copies_per_mb:>8} {allocations_per_mb:>8} " \
+          "{bytes_copied_per_mb:>12} {ms_per_mb:>8.3f}"
+    print("{0:<28} {1:<10} {2:<7} {3:>8} {4:>8} {5:>12} {6:>8}".format("scenario", "chunk", "path", "copies",
+                                                                       "allocs", "bytes copied", "ms"))
+    for chunk_type in (bytes, bytearray):
+        for result in run(options.chunk_size, chunk_type):
+            print(row.format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compare the throughput and the per connection latency of a tunnel running on each available event loop, with the
+callback engine and, on the asyncio based loops, the async one. A client and a server endpoint forward connections
+to an echo service, all in the same process and event loop.
+
+    $ python -m wstunnel.benchmark.engines
+    $ python -m wstunnel.benchmark.engines --engine async asyncio uvloop
+"""
+import argparse
+import socket
+import time
+from tornado.iostream import IOStream
+from tornado.tcpserver import TCPServer
+from wstunnel.client import WSTunnelClient
+from wstunnel.engine import ASYNC, CALLBACK, ENGINES, TORNADO, AsyncTunnelClient, AsyncTunnelServer, \
+    available_engines, available_event_loops, new_event_loop
+from wstunnel.server import WSTunnelServer
+
+__author__ = 'fabio'
+
+MB = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class EchoService(TCPServer):
+    """
+    Writes back whatever it reads
+    """
+
+    def handle_stream(self, stream, address):
+        stream.read_until_close(stream.close, streaming_callback=stream.write)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+class Benchmark(object):
+    """
+    Measures the latency of connections opened one after the other, each one echoing payload_size bytes,
+    then the throughput of a single connection echoing volume bytes
+    """
+
+    def __init__(self, event_loop=None, engine=CALLBACK, connections=100, payload_size=64, volume=16 * 1024 * 1024,
+                 timeout=60):
+        self.event_loop = event_loop
+        self.engine = engine
+        self.connections = connections
+        self.payload = b"x" * payload_size
+        self.volume = volume
+        self.timeout = timeout
+        self.latencies = []
+        self.throughput = 0.0
+        self.io_loop = None
+        self.address = None
+
+    def run(self):
+        """
+        Run the benchmark on a new event loop and return its results
+        """
+        self.io_loop = new_event_loop(self.event_loop)
+        server_class, client_class = (AsyncTunnelServer, AsyncTunnelClient) if self.engine == ASYNC \
+            else (WSTunnelServer, WSTunnelClient)
+        service = EchoService(io_loop=self.io_loop)
+        service.listen(0, "127.0.0.1")
+        service_address = list(service._sockets.values())[0].getsockname()
+        srv_tun = server_class(port=0, address="127.0.0.1", proxies={"/bench": service_address},
+                               io_loop=self.io_loop)
+        srv_tun.start()
+        clt_tun = client_class(proxies={0: "ws://127.0.0.1:%d/bench" % srv_tun.port}, address="127.0.0.1",
+                               family=socket.AF_INET, io_loop=self.io_loop)
+        clt_tun.start()
+        self.address = clt_tun.address_list[0]
+        timeout = self.io_loop.add_timeout(self.io_loop.time() + self.timeout, self.io_loop.stop)
+        self.io_loop.add_callback(self.next_connection)
+        try:
+            self.io_loop.start()
+        finally:
+            self.io_loop.remove_timeout(timeout)
+            for endpoint in (clt_tun, srv_tun, service):
+                endpoint.stop()
+            # let the stopped endpoints close their connections
+            self.io_loop.add_timeout(self.io_loop.time() + 0.1, self.io_loop.stop)
+            self.io_loop.start()
+            self.io_loop.close()
+        return self.results()
+
+    def connect(self, callback):
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM), io_loop=self.io_loop)
+        stream.connect(self.address, lambda: callback(stream))
+        return stream
+
+    def next_connection(self):
+        if len(self.latencies) >= self.connections:
+            self.connect(self.start_transfer)
+            return
+        started = time.time()
+
+        def on_echo(data):
+            self.latencies.append(time.time() - started)
+            stream.close()
+            self.next_connection()
+
+        def on_connect(stream):
+            stream.write(self.payload)
+            stream.read_bytes(len(self.payload), on_echo)
+
+        stream = self.connect(on_connect)
+
+    def start_transfer(self, stream):
+        started = time.time()
+        received = [0]
+        chunk = b"x" * CHUNK_SIZE
+
+        def on_data(data):
+            received[0] += len(data)
+            if received[0] >= self.volume:
+                self.throughput = received[0] / max(time.time() - started, 1e-6)
+                stream.close()
+                self.io_loop.stop()
+
+        def write_more():
+            # Keep a single chunk in flight to let the tunnel apply back pressure
+            if not stream.closed() and sent[0] < self.volume:
+                sent[0] += len(chunk)
+                stream.write(chunk, write_more)
+
+        def on_close(data):
+            # The tunnel closing the connection early ends the benchmark as well
+            if not self.throughput:
+                self.io_loop.stop()
+
+        sent = [0]
+        stream.read_until_close(on_close, streaming_callback=on_data)
+        write_more()
+
+    def results(self):
+        return {
+            "event_loop": self.event_loop or TORNADO,
+            "engine": self.engine,
+            "connections": len(self.latencies),
+            "latency_avg": sum(self.latencies) / len(self.latencies) if self.latencies else 0.0,
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p99": percentile(self.latencies, 0.99),
+            "throughput": self.throughput,
+        }
+
+
+def run(event_loops=None, engines=None, connections=100, payload_size=64, volume=16 * 1024 * 1024):
+    """
+    Return one result dict for each engine on each event loop, all the available ones by default.
+    The async engine is skipped on the tornado event loop, which it cannot run on.
+    """
+    return [Benchmark(event_loop, engine, connections=connections, payload_size=payload_size, volume=volume).run()
+            for engine in engines or available_engines()
+            for event_loop in event_loops or available_event_loops()
+            if engine == CALLBACK or event_loop not in (None, TORNADO)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tunnel throughput and latency on each engine and event loop")
+    parser.add_argument("--engine", action="append", choices=ENGINES, dest="engines",
+                        help="engines to compare, all the available ones by default")
+    parser.add_argument("--connections", type=int, default=100, help="connections measuring latency")
+    parser.add_argument("--payload-size", type=int, default=64, help="bytes echoed by each connection")
+    parser.add_argument("--volume", type=int, default=16 * 1024 * 1024,
+                        help="bytes echoed by the connection measuring throughput")
+    parser.add_argument("event_loops", nargs="*", metavar="EVENT_LOOP", help="event loops to compare")
+    options = parser.parse_args()
+
+    row = "{engine:<10} {event_loop:<10} {connections:>6} {latency_avg:>10.3f} {latency_p50:>10.3f} " \
+          "{latency_p99:>10.3f} {throughput:>10.2f}"
+    print("{0:<10} {1:<10} {2:>6} {3:>10} {4:>10} {5:>10} {6:>10}".format("engine", "loop", "conns", "avg ms",
+                                                                          "p50 ms", "p99 ms", "MB/s"))
+    for result in run(options.event_loops, options.engines, options.connections, options.payload_size,
+                      options.volume):
+        print(row.format(**dict(result,
+                                latency_avg=result["latency_avg"] * 1000,
+                                latency_p50=result["latency_p50"] * 1000,
+                                latency_p99=result["latency_p99"] * 1000,
+                                throughput=result["throughput"] / MB)))
+
+
+if __name__ == "__main__":
+    main()
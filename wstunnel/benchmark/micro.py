@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Microbenchmarks of the hot helpers, each one timed in isolation after a warmup. Results can be saved as a baseline,
+later runs are compared against it flagging the benchmarks slower than the baseline by more than a threshold.
+
+    $ python -m wstunnel.benchmark.micro --save baseline.json
+    $ python -m wstunnel.benchmark.micro --baseline baseline.json --threshold 10
+"""
+import argparse
+import collections
+import json
+import math
+import sys
+import timeit
+from wstunnel.benchmark.copies import ObserverFilter, PatchFilter
+from wstunnel.benchmark.tunnel import environment
+from wstunnel.client import WebSocketProxyConnection
+from wstunnel.filters import FilterChain
+from wstunnel.toolbox import address_to_tuple, hex_dump, printable
+
+__author__ = 'fabio'
+
+REPEAT = 7
+WARMUP = 1
+MIN_TIME = 0.05
+THRESHOLD = 10.0
+CHUNK_SIZE = 16 * 1024
+
+
+class NullStream(object):
+    """
+    Stands for an IOStream with an always empty write buffer
+    """
+    _write_buffer_size = 0
+    io_loop = None
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data, callback=None):
+        self.written += len(data)
+
+    def closed(self):
+        return False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_until_close(self, callback, streaming_callback=None):
+        pass
+
+
+class NullWebSocket(object):
+    """
+    Stands for an handshaked client WebSocket connection
+    """
+
+    def __init__(self):
+        self.stream = NullStream()
+        self.headers = {}
+        self.read_queue = collections.deque()
+
+    def write_message(self, message, binary=False):
+        self.stream.write(message)
+
+
+def forwarding_connection(filters=()):
+    """
+    A client connection forwarding between null streams
+    """
+    connection = WebSocketProxyConnection("ws://localhost/bench", NullStream(), ("127.0.0.1", 0), ws_options={},
+                                          filters=filters)
+    connection.attach(NullWebSocket())
+    return connection
+
+
+def call(func, *args):
+    return lambda: func(*args)
+
+
+def chain_dispatch(filters):
+    chain = FilterChain(filters)
+    chunk = b"x" * CHUNK_SIZE
+    return lambda: chain.socket_to_ws(chunk)
+
+
+def forward(direction, filters=()):
+    connection = forwarding_connection(filters)
+    callback = connection.on_peer_message if direction == "to_ws" else connection.on_message
+    chunk = b"x" * CHUNK_SIZE
+    return lambda: callback(chunk)
+
+
+# (name, setup returning the function to time)
+BENCHMARKS = [
+    ("hex_dump_64", lambda: call(hex_dump, bytes(bytearray(range(64))))),
+    ("hex_dump_1k", lambda: call(hex_dump, bytes(bytearray(range(256))) * 4)),
+    ("printable_byte", lambda: call(printable, 0x41)),
+    ("printable_control", lambda: call(printable, 0x07)),
+    ("address_to_tuple", lambda: call(address_to_tuple, "localhost:8080")),
+    ("address_to_tuple_port", lambda: call(address_to_tuple, 8080)),
+    ("chain_passthrough", lambda: chain_dispatch([ObserverFilter(passthrough=True)])),
+    ("chain_inplace", lambda: chain_dispatch([PatchFilter(inplace=True), PatchFilter(inplace=True)])),
+    ("chain_plain", lambda: chain_dispatch([PatchFilter(), PatchFilter()])),
+    ("forward_to_ws", lambda: forward("to_ws")),
+    ("forward_to_socket", lambda: forward("to_socket")),
+    ("forward_to_ws_filtered", lambda: forward("to_ws", [ObserverFilter(passthrough=True)])),
+]
+
+
+def calibrate(timer, min_time=MIN_TIME):
+    """
+    Return the number of calls, a power of 10, taking at least min_time
+    """
+    number = 1
+    while timer.timeit(number) < min_time and number < 10 ** 9:
+        number *= 10
+    return number
+
+
+def measure(func, repeat=REPEAT, warmup=WARMUP, min_time=MIN_TIME):
+    """
+    Time func, returning statistics on the seconds per call over repeat repetitions
+    """
+    timer = timeit.Timer(func)
+    number = calibrate(timer, min_time)
+    for _ in range(warmup):
+        timer.timeit(number)
+    timings = sorted(t / number for t in timer.repeat(repeat, number))
+    mean = sum(timings) / len(timings)
+    middle = len(timings) // 2
+    return {
+        "number": number,
+        "repeat": repeat,
+        "min": timings[0],
+        "max": timings[-1],
+        "mean": mean,
+        "median": timings[middle] if len(timings) % 2 else (timings[middle - 1] + timings[middle]) / 2,
+        "stdev": math.sqrt(sum((t - mean) ** 2 for t in timings) / (len(timings) - 1)) if len(timings) > 1 else 0.0,
+    }
+
+
+def run(names=None, repeat=REPEAT, warmup=WARMUP, min_time=MIN_TIME):
+    """
+    Return the statistics of each benchmark, or of those whose name contains one of names
+    """
+    results = collections.OrderedDict()
+    for name, setup in BENCHMARKS:
+        if not names or any(n in name for n in names):
+            results[name] = measure(setup(), repeat, warmup, min_time)
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD, statistic="median"):
+    """
+    Compare results with the baseline ones, returning a row for each benchmark found in both.
+    A benchmark regressed when its statistic grew by more than threshold percent.
+    """
+    rows = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name][statistic], stats[statistic]
+        change = 100.0 * (after - before) / before if before else 0.0
+        rows.append({"name": name, "baseline": before, "current": after, "change": change,
+                     "regression": change > threshold})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the tunnel hot helpers")
+    parser.add_argument("names", nargs="*", metavar="NAME", help="run only the benchmarks matching these names")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="timed repetitions")
+    parser.add_argument("--warmup", type=int, default=WARMUP, help="untimed repetitions")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="minimum seconds of a repetition")
+    parser.add_argument("--save", default=None, help="save the results as a baseline to this file")
+    parser.add_argument("--baseline", default=None, help="compare the results with this baseline file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="percentage over the baseline median flagged as a regression")
+    options = parser.parse_args()
+
+    results = run(options.names, options.repeat, options.warmup, options.min_time)
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+    if not options.baseline:
+        print("{0:<24} {1:>12} {2:>12} {3:>12} {4:>10}".format("benchmark", "min ns", "median ns", "mean ns",
+                                                               "stdev %"))
+        for name, stats in results.items():
+            print("{0:<24} {1:>12.1f} {2:>12.1f} {3:>12.1f} {4:>10.1f}".format(
+                name, stats["min"] * 1e9, stats["median"] * 1e9, stats["mean"] * 1e9,
+                100.0 * stats["stdev"] / stats["mean"] if stats["mean"] else 0.0))
+        return
+
+    with open(options.baseline) as f:
+        baseline = json.load(f)["results"]
+    rows = compare(results, baseline, options.threshold)
+    print("{0:<24} {1:>12} {2:>12} {3:>9}".format("benchmark", "baseline ns", "median ns", "change"))
+    for row in rows:
+        print("{0:<24} {1:>12.1f} {2:>12.1f} {3:>+8.1f}% {4}".format(
+            row["name"], row["baseline"] * 1e9, row["current"] * 1e9, row["change"],
+            "REGRESSION" if row["regression"] else ""))
+    regressions = [row["name"] for row in rows if row["regression"]]
+    if regressions:
+        print("%d benchmarks regressed over %.1f%%: %s" % (len(regressions), options.threshold,
+                                                           ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Replay the sessions recorded by a CaptureFilter (or the chunks logged by a DumpFilter) through a local tunnel.
+
+For each session, the replayer plays both peers: it writes the recorded requests on a connection to the client
+endpoint and the recorded responses from the service the server endpoint connects to, keeping the original timing
+scaled by speed (0 replays as fast as possible). Several copies of each session can run concurrently.
+
+    $ python -m wstunnel.benchmark.replay logs/capture-1234.ring --speed 2 --copies 10
+"""
+import argparse
+import collections
+import datetime
+import json
+import re
+import socket
+import sys
+import time
+from tornado.iostream import IOStream
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+from wstunnel.benchmark.engines import percentile
+from wstunnel.benchmark.tunnel import FIXTURE, EndpointProcess, environment, start_client, start_server
+from wstunnel.engine import new_event_loop
+from wstunnel.filters import CAPTURE_MAGIC, SOCK_TO_WS, WS_TO_SOCK, read_capture
+
+__author__ = 'fabio'
+
+CLIENT = "client"
+SERVER = "server"
+
+Event = collections.namedtuple("Event", "offset request payload")
+
+_DUMP_HEADER = re.compile(r"^\[(.+?)\] .* - \[(-->|<--)\] ")
+_DUMP_ROW = re.compile(r"^[0-9a-f]{4,}  ")
+_DUMP_TIME = "%Y-%m-%d %H:%M:%S,%f"
+
+
+class Session(object):
+    """
+    The chunks of a recorded connection, as requests from the client and responses from the service.
+    Offsets are in seconds from the first chunk of the recording.
+    """
+
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.events = []
+
+    @property
+    def start(self):
+        return self.events[0].offset if self.events else 0.0
+
+    def size(self, request):
+        return sum(len(event.payload) for event in self.events if event.request == request)
+
+
+def load_capture(path, side=CLIENT):
+    """
+    Load the sessions of a capture ring, recorded on the given side of the tunnel
+    """
+    request = SOCK_TO_WS if side == CLIENT else WS_TO_SOCK
+    records = read_capture(path)
+    origin = records[0].timestamp if records else 0.0
+    sessions = collections.OrderedDict()
+    for record in records:
+        session = sessions.get(record.connection_id)
+        if session is None:
+            session = sessions[record.connection_id] = Session(record.connection_id)
+        session.events.append(Event(record.timestamp - origin, record.direction == request, record.payload))
+    return list(sessions.values())
+
+
+def _parse_dump_time(value):
+    moment = datetime.datetime.strptime(value, _DUMP_TIME)
+    return time.mktime(moment.timetuple()) + moment.microsecond / 1000000.0
+
+
+def load_dump(path, side=CLIENT):
+    """
+    Load a DumpFilter log as a single session: dumps do not tell connections apart
+    """
+    request = "<--" if side == CLIENT else "-->"
+    session = Session(0)
+    chunks = []
+    with open(path) as f:
+        for line in f:
+            header = _DUMP_HEADER.match(line)
+            if header:
+                chunks.append([_parse_dump_time(header.group(1)), header.group(2) == request, bytearray()])
+            elif chunks and _DUMP_ROW.match(line):
+                # The hex columns end where the printable column, padded by at least three spaces, starts
+                hexed = line[6:].split("   ", 1)[0]
+                chunks[-1][2].extend(int(value, 16) for value in hexed.split())
+    origin = chunks[0][0] if chunks else 0.0
+    session.events = [Event(timestamp - origin, is_request, bytes(payload))
+                      for timestamp, is_request, payload in chunks if payload]
+    return [session] if session.events else []
+
+
+def load_sessions(path, side=CLIENT):
+    """
+    Load the sessions of a capture ring or a dump log
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(CAPTURE_MAGIC))
+    return load_capture(path, side) if magic == CAPTURE_MAGIC else load_dump(path, side)
+
+
+class Player(object):
+    """
+    Replays a session, writing requests on the client connection and responses on the service one,
+    and timing how long each chunk takes to go through the tunnel
+    """
+
+    def __init__(self, replay, session, delay):
+        self.replay = replay
+        self.session = session
+        self.io_loop = replay.io_loop
+        self.delay = delay
+        self.client = None
+        self.service = None
+        self.started = None
+        self.expected = {True: session.size(True), False: session.size(False)}
+        self.received = {True: 0, False: 0}
+        self.sent = {True: 0, False: 0}
+        self.in_flight = {True: collections.deque(), False: collections.deque()}
+        self.done = False
+
+    def start(self):
+        self.io_loop.add_timeout(self.io_loop.time() + self.delay, lambda: self.replay.connect(self))
+
+    def connect(self, address):
+        self.client = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM), io_loop=self.io_loop)
+        self.client.set_close_callback(self.on_close)
+        self.client.connect(address)
+
+    def attach(self, service):
+        """
+        Start replaying once the service connection of this session has been accepted
+        """
+        self.service = service
+        self.service.set_close_callback(self.on_close)
+        self.client.read_until_close(self.on_close, streaming_callback=lambda data: self.on_data(False, data))
+        self.service.read_until_close(self.on_close, streaming_callback=lambda data: self.on_data(True, data))
+        self.started = self.io_loop.time()
+        origin = self.session.start
+        for event in self.session.events:
+            if self.replay.speed:
+                deadline = self.started + (event.offset - origin) / self.replay.speed
+                self.io_loop.add_timeout(deadline, lambda e=event, d=deadline: self.write(e, d))
+            else:
+                self.io_loop.add_callback(lambda e=event, d=self.started: self.write(e, d))
+        self.check()
+
+    def write(self, event, deadline):
+        if self.done:
+            return
+        now = self.io_loop.time()
+        self.replay.lags.append(max(now - deadline, 0.0))
+        self.sent[event.request] += len(event.payload)
+        self.in_flight[event.request].append((self.sent[event.request], now))
+        (self.client if event.request else self.service).write(event.payload)
+
+    def on_data(self, request, data):
+        """
+        On data received at the other end, time the chunks it completes
+        """
+        self.received[request] += len(data)
+        now = self.io_loop.time()
+        in_flight = self.in_flight[request]
+        while in_flight and in_flight[0][0] <= self.received[request]:
+            self.replay.latencies.append(now - in_flight.popleft()[1])
+        self.replay.bytes += len(data)
+        self.check()
+
+    def check(self):
+        if self.received[True] >= self.expected[True] and self.received[False] >= self.expected[False]:
+            self.finish(failed=False)
+
+    def on_close(self, *args):
+        self.finish(failed=True)
+
+    def finish(self, failed):
+        if self.done:
+            return
+        self.done = True
+        for stream in (self.client, self.service):
+            if stream is not None:
+                stream.set_close_callback(None)
+                stream.close()
+        self.replay.on_finish(self, failed)
+
+
+class ReplayService(TCPServer):
+    """
+    The service the server endpoint connects to: each connection is handed to the session being connected
+    """
+
+    def __init__(self, replay, **kwargs):
+        super(ReplayService, self).__init__(**kwargs)
+        self.replay = replay
+
+    def handle_stream(self, stream, address):
+        self.replay.on_accept(stream)
+
+
+class Replay(object):
+    """
+    Replays copies of each session through a tunnel running in other processes. Connections are opened one at
+    a time, so that the service connection accepted next always belongs to the session being connected.
+    """
+
+    def __init__(self, sessions, speed=1.0, copies=1, stagger=0.0, ssl=False, filters=(), event_loop=None,
+                 timeout=300, certfile=None, keyfile=None):
+        self.sessions = sessions
+        self.speed = speed
+        self.copies = copies
+        self.stagger = stagger
+        self.timeout = timeout
+        self.settings = {
+            "ssl": ssl,
+            "filters": list(filters),
+            "event_loop": event_loop,
+            "certfile": certfile or FIXTURE + "/localhost.pem",
+            "keyfile": keyfile or FIXTURE + "/localhost.key",
+        }
+        self.io_loop = None
+        self.address = None
+        self.connecting = None
+        self.queue = collections.deque()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.latencies = []
+        self.lags = []
+        self.timed_out = False
+
+    def connect(self, player):
+        self.queue.append(player)
+        self.connect_next()
+
+    def connect_next(self):
+        if self.connecting is None and self.queue:
+            self.connecting = self.queue.popleft()
+            self.connecting.connect(self.address)
+
+    def on_accept(self, stream):
+        player, self.connecting = self.connecting, None
+        if player is None or player.done:
+            stream.close()
+        else:
+            player.attach(stream)
+        self.connect_next()
+
+    def on_finish(self, player, failed):
+        if failed:
+            self.failed += 1
+        else:
+            self.completed += 1
+        if player is self.connecting:
+            self.connecting = None
+            self.connect_next()
+        self.pending -= 1
+        if not self.pending:
+            self.io_loop.stop()
+
+    def on_timeout(self):
+        self.timed_out = True
+        self.io_loop.stop()
+
+    def run(self):
+        """
+        Replay the sessions and return the results
+        """
+        sockets = bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+        server = EndpointProcess(start_server, self.settings, sockets[0].getsockname())
+        client = EndpointProcess(start_client, self.settings, server.start())
+        self.address = client.start()
+        self.io_loop = new_event_loop(self.settings["event_loop"])
+        service = ReplayService(self, io_loop=self.io_loop)
+        service.add_sockets(sockets)
+        try:
+            before = dict(server=server.usage(), client=client.usage())
+            origin = min(session.start for session in self.sessions) if self.sessions else 0.0
+            for copy in range(self.copies):
+                for session in self.sessions:
+                    delay = (session.start - origin) / self.speed if self.speed else 0.0
+                    Player(self, session, delay + copy * self.stagger).start()
+                    self.pending += 1
+            timeout = self.io_loop.add_timeout(self.io_loop.time() + self.timeout, self.on_timeout)
+            started = time.time()
+            if self.pending:
+                self.io_loop.start()
+            elapsed = max(time.time() - started, 1e-6)
+            self.io_loop.remove_timeout(timeout)
+            after = dict(server=server.usage(), client=client.usage())
+        finally:
+            for endpoint in (client, server):
+                endpoint.stop()
+            service.stop()
+            self.io_loop.close(all_fds=True)
+        results = {
+            "sessions": len(self.sessions),
+            "copies": self.copies,
+            "speed": self.speed,
+            "ssl": self.settings["ssl"],
+            "filters": self.settings["filters"],
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "duration": elapsed,
+            "bytes": self.bytes,
+            "throughput": self.bytes / elapsed,
+            "latency_p50": percentile(self.latencies, 0.5),
+            "latency_p99": percentile(self.latencies, 0.99),
+            "latency_p999": percentile(self.latencies, 0.999),
+            "lag_avg": sum(self.lags) / len(self.lags) if self.lags else 0.0,
+            "lag_max": max(self.lags) if self.lags else 0.0,
+        }
+        for name in ("server", "client"):
+            cpu = after[name][0] - before[name][0]
+            results[name] = {"cpu": cpu, "cpu_percent": 100.0 * cpu / elapsed, "rss": after[name][1]}
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sessions through a local WebSocket tunnel")
+    parser.add_argument("path", help="capture ring file or dump log")
+    parser.add_argument("--side", choices=(CLIENT, SERVER), default=CLIENT,
+                        help="endpoint the sessions were recorded on")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed, 1 keeps the original timing, 0 replays as fast as possible")
+    parser.add_argument("--copies", type=int, default=1, help="concurrent copies of each session")
+    parser.add_argument("--stagger", type=float, default=0.0, help="seconds between the start of each copy")
+    parser.add_argument("--ssl", action="store_true", help="tunnel over wss")
+    parser.add_argument("-f", "--filter", dest="filters", action="append", default=[], metavar="CLASS",
+                        help="filter installed on both endpoints, may be repeated")
+    parser.add_argument("--event-loop", default=None, help="event loop of the endpoints")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds allowed to the replay")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON results to this file")
+    options = parser.parse_args()
+
+    sessions = load_sessions(options.path, options.side)
+    replay = Replay(sessions, speed=options.speed, copies=options.copies, stagger=options.stagger, ssl=options.ssl,
+                    filters=options.filters, event_loop=options.event_loop, timeout=options.timeout)
+    report = {"environment": environment(), "source": options.path, "results": replay.run()}
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
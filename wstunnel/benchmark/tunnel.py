@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+End to end benchmark of a tunnel. A server and a client endpoint, each one in its own process, forward the
+connections of a load generator to an echo or sink service. Reports connections per second, throughput,
+round trip latency percentiles and the cpu and memory used by each endpoint, as JSON.
+
+    $ wstunbench --concurrency 50 --payload-size 4096 --ssl --filter wstunnel.filters.DumpFilter
+    $ wstunbench --matrix --filter wstunnel.filters.DumpFilter --output results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import time
+import tornado
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.tcpserver import TCPServer
+from wstunnel.benchmark.engines import EchoService, percentile
+from wstunnel.client import WSTunnelClient
+from wstunnel.engine import new_event_loop
+from wstunnel.factory import load_filter
+from wstunnel.server import WSTunnelServer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = 'fabio'
+
+ECHO = "echo"
+SINK = "sink"
+BACKENDS = (ECHO, SINK)
+
+PATTERNS = ("zeros", "text", "random")
+TEXT = b"The quick brown fox jumps over the lazy dog. "
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test", "fixture")
+START_TIMEOUT = 10
+
+
+def make_payload(size, pattern="zeros"):
+    """
+    Build a payload of size bytes: zeros, repeated text or random (incompressible) bytes
+    """
+    if pattern == "zeros":
+        return b"\0" * size
+    if pattern == "text":
+        return (TEXT * (size // len(TEXT) + 1))[:size]
+    if pattern == "random":
+        return os.urandom(size)
+    raise ValueError("Unknown payload pattern %s, expected one of %s" % (pattern, ", ".join(PATTERNS)))
+
+
+class SinkService(TCPServer):
+    """
+    Discards what it reads, acknowledging each message of message_size bytes with a single byte
+    """
+
+    def __init__(self, message_size, **kwargs):
+        super(SinkService, self).__init__(**kwargs)
+        self.message_size = message_size
+
+    def handle_stream(self, stream, address):
+        def on_message(data):
+            if not stream.closed():
+                stream.write(b"\x01")
+                stream.read_bytes(self.message_size, on_message)
+
+        stream.read_bytes(self.message_size, on_message)
+
+
+def usage():
+    """
+    Return the cpu seconds and the peak resident memory in bytes of the current process
+    """
+    if resource is None:
+        return 0.0, 0
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def start_backend(io_loop, settings):
+    if settings["backend"] == SINK:
+        service = SinkService(settings["payload_size"], io_loop=io_loop)
+    else:
+        service = EchoService(io_loop=io_loop)
+    service.listen(0, "127.0.0.1")
+    return service, list(service._sockets.values())[0].getsockname()
+
+
+def start_server(io_loop, settings, backend_address):
+    ssl_options = None
+    if settings["ssl"]:
+        ssl_options = {"certfile": settings["certfile"], "keyfile": settings["keyfile"]}
+    srv_tun = WSTunnelServer(port=0, address="127.0.0.1", proxies={"/bench": backend_address}, io_loop=io_loop,
+                             ssl_options=ssl_options)
+    for clazz in settings["filters"]:
+        srv_tun.install_filter(load_filter(clazz))
+    srv_tun.start()
+    return srv_tun, srv_tun.port
+
+
+def start_client(io_loop, settings, server_port):
+    ws_url = "%s://localhost:%d/bench" % ("wss" if settings["ssl"] else "ws", server_port)
+    clt_tun = WSTunnelClient(proxies={0: ws_url}, address="127.0.0.1", family=socket.AF_INET, io_loop=io_loop,
+                             ws_options={"validate_cert": False})
+    for clazz in settings["filters"]:
+        clt_tun.install_filter(load_filter(clazz))
+    clt_tun.start()
+    return clt_tun, clt_tun.address_list[0]
+
+
+def run_endpoint(target, args, conn):
+    """
+    Process body: start the endpoint returned by target, send its address and serve usage requests until stopped
+    """
+    io_loop = new_event_loop(args[0]["event_loop"])
+    endpoint, address = target(io_loop, *args)
+
+    def on_command(fd, events):
+        if conn.recv() == "usage":
+            conn.send(usage())
+        else:
+            endpoint.stop()
+            io_loop.stop()
+
+    io_loop.add_handler(conn.fileno(), on_command, IOLoop.READ)
+    conn.send(address)
+    io_loop.start()
+
+
+class EndpointProcess(object):
+    """
+    Runs an endpoint in a child process
+    """
+
+    def __init__(self, target, *args):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_endpoint, args=(target, args, child_conn))
+        self.process.daemon = True
+        self.address = None
+
+    def start(self):
+        self.process.start()
+        if not self.conn.poll(START_TIMEOUT):
+            self.stop()
+            raise RuntimeError("Endpoint process did not start")
+        self.address = self.conn.recv()
+        return self.address
+
+    def usage(self):
+        self.conn.send("usage")
+        return self.conn.recv()
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send("stop")
+            except (IOError, OSError):
+                pass
+            self.process.join(START_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class Session(object):
+    """
+    A connection exchanging messages through the tunnel one at a time, timing each round trip
+    """
+
+    def __init__(self, load, messages, callback):
+        self.load = load
+        self.remaining = messages
+        self.callback = callback
+        self.started = None
+        self.done = False
+        self.stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM), io_loop=load.io_loop)
+        self.stream.set_close_callback(self.on_close)
+        self.stream.connect(load.address, self.send)
+
+    def send(self):
+        if not self.remaining:
+            self.finish()
+            return
+        self.remaining -= 1
+        self.started = time.time()
+        self.stream.write(self.load.payload)
+        self.stream.read_bytes(self.load.reply_size, self.on_reply)
+
+    def on_reply(self, data):
+        self.load.latencies.append(time.time() - self.started)
+        self.load.bytes += len(self.load.payload)
+        self.send()
+
+    def on_close(self):
+        self.finish(failed=True)
+
+    def finish(self, failed=False):
+        if self.done:
+            return
+        self.done = True
+        if failed:
+            self.load.errors += 1
+        self.stream.set_close_callback(None)
+        self.stream.close()
+        self.callback()
+
+
+class Load(object):
+    """
+    Drives connections through the tunnel listening on address
+    """
+
+    def __init__(self, io_loop, address, payload, reply_size, concurrency, timeout):
+        self.io_loop = io_loop
+        self.address = address
+        self.payload = payload
+        self.reply_size = reply_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.timed_out = False
+
+    def run(self, sessions, messages):
+        """
+        Run sessions exchanging messages each, at most concurrency at a time. Returns the elapsed seconds.
+        """
+        counters = {"started": 0, "finished": 0}
+
+        def start_next():
+            if counters["started"] < sessions:
+                counters["started"] += 1
+                Session(self, messages, on_finish)
+
+        def on_finish():
+            counters["finished"] += 1
+            if counters["finished"] == sessions:
+                self.io_loop.stop()
+            else:
+                start_next()
+
+        def on_timeout():
+            self.timed_out = True
+            self.io_loop.stop()
+
+        self.latencies, self.bytes = [], 0
+        for _ in range(min(self.concurrency, sessions)):
+            self.io_loop.add_callback(start_next)
+        timeout = self.io_loop.add_timeout(self.io_loop.time() + self.timeout, on_timeout)
+        started = time.time()
+        self.io_loop.start()
+        self.io_loop.remove_timeout(timeout)
+        return max(time.time() - started, 1e-6)
+
+
+class TunnelBenchmark(object):
+    """
+    Measures connections per second opening connects connections exchanging a single message, then throughput
+    and latency with concurrency connections exchanging messages each, reporting the endpoint usage of the latter
+    """
+
+    def __init__(self, concurrency=10, messages=100, connects=200, payload_size=1024, pattern="zeros",
+                 backend=ECHO, ssl=False, filters=(), event_loop=None, timeout=120,
+                 certfile=os.path.join(FIXTURE, "localhost.pem"), keyfile=os.path.join(FIXTURE, "localhost.key")):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend %s, expected one of %s" % (backend, ", ".join(BACKENDS)))
+        self.settings = {
+            "concurrency": concurrency,
+            "messages": messages,
+            "connects": connects,
+            "payload_size": payload_size,
+            "pattern": pattern,
+            "backend": backend,
+            "ssl": ssl,
+            "filters": list(filters),
+            "event_loop": event_loop,
+            "certfile": certfile,
+            "keyfile": keyfile,
+        }
+        self.payload = make_payload(payload_size, pattern)
+        self.timeout = timeout
+
+    def run(self):
+        """
+        Run the benchmark and return its results
+        """
+        backend = EndpointProcess(start_backend, self.settings)
+        server = EndpointProcess(start_server, self.settings, backend.start())
+        client = EndpointProcess(start_client, self.settings, server.start())
+        address = client.start()
+        io_loop = new_event_loop(self.settings["event_loop"])
+        try:
+            load = Load(io_loop, address, self.payload,
+                        len(self.payload) if self.settings["backend"] == ECHO else 1,
+                        self.settings["concurrency"], self.timeout)
+            connect_elapsed = load.run(self.settings["connects"], 1)
+            connects = len(load.latencies)
+            before = dict(server=server.usage(), client=client.usage())
+            elapsed = load.run(self.settings["concurrency"], self.settings["messages"])
+            after = dict(server=server.usage(), client=client.usage())
+        finally:
+            for endpoint in (client, server, backend):
+                endpoint.stop()
+            io_loop.close(all_fds=True)
+        results = dict((k, v) for k, v in self.settings.items() if k not in ("certfile", "keyfile"))
+        results.update({
+            "event_loop": self.settings["event_loop"] or "tornado",
+            "connections_per_second": connects / connect_elapsed,
+            "round_trips": len(load.latencies),
+            "throughput": load.bytes / elapsed,
+            "latency_avg": sum(load.latencies) / len(load.latencies) if load.latencies else 0.0,
+            "latency_p50": percentile(load.latencies, 0.5),
+            "latency_p99": percentile(load.latencies, 0.99),
+            "latency_p999": percentile(load.latencies, 0.999),
+            "errors": load.errors,
+            "timed_out": load.timed_out,
+        })
+        for name in ("server", "client"):
+            cpu = after[name][0] - before[name][0]
+            results[name] = {"cpu": cpu, "cpu_percent": 100.0 * cpu / elapsed, "rss": after[name][1]}
+        return results
+
+
+def environment():
+    """
+    Describe where the benchmark runs, to tell comparable runs apart
+    """
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "tornado": tornado.version,
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+    }
+
+
+def run(matrix=False, **kwargs):
+    """
+    Return the results of a benchmark with the given settings or, with matrix, of every combination of
+    SSL and filters (when any is given)
+    """
+    scenarios = [{}]
+    if matrix:
+        scenarios = [{"ssl": ssl, "filters": filters} for ssl in (False, True)
+                     for filters in ([[], kwargs.get("filters")] if kwargs.get("filters") else [[]])]
+    return [TunnelBenchmark(**dict(kwargs, **scenario)).run() for scenario in scenarios]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a local WebSocket tunnel end to end")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="concurrent connections")
+    parser.add_argument("-m", "--messages", type=int, default=100, help="messages exchanged by each connection")
+    parser.add_argument("--connects", type=int, default=200, help="connections measuring connections per second")
+    parser.add_argument("-s", "--payload-size", type=int, default=1024, help="bytes of each message")
+    parser.add_argument("-p", "--pattern", choices=PATTERNS, default="zeros", help="content of the messages")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default=ECHO,
+                        help="echo the messages back, or acknowledge them with a single byte")
+    parser.add_argument("--ssl", action="store_true", help="tunnel over wss")
+    parser.add_argument("--certfile", default=os.path.join(FIXTURE, "localhost.pem"), help="server certificate")
+    parser.add_argument("--keyfile", default=os.path.join(FIXTURE, "localhost.key"), help="server private key")
+    parser.add_argument("-f", "--filter", dest="filters", action="append", default=[], metavar="CLASS",
+                        help="filter installed on both endpoints, may be repeated")
+    parser.add_argument("--matrix", action="store_true", help="run with and without SSL and filters")
+    parser.add_argument("--event-loop", default=None, help="event loop of the endpoints")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed to each phase")
+    parser.add_argument("-o", "--output", default=None, help="write the JSON results to this file")
+    options = vars(parser.parse_args())
+    output = options.pop("output")
+
+    report = {"environment": environment(), "results": run(**options)}
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,35 +13,61 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import copy
 import logging
 import socket
-from tornado import httpclient
-from tornado.ioloop import IOLoop
+import time
+from tornado import httpclient, httputil
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.process import cpu_count, fork_processes
 
 from tornado.tcpserver import TCPServer
 from tornado.websocket import WebSocketClientConnection
-from wstunnel.toolbox import tuple_to_address
-from wstunnel.exception import EndpointNotAvailableException
-from wstunnel.filters import FilterException
+from wstunnel.toolbox import tuple_to_address, bind_sockets
+from wstunnel.compression import CompressionException, subprotocols, message_deflate, DEFLATE_SUBPROTOCOL, \
+    MUX_DEFLATE_SUBPROTOCOL
+from wstunnel.exception import EndpointNotAvailableException, MappedServiceNotAvailableException
+from wstunnel.filters import FilterException, filter_chain, to_bytes
+from wstunnel.flow import BackPressure, Coalescer, DEFAULT_HIGH_WATERMARK, DEFAULT_COALESCE_BYTES, SOCKET_TO_WS, \
+    WS_TO_SOCKET, shaping
+from wstunnel.keepalive import KeepAlive, keep_alive_options
+from wstunnel.metrics import ResourceMetrics, TunnelMetrics
+from wstunnel.mux import MultiplexedSession, MultiplexException, Channel, MUX_SUBPROTOCOL, OPEN, WINDOW_STRUCT, \
+    DEFAULT_WINDOW
+from wstunnel.stats import StatsRegion
 
 __author__ = "fabio"
 logger = logging.getLogger(__name__)
 
 
-def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None, **kwargs):
+def websocket_request(url, connect_timeout=None, headers=None, **kwargs):
+    """
+    Build the request used to handshake WebSocket connections with the given url.
+    It can be built once and passed to websocket_connect in place of the url.
+    """
+    options = dict(httpclient.HTTPRequest._DEFAULTS)
+    options.update(kwargs)
+    request = httpclient.HTTPRequest(url, connect_timeout=connect_timeout, headers=httputil.HTTPHeaders(headers or {}),
+                                     validate_cert=kwargs.get("validate_cert", True))
+    return httpclient._RequestProxy(request, options)
+
+
+def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None, headers=None, **kwargs):
     """Client-side websocket support.
 
-    Takes a url and returns a Future whose result is a
+    Takes a url, or a request built by `websocket_request`, and returns a Future whose result is a
     `WebSocketClientConnection`.
     """
-    options = httpclient.HTTPRequest._DEFAULTS.copy()
-    options.update(kwargs)
-
     if io_loop is None:
         io_loop = IOLoop.current()
-    request = httpclient.HTTPRequest(url, connect_timeout=connect_timeout,
-                                     validate_cert=kwargs.get("validate_cert", True))
-    request = httpclient._RequestProxy(request, options)
+    if isinstance(url, httpclient._RequestProxy):
+        # The handshake alters url and headers, so each connection gets its own shallow copy
+        request = copy.copy(url.request)
+        request.headers = httputil.HTTPHeaders(request.headers)
+        request = httpclient._RequestProxy(request, url.defaults)
+    else:
+        request = websocket_request(url, connect_timeout=connect_timeout, headers=headers, **kwargs)
     conn = WebSocketClientConnection(io_loop, request)
     if callback is not None:
         io_loop.add_future(conn.connect_future, callback)
@@ -56,17 +82,46 @@ class WebSocketProxy(TCPServer):
     def __init__(self, port, ws_url, **kwargs):
         super(WebSocketProxy, self).__init__(kwargs.get("io_loop"),
                                              kwargs.get("ssl_options"))
+        self._address_list = []
         self.bind(port,
                   kwargs.get("address", ''),
                   kwargs.get("family", socket.AF_UNSPEC),
-                  kwargs.get("backlog", 128))
+                  kwargs.get("backlog", 128),
+                  kwargs.get("reuse_port", False))
 
         self.ws_url = ws_url
         self.ws_options = kwargs.get("ws_options", {})
-        self.filters = kwargs.get("filters", [])
+        self.filters = filter_chain(kwargs.get("filters"))
+        self.io_loop = kwargs.get("io_loop")
+        self.multiplex = kwargs.get("multiplex", False)
+        self.mux_connections = kwargs.get("mux_connections", 1)
+        self.mux_window = kwargs.get("mux_window", DEFAULT_WINDOW)
+        self.mux_sessions = []
+        self.connect_timeout = kwargs.get("connect_timeout")
+        self.high_watermark = kwargs.get("high_watermark", DEFAULT_HIGH_WATERMARK)
+        self.coalesce_delay = kwargs.get("coalesce_delay", 0)
+        self.coalesce_bytes = kwargs.get("coalesce_bytes", DEFAULT_COALESCE_BYTES)
+        self.compression = kwargs.get("compression")
+        self.scheduler = kwargs.get("scheduler")
+        self.priority = kwargs.get("priority")
+        self.weight = kwargs.get("weight", 1)
+        self.shaping = shaping(kwargs.get("shaping"))
+        self.keep_alive = keep_alive_options(kwargs.get("keep_alive"))
+        self.metrics = kwargs.get("metrics") or ResourceMetrics()
+        protocols = subprotocols(self.multiplex, self.compression)
+        headers = {"Sec-WebSocket-Protocol": ", ".join(protocols)} if protocols else None
+        self.ws_request = websocket_request(ws_url, connect_timeout=self.connect_timeout, headers=headers,
+                                            **self.ws_options)
+        self.pool = None
+        if kwargs.get("pool_min_idle") and not self.multiplex:
+            self.pool = WebSocketPool(self.ws_request,
+                                      io_loop=self.io_loop,
+                                      min_idle=kwargs.get("pool_min_idle"),
+                                      max_idle=kwargs.get("pool_max_idle"),
+                                      max_age=kwargs.get("pool_max_age", 60),
+                                      refill_rate=kwargs.get("pool_refill_rate", 10))
         self.serving = False
         self.ws_conn = None
-        self._address_list = []
 
     @property
     def address_list(self):
@@ -78,18 +133,78 @@ class WebSocketProxy(TCPServer):
         """
         logger.info("Got connection from %s on %s" % (tuple_to_address(stream.socket.getpeername()),
                                                       tuple_to_address(stream.socket.getsockname())))
+        if self.multiplex:
+            self.get_mux_session().open_channel(stream)
+            return
         self.ws_conn = WebSocketProxyConnection(self.ws_url, stream, address,
                                                 filters=self.filters,
-                                                ws_options=self.ws_options)
-        self.ws_conn.connect()
+                                                ws_options=self.ws_options,
+                                                io_loop=self.io_loop,
+                                                request=self.ws_request,
+                                                high_watermark=self.high_watermark,
+                                                coalesce_delay=self.coalesce_delay,
+                                                coalesce_bytes=self.coalesce_bytes,
+                                                compression=self.compression,
+                                                scheduler=self.scheduler,
+                                                priority=self.priority,
+                                                weight=self.weight,
+                                                shaping=self.shaping,
+                                                keep_alive=self.keep_alive,
+                                                metrics=self.metrics)
+        ws_conn = self.pool.get() if self.pool else None
+        if ws_conn is not None:
+            self.ws_conn.attach(ws_conn)
+        else:
+            self.ws_conn.connect()
+
+    def get_mux_session(self):
+        """
+        Pick the least loaded multiplexed WebSocket, opening a new one until mux_connections are established
+        """
+        if len(self.mux_sessions) < self.mux_connections:
+            session = MultiplexedClientSession(self.ws_request,
+                                               io_loop=self.io_loop,
+                                               on_session_close=self.mux_sessions.remove,
+                                               filters=self.filters,
+                                               window=self.mux_window,
+                                               compression=self.compression,
+                                               keep_alive=self.keep_alive,
+                                               metrics=self.metrics)
+            self.mux_sessions.append(session)
+            session.connect()
+            return session
+        return min(self.mux_sessions, key=lambda s: len(s.channels))
+
+    def bind(self, port, address=None, family=socket.AF_UNSPEC, backlog=128, reuse_port=False):
+        """
+        Same as TCPServer.bind, optionally enabling SO_REUSEPORT
+        """
+        sockets = bind_sockets(port, address=address, family=family, backlog=backlog, reuse_port=reuse_port)
+        self._address_list.extend((s.getsockname()[0], s.getsockname()[1]) for s in sockets)
+        if self._started:
+            self.add_sockets(sockets)
+        else:
+            self._pending_sockets.extend(sockets)
+
+    def release_sockets(self):
+        """
+        Return the bound sockets, which this proxy won't accept connections on when started
+        """
+        sockets, self._pending_sockets = self._pending_sockets, []
+        return sockets
 
     def start(self, num_processes=1):
         super(WebSocketProxy, self).start(num_processes)
-        self._address_list = [(s.getsockname()[0], s.getsockname()[1]) for s in self._sockets.values()]
+        if self.pool:
+            self.pool.start()
         self.serving = True
 
     def stop(self):
         super(WebSocketProxy, self).stop()
+        if self.pool:
+            self.pool.stop()
+        for session in list(self.mux_sessions):
+            session.shutdown()
         self.serving = False
 
     def __str__(self):
@@ -106,20 +221,46 @@ class WebSocketProxyConnection(object):
         self.url = url
         self.io_loop = kwargs.get("io_loop")
         self.connect_timeout = kwargs.get("connect_timeout", None)
-        self.keep_alive = kwargs.get("keep_alive", None)
+        self.keep_alive = keep_alive_options(kwargs.get("keep_alive"))
         self.ws_options = ws_options
         self.io_stream, self.address = io_stream, address
-        self.filters = kwargs.get("filters", [])
+        self.filters = filter_chain(kwargs.get("filters")).for_connection()
+        self.request = kwargs.get("request")
+        self.high_watermark = kwargs.get("high_watermark", DEFAULT_HIGH_WATERMARK)
+        self.coalesce_delay = kwargs.get("coalesce_delay", 0)
+        self.coalesce_bytes = kwargs.get("coalesce_bytes", DEFAULT_COALESCE_BYTES)
+        self.compression = kwargs.get("compression")
+        self.scheduler = kwargs.get("scheduler")
+        self.priority = kwargs.get("priority")
+        self.weight = kwargs.get("weight", 1)
+        self.shaping = kwargs.get("shaping")
+        self.metrics = kwargs.get("metrics") or ResourceMetrics()
         self.io_stream.set_close_callback(self.on_close)
         self.ws_conn = None
+        self.deflate = None
+        self.to_ws_flow = None
+        self.to_socket_flow = None
+        self.to_ws_coalescer = None
+        self.to_socket_coalescer = None
+        self.to_ws_queue = None
+        self.to_socket_queue = None
+        self.to_ws_shaper = None
+        self.to_socket_shaper = None
+        self.keep_alive_timer = None
+        self._connect_started = None
+        self._counted = False
 
     def connect(self):
         logger.info("Connecting WebSocket at url %s" % self.url)
-        websocket_connect(self.url,
-                          self.io_loop,
-                          callback=self.on_open,
-                          connect_timeout=self.connect_timeout,
-                          **self.ws_options)
+        self._connect_started = time.time()
+        if self.request is not None:
+            websocket_connect(self.request, self.io_loop, callback=self.on_open)
+        else:
+            websocket_connect(self.url,
+                              self.io_loop,
+                              callback=self.on_open,
+                              connect_timeout=self.connect_timeout,
+                              **self.ws_options)
 
     def on_open(self, ws_conn):
         """
@@ -129,23 +270,76 @@ class WebSocketProxyConnection(object):
         try:
             self.ws_conn = ws_conn.result()
         except httpclient.HTTPError as e:
+            self.metrics.handshake_failures += 1
+            if e.code == 502:
+                self.metrics.connect_failures += 1
+                logger.error(MappedServiceNotAvailableException(cause=e))
+                self.on_close()
+                return
             #TODO: change with raise EndpointNotAvailableException(message="The server endpoint is not available") from e
             raise EndpointNotAvailableException("The server endpoint is not available", cause=e)
-        self.ws_conn.on_message = self.on_message
+        self.metrics.connect_latency.observe(time.time() - self._connect_started)
+        self.attach(self.ws_conn)
+
+    def attach(self, ws_conn):
+        """
+        Bind an handshaked websocket connection to the client socket and start forwarding data.
+        Messages the websocket received while idle are delivered first.
+        """
+        self.ws_conn = ws_conn
+        self.metrics.connections_active += 1
+        self.metrics.connections_total += 1
+        self._counted = True
+        if self.compression and ws_conn.headers.get("Sec-WebSocket-Protocol") == DEFLATE_SUBPROTOCOL:
+            self.deflate = message_deflate(self.compression)
+        self.to_ws_flow = BackPressure(self.io_stream, ws_conn.stream, self.high_watermark)
+        self.to_socket_flow = BackPressure(ws_conn.stream, self.io_stream, self.high_watermark)
+        if self.coalesce_delay:
+            max_delay = self.coalesce_delay / 1000000.0
+            self.to_ws_coalescer = Coalescer(self.write_to_ws, ws_conn.stream.io_loop, max_delay, self.coalesce_bytes)
+            self.to_socket_coalescer = Coalescer(self.io_stream.write, self.io_stream.io_loop, max_delay,
+                                                 self.coalesce_bytes)
+        if self.shaping:
+            self.to_ws_shaper = self.shaping.shaper(SOCKET_TO_WS, self.io_stream, self.metrics)
+            self.to_socket_shaper = self.shaping.shaper(WS_TO_SOCKET, ws_conn.stream, self.metrics)
+        on_message, on_peer_message = self.on_message, self.on_peer_message
+        if self.scheduler:
+            self.to_ws_queue = self.scheduler.flow(self.io_stream, self.on_peer_message, self.priority, self.weight)
+            self.to_socket_queue = self.scheduler.flow(ws_conn.stream, self.on_message, self.priority, self.weight,
+                                                       split=False)
+            on_message, on_peer_message = self.to_socket_queue.write, self.to_ws_queue.write
+        self.ws_conn.on_message = on_message
         self.ws_conn.release_callback = self.on_close
-        self.io_stream.read_until_close(self.on_close, streaming_callback=self.on_peer_message)
+        if self.keep_alive is not None:
+            self.keep_alive_timer = KeepAlive(ws_conn.stream, ws_conn.protocol.write_ping, self.on_keep_alive_timeout,
+                                              metrics=self.metrics, **self.keep_alive)
+            ws_conn.on_pong = self.keep_alive_timer.on_pong
+            self.keep_alive_timer.start()
+        while ws_conn.read_queue:
+            self.on_message(ws_conn.read_queue.popleft())
+        self.io_stream.read_until_close(self.on_close, streaming_callback=on_peer_message)
 
     def on_message(self, message):
         """
         On a message received from websocket, send back to client peer
         """
+        if message is not None:
+            self.metrics.bytes_ws_to_socket += len(message)
+            if self.keep_alive_timer:
+                self.keep_alive_timer.active = True
         try:
-            data = None if message is None else bytes(message)
-            for filtr in self.filters:
-                data = filtr.ws_to_socket(data=data)
+            if self.deflate and message is not None:
+                message = self.deflate.decompress(message)
+            data = message if self.filters.ws_to_socket is None else to_bytes(self.filters.ws_to_socket(message))
             if data:
-                self.io_stream.write(data)
-        except FilterException as e:
+                if self.to_socket_coalescer:
+                    self.to_socket_coalescer.write(data)
+                else:
+                    self.io_stream.write(data)
+                self.to_socket_flow.check()
+                if self.to_socket_shaper:
+                    self.to_socket_shaper.consume(len(data))
+        except (FilterException, CompressionException) as e:
             logger.exception(e)
             self.on_close()
 
@@ -155,23 +349,266 @@ class WebSocketProxyConnection(object):
         """
         logger.info("Closing connection with client at {0}:{1}".format(*self.address))
         logger.debug("Received args %s and %s", args, kwargs)
+        if self._counted:
+            self.metrics.connections_active -= 1
+            self._counted = False
+        if self.keep_alive_timer:
+            self.keep_alive_timer.stop()
+        if self.to_ws_queue:
+            self.to_ws_queue.close()
+            self.to_socket_queue.close()
+        if self.to_ws_coalescer:
+            self.to_ws_coalescer.close()
+            self.to_socket_coalescer.close()
+        self.filters.close()
         if not self.io_stream.closed():
             self.io_stream.close()
 
+    def on_keep_alive_timeout(self):
+        """
+        The server stopped answering pings: tear down the WebSocket and the client socket
+        """
+        self.on_close()
+        self.ws_conn.stream.close()
+
     def on_peer_message(self, message):
         """
         On data received from client peer, forward through WebSocket
         """
         try:
-            data = None if message is None else bytes(message)
-            for filtr in self.filters:
-                data = filtr.socket_to_ws(data=data)
+            data = message if self.filters.socket_to_ws is None else to_bytes(self.filters.socket_to_ws(message))
             if data:
-                self.ws_conn.write_message(data, binary=True)
+                if self.to_ws_coalescer:
+                    self.to_ws_coalescer.write(data)
+                else:
+                    self.write_to_ws(data)
+                self.to_ws_flow.check()
+                if self.to_ws_shaper:
+                    self.to_ws_shaper.consume(len(data))
         except FilterException as e:
             logger.exception(e)
             self.on_close()
 
+    def write_to_ws(self, data):
+        message = self.deflate.compress(data) if self.deflate else data
+        self.metrics.bytes_socket_to_ws += len(message)
+        self.ws_conn.write_message(message, binary=True)
+
+
+class WebSocketPool(object):
+    """
+    Keeps a set of handshaked idle websocket connections, so that new client connections do not
+    wait for the handshake. The pool is refilled in background at most refill_rate times per second.
+    The number of idle connections grows from min_idle up to max_idle while the pool runs dry and shrinks
+    back as idle connections reach max_age seconds unused.
+    """
+
+    def __init__(self, request, io_loop=None, min_idle=1, max_idle=None, max_age=60, refill_rate=10):
+        self.request = request
+        self.io_loop = io_loop or IOLoop.current()
+        self.min_idle = min_idle
+        self.max_idle = max(max_idle or min_idle, min_idle)
+        self.max_age = max_age
+        self.refill_rate = refill_rate
+        self.target = min_idle
+        self.idle = collections.deque()
+        self.connecting = 0
+        self.hits = 0
+        self.misses = 0
+        self._last_connect = 0
+        self._periodic = None
+
+    def start(self):
+        self._periodic = PeriodicCallback(self.refill, 1000.0 / self.refill_rate, io_loop=self.io_loop)
+        self._periodic.start()
+        self.refill()
+
+    def stop(self):
+        if self._periodic:
+            self._periodic.stop()
+            self._periodic = None
+        while self.idle:
+            self.idle.popleft()[1].close()
+
+    def get(self):
+        """
+        Return an idle websocket connection, or None if the pool is empty
+        """
+        self._expire()
+        ws_conn = None
+        while self.idle and ws_conn is None:
+            created, ws_conn = self.idle.pop()
+            if ws_conn.stream.closed() or None in ws_conn.read_queue:
+                ws_conn = None
+        if ws_conn is None:
+            self.misses += 1
+            self.target = min(self.target + 1, self.max_idle)
+        else:
+            self.hits += 1
+        self.refill()
+        return ws_conn
+
+    def refill(self):
+        """
+        Start a new handshake if the pool is below its target and the refill rate allows it
+        """
+        self._expire()
+        now = self.io_loop.time()
+        if self._periodic and len(self.idle) + self.connecting < self.target \
+                and now - self._last_connect >= 1.0 / self.refill_rate:
+            self._last_connect = now
+            self.connecting += 1
+            websocket_connect(self.request, self.io_loop, callback=self.on_open)
+
+    def on_open(self, ws_conn):
+        self.connecting -= 1
+        try:
+            ws_conn = ws_conn.result()
+        except httpclient.HTTPError as e:
+            logger.debug("Unable to prepare pooled WebSocket: %s", e)
+            return
+        if self._periodic is None or len(self.idle) >= self.max_idle:
+            ws_conn.close()
+        else:
+            self.idle.append((self.io_loop.time(), ws_conn))
+
+    def _expire(self):
+        """
+        Close idle connections older than max_age
+        """
+        deadline = self.io_loop.time() - self.max_age
+        while self.idle and self.idle[0][0] < deadline:
+            self.idle.popleft()[1].close()
+            self.target = max(self.target - 1, self.min_idle)
+
+
+class MultiplexedClientSession(MultiplexedSession):
+    """
+    Carries the local TCP streams of a proxy as channels over a single WebSocket connection.
+    Frames written before the WebSocket handshake completes are queued.
+    """
+
+    def __init__(self, request, io_loop=None, on_session_close=None, compression=None, keep_alive=None, metrics=None,
+                 **kwargs):
+        super(MultiplexedClientSession, self).__init__(**kwargs)
+        self.request = request
+        self.compression = compression
+        self.keep_alive = keep_alive
+        self.keep_alive_timer = None
+        self.metrics = metrics or ResourceMetrics()
+        self.deflate = None
+        self.url = request.url
+        self.io_loop = io_loop
+        self.on_session_close = on_session_close
+        self.ws_conn = None
+        self.closed = False
+        self._next_id = 1
+        self._pending = []
+        self._connect_started = None
+        self._counted = False
+
+    def connect(self):
+        logger.info("Connecting multiplexed WebSocket at url %s" % self.url)
+        self._connect_started = time.time()
+        websocket_connect(self.request, self.io_loop, callback=self.on_open)
+
+    def on_open(self, ws_conn):
+        """
+        When the websocket connection is handshaked, flush the frames queued in the meanwhile
+        """
+        try:
+            self.ws_conn = ws_conn.result()
+        except httpclient.HTTPError as e:
+            logger.error("The server endpoint is not available, caused by %s" % repr(e))
+            self.metrics.handshake_failures += 1
+            self.on_close()
+            return
+        self.metrics.connect_latency.observe(time.time() - self._connect_started)
+        protocol = self.ws_conn.headers.get("Sec-WebSocket-Protocol")
+        if protocol not in (MUX_SUBPROTOCOL, MUX_DEFLATE_SUBPROTOCOL):
+            logger.error("The server endpoint at %s does not support multiplexing" % self.url)
+            self.shutdown()
+            return
+        if protocol == MUX_DEFLATE_SUBPROTOCOL:
+            self.deflate = message_deflate(self.compression)
+        self.metrics.connections_active += 1
+        self.metrics.connections_total += 1
+        self._counted = True
+        self.ws_conn.on_message = self.on_message
+        if self.keep_alive is not None:
+            self.keep_alive_timer = KeepAlive(self.ws_conn.stream, self.ws_conn.protocol.write_ping,
+                                              self.on_keep_alive_timeout, metrics=self.metrics, **self.keep_alive)
+            self.ws_conn.on_pong = self.keep_alive_timer.on_pong
+            self.keep_alive_timer.start()
+        for frame in self._pending:
+            self.write_frame(frame)
+        self._pending = []
+
+    def write_frame(self, frame):
+        if self.closed:
+            return
+        if self.ws_conn is None:
+            self._pending.append(frame)
+        else:
+            message = self.deflate.compress(frame) if self.deflate else frame
+            self.metrics.bytes_socket_to_ws += len(message)
+            self.ws_conn.write_message(message, binary=True)
+
+    def open_channel(self, io_stream):
+        """
+        Carry the given TCP stream over a new channel
+        """
+        channel_id = self._next_id
+        self._next_id += 1
+        channel = Channel(self, channel_id, io_stream, window=self.window, filters=self.filters)
+        self.channels[channel_id] = channel
+        self.send_frame(OPEN, channel_id, WINDOW_STRUCT.pack(self.window))
+        channel.start()
+        return channel
+
+    def on_message(self, message):
+        """
+        On a frame received from the WebSocket. None means the WebSocket has been closed.
+        """
+        if message is None:
+            self.on_close()
+            return
+        self.metrics.bytes_ws_to_socket += len(message)
+        if self.keep_alive_timer:
+            self.keep_alive_timer.active = True
+        try:
+            self.on_frame(self.deflate.decompress(message) if self.deflate else message)
+        except (MultiplexException, CompressionException) as e:
+            logger.exception(e)
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Close the WebSocket and all of its channels
+        """
+        if self.ws_conn is not None:
+            self.ws_conn.close()
+        self.on_close()
+
+    def on_keep_alive_timeout(self):
+        """
+        The server stopped answering pings: tear down the WebSocket and all of its channels
+        """
+        self.on_close()
+        self.ws_conn.stream.close()
+
+    def on_close(self):
+        if not self.closed:
+            logger.info("Closing multiplexed WebSocket at url %s" % self.url)
+            self.closed = True
+            if self._counted:
+                self.metrics.connections_active -= 1
+            if self.keep_alive_timer:
+                self.keep_alive_timer.stop()
+            self.close()
+            if self.on_session_close:
+                self.on_session_close(self)
+
 
 class WSTunnelClient(object):
     """
@@ -179,7 +616,7 @@ class WSTunnelClient(object):
     """
 
     def __init__(self, proxies=None, address='', family=socket.AF_UNSPEC, io_loop=None, ssl_options=None,
-                 ws_options=None):
+                 ws_options=None, filter_profile=None, **kwargs):
 
         self.stream_options = {
             "address": address,
@@ -188,24 +625,30 @@ class WSTunnelClient(object):
             "ssl_options": ssl_options,
         }
         self.ws_options = ws_options or {}
+        self.proxy_options = kwargs
         self.proxies = proxies or {}
         self.serving = False
-        self._num_proc = 1
+        self.metrics = TunnelMetrics()
+        self.metrics.filter_profile = self.filter_profile = filter_profile
+        self._num_processes = 1
         if proxies:
             for port, ws_url in proxies.items():
                 self.add_proxy(port, WebSocketProxy(port=port,
                                                     ws_url=ws_url,
                                                     ws_options=self.ws_options,
-                                                    **self.stream_options))
+                                                    **dict(self.stream_options, **self.proxy_options)))
 
     def add_proxy(self, key, ws_proxy):
         """
         Adds a proxy to the list.
         If the tunnel is serving connection, the proxy it gets started.
         """
+        ws_proxy.metrics = self.metrics.resource(key)
+        if self.filter_profile is not None:
+            ws_proxy.filters.instrument(self.filter_profile, key)
         self.proxies[key] = ws_proxy
         if self.serving:
-            ws_proxy.start(self._num_proc)
+            ws_proxy.start()
             logger.info("Started %s" % ws_proxy)
 
     def remove_proxy(self, key):
@@ -250,17 +693,35 @@ class WSTunnelClient(object):
         for ws_proxy in self.proxies.values():
             ws_proxy.filters.remove(filtr)
 
-    def start(self, num_processes=1):
+    def start(self, num_processes=1, dispatcher=None):
         """
-        Start the client tunnel service by starting each configured proxy
+        Start the client tunnel service by starting each configured proxy.
+        Processes are forked once, each one serving all the proxies.
+        With a dispatcher, the parent process accepts the connections and passes them to the workers.
         """
         logger.info("Starting %d %s processes" % (num_processes, self.__class__.__name__))
         self._num_processes = num_processes
+        workers = num_processes or cpu_count()
+        region = StatsRegion(self.proxies, workers) if workers > 1 else None
+        if dispatcher is not None:
+            for ws_proxy in self.proxies.values():
+                dispatcher.add_server(ws_proxy, ws_proxy.release_sockets())
+            self.bind_stats(region, dispatcher.start(workers))
+        elif workers > 1:
+            self.bind_stats(region, fork_processes(workers))
         for key, ws_proxy in self.proxies.items():
-            ws_proxy.start(num_processes)
+            ws_proxy.start()
             logger.info("Started %s" % ws_proxy)
             self.serving = True
 
+    def bind_stats(self, region, worker):
+        """
+        Make a forked worker account the metrics of its proxies in its slots of the shared stats region
+        """
+        self.metrics.bind(region, worker)
+        for key, ws_proxy in self.proxies.items():
+            ws_proxy.metrics = self.metrics.resource(key)
+
     def stop(self):
         """
         Stop the client tunnel service by stopping each configured proxy
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The places where wstunnel depends on behaviours differing among the supported tornado versions, 3.x and 4.x, or on
+tornado internals: the handshake of WebSocketHandler and the IOStream hooks pausing reads and tracking writes.
+"""
+import functools
+import tornado
+from tornado import httputil, websocket
+from tornado.escape import utf8
+from tornado.web import asynchronous
+
+__author__ = 'fabio'
+
+TORNADO_VERSION = tornado.version_info
+
+# IOStream attributes describing the pending read operation, with their idle values
+if TORNADO_VERSION < (4, 0):
+    READ_STATE = {
+        "_read_callback": None,
+        "_streaming_callback": None,
+        "_read_until_close": False,
+        "_read_bytes": None,
+        "_read_delimiter": None,
+        "_read_regex": None,
+    }
+else:
+    READ_STATE = {
+        "_read_callback": None,
+        "_streaming_callback": None,
+        "_read_until_close": False,
+        "_read_bytes": None,
+        "_read_delimiter": None,
+        "_read_regex": None,
+        "_read_partial": False,
+        "_read_max_bytes": None,
+        "_read_future": None,
+    }
+
+
+class WebSocketHandler(websocket.WebSocketHandler):
+    """
+    WebSocketHandler whose upgrade can be held back by overriding before_upgrade: the upgrade goes on once
+    it calls back, otherwise the request must be answered with reject.
+    """
+
+    def before_upgrade(self, callback):
+        callback()
+
+    if TORNADO_VERSION < (4, 0):
+        def _execute(self, transforms, *args, **kwargs):
+            # tornado 3 upgrades in _execute rather than in get
+            self.before_upgrade(lambda: super(WebSocketHandler, self)._execute(transforms, *args, **kwargs))
+
+        def reject(self, status, message=""):
+            # tornado 3 disables set_status and finish on WebSocketHandler, answering errors on its stream
+            if not self.stream.closed():
+                self.stream.write(utf8("HTTP/1.1 %d %s\r\n\r\n%s" % (status, httputil.responses[status], message)))
+                self.stream.close()
+    else:
+        @asynchronous
+        def get(self, *args, **kwargs):
+            self.before_upgrade(lambda: super(WebSocketHandler, self).get(*args, **kwargs))
+
+        def reject(self, status, message=""):
+            self.set_status(status)
+            self.finish(message)
+
+
+def pause_reading(stream, reason=None):
+    """
+    Stop delivering data from the given IOStream and stop polling its socket for reads.
+    The pending read operation is set aside until resume_reading is called for every reason reads were paused for.
+    """
+    if stream.closed():
+        return
+    reasons = getattr(stream, "_pause_reasons", None)
+    if reasons is None:
+        reasons = stream._pause_reasons = set()
+    reasons.add(reason)
+    if is_reading_paused(stream):
+        return
+    # Stream like objects may lack some of the attributes
+    stream._paused_read = dict((attr, getattr(stream, attr)) for attr in READ_STATE if hasattr(stream, attr))
+    for attr in stream._paused_read:
+        setattr(stream, attr, READ_STATE[attr])
+    # Reads started while paused, like the next frame a WebSocket asks for, are set aside too
+    stream._try_inline_read = functools.partial(_defer_read, stream)
+    if stream._state is not None and stream._state & stream.io_loop.READ:
+        stream._state &= ~stream.io_loop.READ
+        stream.io_loop.update_handler(stream.fileno(), stream._state)
+
+
+def resume_reading(stream, reason=None):
+    """
+    Restore the read operation set aside by pause_reading, delivering any data already buffered,
+    unless reads are still paused for other reasons
+    """
+    reasons = getattr(stream, "_pause_reasons", None)
+    if reasons:
+        reasons.discard(reason)
+        if reasons:
+            return
+    paused = getattr(stream, "_paused_read", None)
+    stream._paused_read = None
+    stream.__dict__.pop("_try_inline_read", None)
+    if paused is None or stream.closed():
+        return
+    if stream.reading():
+        stream._add_io_state(stream.io_loop.READ)
+        return
+    for attr, value in paused.items():
+        setattr(stream, attr, value)
+    if stream.reading():
+        stream._try_inline_read()
+        stream._add_io_state(stream.io_loop.READ)
+
+
+def _defer_read(stream):
+    """
+    Set aside a read operation started on a paused IOStream, in place of trying to complete it at once
+    """
+    for attr in stream._paused_read:
+        value = getattr(stream, attr)
+        if value != READ_STATE[attr]:
+            stream._paused_read[attr] = value
+            setattr(stream, attr, READ_STATE[attr])
+
+
+def is_reading_paused(stream):
+    """
+    Tells whether reads on the given IOStream have been paused by pause_reading
+    """
+    return getattr(stream, "_paused_read", None) is not None
+
+
+def write_buffer_size(stream):
+    """
+    Number of bytes waiting in the write buffer of the given IOStream
+    """
+    # tornado 4.5 and later count the buffered bytes, earlier versions keep a deque of chunks
+    size = getattr(stream, "_write_buffer_size", None)
+    if size is None:
+        size = sum(map(len, stream._write_buffer or ()))
+    return size
+
+
+def on_write_flushed(stream, callback):
+    """
+    Call back once the data written so far to the given IOStream has been flushed to its socket
+    """
+    stream.write(b"", callback)
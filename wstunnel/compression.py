@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per message deflate compression of the WebSocket messages exchanged by the tunnel endpoints.
+
+Compression is negotiated as a WebSocket subprotocol. Each message is prefixed by a flag byte telling whether
+the payload is deflated, so that a sender can stop compressing at any time. Deflated payloads are flushed with
+Z_SYNC_FLUSH and stripped of the trailing 0x00 0x00 0xff 0xff, as RFC 7692 does, but this is a private
+subprotocol rather than the permessage-deflate extension: tornado 3.x does not implement the extension, and the
+tornado 4.x compression_options deflate every message, leaving the adaptive mode no way to skip one.
+"""
+import logging
+import zlib
+from wstunnel.exception import ChainedException
+from wstunnel.mux import MUX_SUBPROTOCOL
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+DEFLATE_SUBPROTOCOL = "wstunnel-deflate"
+MUX_DEFLATE_SUBPROTOCOL = MUX_SUBPROTOCOL + "-deflate"
+
+RAW = b"\x00"
+DEFLATED = b"\x01"
+
+_TAIL = b"\x00\x00\xff\xff"
+
+# Largest data a received message may inflate to, the same as the tornado default for WebSocket messages
+DEFAULT_MAX_SIZE = 10 * 1024 * 1024
+
+
+class CompressionException(ChainedException):
+    """
+    Exception raised when a compressed message cannot be decoded
+    """
+
+    def __init__(self, message="Malformed compressed message", *args, **kwargs):
+        super(CompressionException, self).__init__(message, *args, **kwargs)
+
+
+def subprotocols(multiplex=False, compression=None):
+    """
+    Return the subprotocols a client offers, most preferred first
+    """
+    protocols = []
+    if multiplex:
+        if compression:
+            protocols.append(MUX_DEFLATE_SUBPROTOCOL)
+        protocols.append(MUX_SUBPROTOCOL)
+    elif compression:
+        protocols.append(DEFLATE_SUBPROTOCOL)
+    return protocols
+
+
+def message_deflate(compression):
+    """
+    Build a MessageDeflate out of the compression setting of a proxy, either True or a dict of options
+    """
+    return MessageDeflate(**(compression if isinstance(compression, dict) else {}))
+
+
+class MessageDeflate(object):
+    """
+    Compresses the messages sent over a WebSocket connection and decompresses the received ones.
+    In adaptive mode the compression ratio is measured every sample_size bytes: when the data turns out to be
+    incompressible messages are sent as they are, and compression is tried again after backoff bytes.
+    Received messages inflating to more than max_size bytes are rejected.
+    """
+
+    def __init__(self, level=6, window_bits=15, context_takeover=True, adaptive=True, max_ratio=0.9,
+                 sample_size=64 * 1024, backoff=1024 * 1024, max_size=DEFAULT_MAX_SIZE):
+        self.level = level
+        self.window_bits = min(max(window_bits, 9), 15)
+        self.context_takeover = context_takeover
+        self.adaptive = adaptive
+        self.max_ratio = max_ratio
+        self.sample_size = sample_size
+        self.backoff = backoff
+        self.max_size = max_size
+        self.compressing = True
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-15)
+        self._sample_in = 0
+        self._sample_out = 0
+        self._skipped = 0
+
+    @property
+    def ratio(self):
+        return float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0
+
+    def compress(self, data):
+        """
+        Return the message to send for the given data
+        """
+        self.bytes_in += len(data)
+        if not self.compressing:
+            self.bytes_out += len(data)
+            self._skipped += len(data)
+            if self._skipped >= self.backoff:
+                self.compressing = True
+            return RAW + data
+        if self._compressor is None or not self.context_takeover:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits)
+        payload = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        payload = payload[:-len(_TAIL)]
+        self.bytes_out += len(payload)
+        if self.adaptive:
+            self._sample(len(data), len(payload))
+        return DEFLATED + payload
+
+    def _sample(self, size_in, size_out):
+        self._sample_in += size_in
+        self._sample_out += size_out
+        if self._sample_in >= self.sample_size:
+            if self._sample_out > self._sample_in * self.max_ratio:
+                logger.debug("Data is not compressible (%d bytes out of %d), stop compressing",
+                             self._sample_out, self._sample_in)
+                self.compressing = False
+                self._compressor = None
+                self._skipped = 0
+            self._sample_in = self._sample_out = 0
+
+    def decompress(self, message):
+        """
+        Return the data carried by a received message
+        """
+        flag, payload = message[:1], message[1:]
+        if flag == RAW:
+            return payload
+        if flag != DEFLATED:
+            raise CompressionException()
+        try:
+            data = self._decompressor.decompress(payload + _TAIL, self.max_size)
+        except zlib.error as e:
+            raise CompressionException(cause=e)
+        if self._decompressor.unconsumed_tail:
+            raise CompressionException("Compressed message inflating over %d bytes" % self.max_size)
+        return data
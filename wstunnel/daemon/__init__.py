@@ -15,14 +15,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 import atexit
+import errno
 import signal
 import logging
 import time
 import os
 from tornado.ioloop import IOLoop
 from wstunnel.factory import create_ws_client_endpoint, create_ws_server_endpoint
+from wstunnel.dispatcher import Dispatcher, RESPAWN_DELAY
+from wstunnel.stats import StatsRegion
+from wstunnel.toolbox import pin_to_cpu
 
 __author__ = 'fabio'
+logger = logging.getLogger(__name__)
 SIG_NAMES = dict((k, v) for v, k in signal.__dict__.items() if v.startswith('SIG'))
 SHUTDOWN_POLL = 0.2
 
@@ -211,6 +216,88 @@ class Daemon(object):
         pass
 
 
+class Supervisor(object):
+    """
+    Runs target in several worker processes, respawning the ones exiting unexpectedly.
+    SIGTERM is forwarded to the workers, whose termination is awaited, as well as the given signals. When a list of
+    cpus is given, workers are pinned to them round robin.
+    """
+
+    def __init__(self, target, workers, cpus=None, respawn_delay=RESPAWN_DELAY, signals=()):
+        self.target = target
+        self.workers = workers
+        self.cpus = cpus
+        self.respawn_delay = respawn_delay
+        self.signals = signals
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.terminate)
+        for signum in self.signals:
+            signal.signal(signum, self.forward)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            index = self.children.pop(pid, None)
+            if index is not None and not self.stopping:
+                logger.warning("Worker %d [pid: %d] exited with status %d, respawning" % (index, pid, status))
+                time.sleep(self.respawn_delay)
+                self.spawn(index)
+
+    def spawn(self, index):
+        """
+        Fork a worker process running target(index)
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+        for signum in (signal.SIGTERM,) + tuple(self.signals):
+            signal.signal(signum, signal.SIG_DFL)
+        status = 0
+        try:
+            self.pin(index)
+            self.target(index)
+        except Exception as e:
+            logger.exception(e)
+            status = 1
+        os._exit(status)
+
+    def pin(self, index):
+        """
+        Pin the current process to a cpu, if supported
+        """
+        pin_to_cpu(self.cpus, index)
+
+    def forward(self, signum, frame):
+        """
+        Forward a signal to the workers
+        """
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def terminate(self, *args):
+        """
+        Forward the termination request to the workers
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.children.pop(pid, None)
+
+
 class WSTunnelDaemon(Daemon):
     """
     WebSocket Tunnel Daemon
@@ -222,18 +309,86 @@ class WSTunnelDaemon(Daemon):
                                              workdir=config.get("workdir"))
         self.config = config
         logging.config.dictConfig(self.config["logging"])
+        self.stats_region = None
         self._srv = None
 
+    @property
+    def cpus(self):
+        """
+        The cpus workers are pinned to: all of them when cpu_affinity is yes, or the given list
+        """
+        cpu_affinity = self.config.get("cpu_affinity")
+        if cpu_affinity is True:
+            return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+        return cpu_affinity or None
+
+    @property
+    def forwarded_signals(self):
+        """
+        The signals the workers act on, forwarded to them by the supervisor or the dispatcher: SIGUSR1 logging
+        the filter profile
+        """
+        if self.config.get("filter_profile") and hasattr(signal, "SIGUSR1"):
+            return (signal.SIGUSR1,)
+        return ()
+
     def run(self):
         """
-        Called when daemon starts
+        Called when daemon starts. With more than one worker, a supervisor process runs them, or a dispatcher
+        process passes them the accepted connections when dispatch is set.
         """
         for logger_name in self.config["logging"]["loggers"].keys():
             logging.getLogger(logger_name).disabled = False
-        self._srv.start()
+        workers = self.config.get("workers", 1)
+        if workers > 1 and self.config.get("dispatch"):
+            self.serve(workers, Dispatcher(policy=self.config["dispatch"], cpus=self.cpus,
+                                           signals=self.forwarded_signals))
+        elif workers > 1:
+            # the supervised workers create their endpoints once forked, so their stats region is created here
+            self.stats_region = StatsRegion(self.stats_resources() or (), workers)
+            Supervisor(self.run_worker, workers, cpus=self.cpus, signals=self.forwarded_signals).run()
+        else:
+            self.serve()
+
+    def run_worker(self, index):
+        self.register_shutdown()
+        self.serve(worker=index)
+
+    def serve(self, num_processes=1, dispatcher=None, worker=None):
+        """
+        Start the endpoint and its IOLoop in the current process. A supervised worker accounts its metrics in
+        its slots of the stats region.
+        """
+        self._srv = self.create_endpoint()
+        if self._srv is None:
+            return
+        if self.stats_region is not None:
+            self._srv.bind_stats(self.stats_region, worker)
+        if self._srv.filter_profile is not None and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.report_filters)
+        self._srv.start(num_processes, dispatcher=dispatcher)
         self.switch_user()
         IOLoop.instance().start()
 
+    def report_filters(self, *args):
+        """
+        Log the time spent in each filter, on SIGUSR1
+        """
+        lines = self._srv.filter_profile.report()
+        logger.info("Filter profile [pid: %d]:\n%s" % (os.getpid(), "\n".join(lines) or "no filter calls"))
+
+    def create_endpoint(self):
+        """
+        Hook building the tunnel endpoint to serve. Override to return your client or server endpoint
+        """
+        pass
+
+    def stats_resources(self):
+        """
+        Hook listing the resources the endpoint accounts metrics to, the keys of its proxies
+        """
+        pass
+
     def shutdown(self, *args):
         """
         This will be called when daemon will be stopped
@@ -254,9 +409,11 @@ class WSTunnelClientDaemon(WSTunnelDaemon):
     Shortcut to have a wstunnel client endpoint
     """
 
-    def run(self):
-        self._srv = create_ws_client_endpoint(self.config)
-        super(WSTunnelClientDaemon, self).run()
+    def create_endpoint(self):
+        return create_ws_client_endpoint(self.config)
+
+    def stats_resources(self):
+        return [settings["port"] for settings in self.config["proxies"].values()]
 
 
 class WSTunnelServerDaemon(WSTunnelDaemon):
@@ -264,7 +421,9 @@ class WSTunnelServerDaemon(WSTunnelDaemon):
     Shortcut to have a wstunnel server endpoint
     """
 
-    def run(self):
-        self._srv = create_ws_server_endpoint(self.config)
-        super(WSTunnelServerDaemon, self).run()
+    def create_endpoint(self):
+        return create_ws_server_endpoint(self.config)
+
+    def stats_resources(self):
+        return list(self.config["proxies"])
 
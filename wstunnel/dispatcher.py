@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Load aware dispatching of accepted connections to worker processes.
+
+The parent process accepts connections and passes each socket to a worker over a Unix socket (SCM_RIGHTS),
+choosing the worker with a pluggable policy. Workers report their load (active connections and bytes per second)
+back over the same Unix socket. Passing sockets requires sendmsg/recvmsg, available from Python 3.3.
+"""
+import array
+import errno
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import weakref
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import IOStream, SSLIOStream
+from tornado.netutil import add_accept_handler, ssl_wrap_socket
+from tornado.util import import_object
+from wstunnel.toolbox import pin_to_cpu
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 1.0
+RESPAWN_DELAY = 1
+
+_HANDOFF = struct.Struct("!Ii")
+_REPORT = struct.Struct("!IQ")
+_FD_SIZE = array.array("i").itemsize
+
+
+def least_connections(workers):
+    """
+    Pick the worker with the fewest active connections
+    """
+    return min(workers, key=lambda w: (w.connections, w.bytes_rate))
+
+
+def least_bytes(workers):
+    """
+    Pick the worker moving the fewest bytes per second
+    """
+    return min(workers, key=lambda w: (w.bytes_rate, w.connections))
+
+
+POLICIES = {
+    "connections": least_connections,
+    "bytes": least_bytes,
+}
+
+
+def get_policy(policy):
+    """
+    Return a policy given its name, the dotted path of a callable or the callable itself
+    """
+    if callable(policy):
+        return policy
+    if policy in (None, True):
+        return least_connections
+    return POLICIES.get(policy) or import_object(policy)
+
+
+def send_socket(channel, index, connection):
+    """
+    Pass a connected socket, accepted on the index-th server, through a Unix socket
+    """
+    channel.sendmsg([_HANDOFF.pack(index, connection.family)],
+                    [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [connection.fileno()]))])
+
+
+def receive_socket(channel):
+    """
+    Receive a (server index, socket) pair passed by send_socket
+    """
+    data, ancdata, flags, _ = channel.recvmsg(_HANDOFF.size, socket.CMSG_LEN(_FD_SIZE))
+    if not data:
+        raise EOFError()
+    fds = array.array("i")
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % _FD_SIZE])
+    if not fds:
+        return None
+    index, family = _HANDOFF.unpack(data)
+    connection = socket.fromfd(fds[0], family, socket.SOCK_STREAM)
+    os.close(fds[0])
+    return index, connection
+
+
+class _CountingStream(object):
+    """
+    Mixin counting the bytes read and written by an IOStream into its worker load
+    """
+    load = None
+
+    def read_from_fd(self):
+        chunk = super(_CountingStream, self).read_from_fd()
+        if chunk:
+            self.load.bytes += len(chunk)
+        return chunk
+
+    def write_to_fd(self, data):
+        written = super(_CountingStream, self).write_to_fd(data)
+        self.load.bytes += written
+        return written
+
+
+class CountingIOStream(_CountingStream, IOStream):
+    pass
+
+
+class CountingSSLIOStream(_CountingStream, SSLIOStream):
+    pass
+
+
+class WorkerHandle(object):
+    """
+    The parent side view of a worker: its Unix socket and the last reported load.
+    Connections dispatched since the last report are accounted immediately, so bursts spread over workers.
+    """
+
+    def __init__(self, index, pid, channel):
+        self.index = index
+        self.pid = pid
+        self.channel = channel
+        self.connections = 0
+        self.bytes_rate = 0
+
+    def on_report(self, connections, bytes_rate):
+        self.connections = connections
+        self.bytes_rate = bytes_rate
+
+    def __str__(self):
+        return "worker %d (pid %d, %d connections, %d B/s)" % (self.index, self.pid, self.connections,
+                                                               self.bytes_rate)
+
+
+class Worker(object):
+    """
+    Receives the sockets passed by the dispatcher, hands them to the matching server and reports its load
+    """
+
+    def __init__(self, servers, channel, io_loop=None, report_interval=REPORT_INTERVAL):
+        self.servers = servers
+        self.channel = channel
+        self.io_loop = io_loop or IOLoop.current()
+        self.report_interval = report_interval
+        self.streams = weakref.WeakSet()
+        self.bytes = 0
+        self._last_bytes = 0
+        self._last_report = self.io_loop.time()
+        self._reporter = PeriodicCallback(self.report, report_interval * 1000, io_loop=self.io_loop)
+
+    @property
+    def connections(self):
+        return sum(1 for stream in list(self.streams) if not stream.closed())
+
+    def start(self):
+        self.channel.setblocking(0)
+        self.io_loop.add_handler(self.channel.fileno(), self.on_channel_event, IOLoop.READ)
+        self._reporter.start()
+
+    def stop(self):
+        self._reporter.stop()
+        self.io_loop.remove_handler(self.channel.fileno())
+        self.channel.close()
+
+    def on_channel_event(self, fd, events):
+        while True:
+            try:
+                handoff = receive_socket(self.channel)
+            except socket.error as e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            except EOFError:
+                logger.info("Dispatcher has gone, stop receiving connections")
+                self.stop()
+                return
+            if handoff is not None:
+                self.handle_connection(*handoff)
+
+    def handle_connection(self, index, connection):
+        """
+        Build a stream out of the connection as TCPServer does, and let the server handle it
+        """
+        server = self.servers[index]
+        connection.setblocking(0)
+        try:
+            address = connection.getpeername()
+            if server.ssl_options is not None:
+                connection = ssl_wrap_socket(connection, server.ssl_options, server_side=True,
+                                             do_handshake_on_connect=False)
+                stream = CountingSSLIOStream(connection, io_loop=self.io_loop,
+                                             max_buffer_size=server.max_buffer_size)
+            else:
+                stream = CountingIOStream(connection, io_loop=self.io_loop, max_buffer_size=server.max_buffer_size)
+        except socket.error as e:
+            logger.debug("Dropping dispatched connection: %s", e)
+            connection.close()
+            return
+        stream.load = self
+        self.streams.add(stream)
+        if server.io_loop is None:
+            server.io_loop = self.io_loop
+        server.handle_stream(stream, address)
+
+    def report(self):
+        now = self.io_loop.time()
+        elapsed = max(now - self._last_report, 1e-6)
+        bytes_rate = int((self.bytes - self._last_bytes) / elapsed)
+        self._last_bytes, self._last_report = self.bytes, now
+        try:
+            self.channel.send(_REPORT.pack(self.connections, bytes_rate))
+        except socket.error as e:
+            logger.debug("Unable to report load: %s", e)
+
+
+class Dispatcher(object):
+    """
+    Forks worker processes and dispatches them the connections accepted on the sockets of the added servers.
+    Like tornado.process.fork_processes, start returns the worker index in the workers while the parent
+    dispatches connections until terminated and then exits. Lost workers are respawned after respawn_delay
+    seconds and, when a list of cpus is given, workers are pinned to them round robin. The given signals are
+    forwarded to the workers.
+    """
+
+    def __init__(self, policy=least_connections, report_interval=REPORT_INTERVAL, cpus=None,
+                 respawn_delay=RESPAWN_DELAY, signals=()):
+        if not hasattr(socket.socket, "sendmsg"):
+            raise ValueError("Dispatching connections requires Python 3.3 or later")
+        self.policy = get_policy(policy)
+        self.report_interval = report_interval
+        self.cpus = cpus
+        self.respawn_delay = respawn_delay
+        self.signals = signals
+        self.servers = []
+        self.sockets = []
+        self.workers = {}
+        self.respawning = []
+        self.stopping = False
+        self.io_loop = None
+        self._signal_handlers = {}
+
+    def add_server(self, server, sockets):
+        """
+        Accept connections on sockets on behalf of server, which gets them in the workers through handle_stream
+        """
+        self.servers.append(server)
+        self.sockets.append(sockets)
+
+    def start(self, num_processes):
+        """
+        Fork num_processes workers. Returns the worker index in the workers, never returns in the parent.
+        """
+        assert not IOLoop.initialized(), "Cannot dispatch connections after the IOLoop has been created"
+        for index in range(num_processes):
+            if self.spawn(index):
+                return index
+        self.listen()
+        while not self.stopping:
+            self.io_loop.start()
+            # workers are forked out of the running loop, which is left to the parent
+            while self.respawning:
+                index = self.respawning.pop(0)
+                if self.spawn(index):
+                    return index
+        sys.exit(0)
+
+    def spawn(self, index):
+        """
+        Fork the index-th worker. Returns True in the worker, False in the parent
+        """
+        parent_channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            parent_channel.close()
+            for worker in self.workers.values():
+                worker.channel.close()
+            for sockets in self.sockets:
+                for sock in sockets:
+                    sock.close()
+            if self.io_loop is not None:
+                IOLoop.clear_current()
+                for signum, handler in self._signal_handlers.items():
+                    signal.signal(signum, handler)
+            pin_to_cpu(self.cpus, index)
+            Worker(self.servers, worker_channel, report_interval=self.report_interval).start()
+            return True
+        worker_channel.close()
+        parent_channel.setblocking(0)
+        self.workers[parent_channel.fileno()] = WorkerHandle(index, pid, parent_channel)
+        if self.io_loop is not None:
+            self.io_loop.add_handler(parent_channel.fileno(), self.on_report, IOLoop.READ)
+            logger.info("Respawned worker %d [pid: %d]", index, pid)
+        return False
+
+    def listen(self):
+        """
+        Accept connections and worker reports on a loop of the parent, not installed as the IOLoop instance
+        """
+        self.io_loop = IOLoop()
+        self._signal_handlers[signal.SIGTERM] = signal.signal(
+            signal.SIGTERM, lambda *args: self.io_loop.add_callback_from_signal(self.stop))
+        for signum in self.signals:
+            self._signal_handlers[signum] = signal.signal(signum, self.forward)
+        for index, sockets in enumerate(self.sockets):
+            for sock in sockets:
+                add_accept_handler(sock, lambda connection, address, i=index: self.dispatch(i, connection),
+                                   io_loop=self.io_loop)
+        for fd in self.workers:
+            self.io_loop.add_handler(fd, self.on_report, IOLoop.READ)
+        logger.info("Dispatching connections to %d workers", len(self.workers))
+
+    def dispatch(self, index, connection):
+        """
+        Pass a connection accepted on the index-th server to the worker chosen by the policy
+        """
+        candidates = list(self.workers.values())
+        try:
+            while candidates:
+                worker = self.policy(candidates)
+                candidates.remove(worker)
+                try:
+                    send_socket(worker.channel, index, connection)
+                except socket.error as e:
+                    if e.args[0] not in (errno.EWOULDBLOCK, errno.EAGAIN):
+                        logger.error("Unable to pass connection to %s: %s", worker, e)
+                        self.remove_worker(worker)
+                    continue
+                worker.connections += 1
+                logger.debug("Connection dispatched to %s", worker)
+                return
+            logger.error("No worker available to handle connection")
+        finally:
+            connection.close()
+
+    def on_report(self, fd, events):
+        worker = self.workers.get(fd)
+        if worker is None:
+            return
+        try:
+            data = worker.channel.recv(_REPORT.size)
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            data = None
+        if not data:
+            logger.error("Lost %s", worker)
+            self.remove_worker(worker)
+        elif len(data) == _REPORT.size:
+            worker.on_report(*_REPORT.unpack(data))
+
+    def remove_worker(self, worker):
+        """
+        Stop dispatching to a worker and respawn it after respawn_delay seconds
+        """
+        fd = worker.channel.fileno()
+        if self.workers.pop(fd, None) is None:
+            return
+        self.io_loop.remove_handler(fd)
+        worker.channel.close()
+        try:
+            os.waitpid(worker.pid, os.WNOHANG)
+        except OSError:
+            pass
+        if not self.stopping:
+            self.io_loop.add_timeout(self.io_loop.time() + self.respawn_delay, lambda: self.respawn(worker.index))
+
+    def respawn(self, index):
+        if not self.stopping:
+            self.respawning.append(index)
+            self.io_loop.stop()
+
+    def forward(self, signum, frame):
+        """
+        Forward a signal to the workers
+        """
+        for worker in list(self.workers.values()):
+            try:
+                os.kill(worker.pid, signum)
+            except OSError:
+                pass
+
+    def stop(self):
+        """
+        Terminate the workers and stop dispatching
+        """
+        self.stopping = True
+        for worker in list(self.workers.values()):
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for worker in list(self.workers.values()):
+            try:
+                os.waitpid(worker.pid, 0)
+            except OSError:
+                pass
+        self.io_loop.stop()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Event loops the tunnel endpoints can run on.
+
+The endpoints are written against the tornado IOLoop interface. Besides the tornado one, they can run on an asyncio
+event loop through the tornado asyncio bridge, either the standard one or the uvloop one when uvloop is installed.
+Running on asyncio lets coroutines share the loop with the tunnel, e.g. in filters.
+
+The endpoints forward data with the callback engine by default. On Python 3.5+ the async engine, written with
+async/await on asyncio streams, can forward it instead, running on the asyncio or uvloop event loop.
+"""
+import logging
+from tornado.ioloop import IOLoop
+
+try:
+    from tornado.platform.asyncio import BaseAsyncIOLoop, AsyncIOLoop
+except ImportError:
+    BaseAsyncIOLoop = AsyncIOLoop = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    from wstunnel.aio import AsyncTunnelClient, AsyncTunnelServer
+except (ImportError, SyntaxError):
+    AsyncTunnelClient = AsyncTunnelServer = None
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+TORNADO = "tornado"
+ASYNCIO = "asyncio"
+UVLOOP = "uvloop"
+
+EVENT_LOOPS = (TORNADO, ASYNCIO, UVLOOP)
+
+CALLBACK = "callback"
+ASYNC = "async"
+
+ENGINES = (CALLBACK, ASYNC)
+
+if BaseAsyncIOLoop is not None and uvloop is not None:
+    class UVLoop(BaseAsyncIOLoop):
+        """
+        IOLoop running on a uvloop event loop
+        """
+
+        def initialize(self):
+            super(UVLoop, self).initialize(uvloop.new_event_loop(), close_loop=True)
+else:
+    UVLoop = None
+
+
+def available_event_loops():
+    """
+    Return the names of the event loops usable in this environment
+    """
+    return [name for name in EVENT_LOOPS if name == TORNADO or event_loop_class(name, strict=False)]
+
+
+def event_loop_class(name=None, strict=True):
+    """
+    Return the IOLoop class for the given event loop name. When the event loop is not available,
+    raise a ValueError or return None if not strict.
+    """
+    if name in (None, TORNADO):
+        return IOLoop.configured_class()
+    if name not in EVENT_LOOPS:
+        raise ValueError("Unknown event loop %s, expected one of %s" % (name, ", ".join(EVENT_LOOPS)))
+    clazz = AsyncIOLoop if name == ASYNCIO else UVLoop
+    if clazz is None and strict:
+        raise ValueError("Event loop %s is not available, is %s installed?" % (name, name))
+    return clazz
+
+
+def new_event_loop(name=None):
+    """
+    Create an IOLoop running on the given event loop, without making it current
+    """
+    return event_loop_class(name)()
+
+
+def configure_event_loop(name=None):
+    """
+    Make the global IOLoop run on the given event loop. Must be called before the IOLoop is created.
+    """
+    if name in (None, TORNADO):
+        return
+    if IOLoop.initialized():
+        logger.warning("IOLoop already created, unable to switch it to %s" % name)
+        return
+    IOLoop.configure(event_loop_class(name))
+    logger.info("Running on %s event loop" % name)
+
+
+def available_engines():
+    """
+    Return the names of the engines usable in this environment
+    """
+    return [CALLBACK, ASYNC] if AsyncTunnelClient is not None and AsyncIOLoop is not None else [CALLBACK]
+
+
+def configure_engine(engine=None, event_loop=None):
+    """
+    Make the global IOLoop run on the event loop of the given engine, asyncio for the async one unless uvloop is
+    asked for. Returns True when the endpoints have to run on the async engine.
+    """
+    if engine in (None, CALLBACK):
+        configure_event_loop(event_loop)
+        return False
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine %s, expected one of %s" % (engine, ", ".join(ENGINES)))
+    if engine not in available_engines():
+        raise ValueError("The async engine requires Python 3.5+ and the tornado asyncio bridge")
+    configure_event_loop(ASYNCIO if event_loop in (None, TORNADO) else event_loop)
+    return True
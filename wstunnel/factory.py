@@ -13,15 +13,27 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
 from wstunnel import join_url
 from wstunnel.client import WSTunnelClient, WebSocketProxy
+from wstunnel.engine import AsyncTunnelClient, AsyncTunnelServer, configure_engine
+from wstunnel.filters import FilterProfile
+from wstunnel.flow import DEFAULT_HIGH_WATERMARK, DEFAULT_COALESCE_BYTES, Scheduler
 from wstunnel.server import WSTunnelServer
+from wstunnel.resolver import DEFAULT_CONNECT_TIMEOUT, configure_resolver
 from wstunnel.toolbox import address_to_tuple
 
 __author__ = 'fabio'
 
+logger = logging.getLogger(__name__)
 
-def load_filter(clazz, args=None):
+# Options of the callback engine the async engine does not implement
+ASYNC_IGNORED_OPTIONS = ("multiplex", "mux_connections", "pool_min_idle", "pool_max_idle", "pool_max_age",
+                         "pool_refill_rate", "coalesce_delay", "coalesce_bytes", "compression", "scheduler",
+                         "priority", "weight", "shaping", "keep_alive", "metrics", "dispatch")
+
+
+def load_filter(clazz, args=None, kwargs=None):
     """
     Load a filter by its fully qualified class name
     """
@@ -30,7 +42,38 @@ def load_filter(clazz, args=None):
     path = clazz.split(".")
     mod = importlib.import_module(".".join(path[:-1]))
     Filter = getattr(mod, path[-1])
-    return Filter(*args) if args else Filter()
+    return Filter(*(args or ()), **(kwargs or {}))
+
+
+def create_filter(option):
+    """
+    Create the filter given by an entry of the filters option: its class name, or a dict with the class name
+    and the filter arguments
+    """
+    if isinstance(option, dict):
+        kwargs = dict(option)
+        return load_filter(kwargs.pop("class"), kwargs=kwargs)
+    return load_filter(option)
+
+
+def create_filter_profile(option):
+    """
+    Create the FilterProfile given by the filter_profile option: yes, the sampling rate or a dict of arguments
+    """
+    if not option:
+        return None
+    if isinstance(option, dict):
+        return FilterProfile(**option)
+    return FilterProfile() if option is True else FilterProfile(sample_every=option)
+
+
+def create_scheduler(option):
+    """
+    Create the Scheduler given by the scheduler option: yes or a dict of arguments
+    """
+    if not option:
+        return None
+    return Scheduler(**option) if isinstance(option, dict) else Scheduler()
 
 
 def create_ws_client_endpoint(config):
@@ -38,17 +81,39 @@ def create_ws_client_endpoint(config):
     Create a client endpoint parsing the configuration file options
     """
     ws_url = config["ws_url"]
-    srv = WSTunnelClient(ws_options=config.get("ws_options", {}))
+    configure_resolver(**config.get("resolver") or {})
+    if configure_engine(config.get("engine"), config.get("event_loop")):
+        return create_async_client_endpoint(config)
+    srv = WSTunnelClient(ws_options=config.get("ws_options", {}),
+                         filter_profile=create_filter_profile(config.get("filter_profile")))
+    reuse_port = config.get("workers", 1) > 1 and not config.get("dispatch")
+    scheduler = create_scheduler(config.get("scheduler"))
     proxies = config["proxies"]
     for resource, settings in proxies.items():
-        filters = [load_filter(clazz) for clazz in config.get("filters", [])]
+        filters = [create_filter(option) for option in settings.get("filters", config.get("filters", []))]
 
         srv.add_proxy(key=settings["port"],
                       ws_proxy=WebSocketProxy(  #address=settings.get("address", ''),
                                                 port=int(settings.get("port", 0)),
                                                 ws_url=join_url(ws_url, resource),
                                               filters=filters,
-                                              ws_options=config.get("ws_options", {})))
+                                              ws_options=config.get("ws_options", {}),
+                                              multiplex=settings.get("multiplex", False),
+                                              mux_connections=settings.get("mux_connections", 1),
+                                              pool_min_idle=settings.get("pool_min_idle", 0),
+                                              pool_max_idle=settings.get("pool_max_idle"),
+                                              pool_max_age=settings.get("pool_max_age", 60),
+                                              pool_refill_rate=settings.get("pool_refill_rate", 10),
+                                              high_watermark=settings.get("high_watermark", DEFAULT_HIGH_WATERMARK),
+                                              coalesce_delay=settings.get("coalesce_delay", 0),
+                                              coalesce_bytes=settings.get("coalesce_bytes", DEFAULT_COALESCE_BYTES),
+                                              compression=settings.get("compression"),
+                                              scheduler=scheduler,
+                                              priority=settings.get("priority"),
+                                              weight=settings.get("weight", 1),
+                                              shaping=settings.get("shaping"),
+                                              keep_alive=settings.get("keep_alive", config.get("keep_alive")),
+                                              reuse_port=reuse_port))
     return srv
 
 
@@ -57,21 +122,93 @@ def create_ws_server_endpoint(config):
     Create a server endpoint parsing the configuration file options
     """
     address, port = address_to_tuple(config["listen"])
+    configure_resolver(**config.get("resolver") or {})
+    async_engine = configure_engine(config.get("engine"), config.get("event_loop"))
 
     ssl_options = None
     if config["ssl"]:
         ssl_options = config["ssl_options"]
+    if async_engine:
+        return create_async_server_endpoint(config, address, port, ssl_options)
+
+    metrics = config.get("metrics")
+    if isinstance(metrics, dict):
+        metrics = dict(metrics)
+        if metrics.get("listen"):
+            metrics["address"], metrics["port"] = address_to_tuple(metrics.pop("listen"))
 
     srv = WSTunnelServer(port=port,
                          address=address,
-                         ssl_options=ssl_options)
+                         ssl_options=ssl_options,
+                         reuse_port=config.get("workers", 1) > 1 and not config.get("dispatch"),
+                         metrics=metrics,
+                         filter_profile=create_filter_profile(config.get("filter_profile")))
+    scheduler = create_scheduler(config.get("scheduler"))
     proxies = config["proxies"]
     for resource, settings in proxies.items():
-        filters = [load_filter(clazz) for clazz in settings.get("filters", [])]
+        filters = [create_filter(option) for option in settings.get("filters", [])]
 
         srv.add_proxy(key=resource,
                       ws_proxy={"address": address_to_tuple(settings["address"]),
-                                "filters": filters})
+                                "filters": filters,
+                                "high_watermark": settings.get("high_watermark", DEFAULT_HIGH_WATERMARK),
+                                "connect_timeout": settings.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                                "coalesce_delay": settings.get("coalesce_delay", 0),
+                                "coalesce_bytes": settings.get("coalesce_bytes", DEFAULT_COALESCE_BYTES),
+                                "compression": settings.get("compression"),
+                                "scheduler": scheduler,
+                                "priority": settings.get("priority"),
+                                "weight": settings.get("weight", 1),
+                                "shaping": settings.get("shaping"),
+                                "keep_alive": settings.get("keep_alive", config.get("keep_alive"))})
     return srv
 
 
+def warn_ignored_options(config):
+    """
+    Log the options set in the configuration or in its proxies the async engine ignores, and return them
+    """
+    ignored = set(key for key in ASYNC_IGNORED_OPTIONS if config.get(key))
+    for settings in config["proxies"].values():
+        ignored.update(key for key in ASYNC_IGNORED_OPTIONS if settings.get(key))
+    if ignored:
+        logger.warning("The async engine ignores the options %s, use engine: callback to enable them"
+                       % ", ".join(sorted(ignored)))
+    return ignored
+
+
+def create_async_client_endpoint(config):
+    """
+    Create a client endpoint running on the async engine
+    """
+    warn_ignored_options(config)
+    srv = AsyncTunnelClient(ws_options=config.get("ws_options", {}),
+                            reuse_port=config.get("workers", 1) > 1,
+                            filter_profile=create_filter_profile(config.get("filter_profile")))
+    for resource, settings in config["proxies"].items():
+        srv.add_proxy(key=settings["port"],
+                      ws_proxy={"port": int(settings.get("port", 0)),
+                                "ws_url": join_url(config["ws_url"], resource),
+                                "filters": [create_filter(option)
+                                            for option in settings.get("filters", config.get("filters", []))],
+                                "high_watermark": settings.get("high_watermark", DEFAULT_HIGH_WATERMARK)})
+    return srv
+
+
+def create_async_server_endpoint(config, address, port, ssl_options):
+    """
+    Create a server endpoint running on the async engine
+    """
+    warn_ignored_options(config)
+    srv = AsyncTunnelServer(port=port,
+                            address=address,
+                            ssl_options=ssl_options,
+                            reuse_port=config.get("workers", 1) > 1,
+                            filter_profile=create_filter_profile(config.get("filter_profile")))
+    for resource, settings in config["proxies"].items():
+        srv.add_proxy(key=resource,
+                      ws_proxy={"address": address_to_tuple(settings["address"]),
+                                "filters": [create_filter(option) for option in settings.get("filters", [])],
+                                "high_watermark": settings.get("high_watermark", DEFAULT_HIGH_WATERMARK),
+                                "connect_timeout": settings.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)})
+    return srv
@@ -16,12 +16,31 @@
 import logging
 from logging import config
 
+import collections
 import copy
+import itertools
+import mmap
+import os
+import struct
 import sys
+import threading
+import time
+import timeit
 import yaml
-from wstunnel import EnhancedRotatingFileHandler
+import zlib
+from wstunnel import EnhancedRotatingFileHandler, bytes_type
 from wstunnel.toolbox import hex_dump
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logging.handlers.RotatingFileHandler = EnhancedRotatingFileHandler
 
 __author__ = 'fabio'
@@ -36,6 +55,24 @@ class FilterException(Exception):
 
 
 class BaseFilter(object):
+    """
+    Base class for filters. Subclasses may declare how they handle data so that chunks are not copied needlessly:
+
+    * passthrough filters only inspect data: the value they return is ignored and the chunk is forwarded as is
+    * inplace filters modify data in place: they receive a bytearray and return it (or a slice of it), so a
+      single mutable copy is shared by all the consecutive in place filters of a chain
+
+    A filter instance is shared by every connection of a proxy, unless for_connection returns a per connection
+    filter, which is closed when its connection is. Encoding filters change the data carried over the WebSocket
+    (e.g. compress it): they run after the other filters on the data sent and, in reverse order, before them on the
+    received one, so that the other filters always see plain data.
+    """
+    passthrough = False
+    inplace = False
+    encoding = False
+    #: WS_TO_SOCK, SOCK_TO_WS or BOTH. When None, the directions are the methods the filter class overrides
+    direction = None
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -51,10 +88,260 @@ class BaseFilter(object):
         """
         return data
 
+    def for_connection(self, connection_id):
+        """
+        Override to return the filter handling a new connection: a per connection filter, or None when this
+        filter should skip the connection
+        """
+        return self
+
+    def close(self):
+        """
+        Override to release the resources of a per connection filter
+        """
+        pass
+
+
+def to_bytes(data):
+    """
+    Convert a chunk to bytes, without copying if it is already a bytes object
+    """
+    return data if data is None or isinstance(data, bytes_type) else bytes_type(data)
+
+
+def filter_data(filters, data, direction):
+    """
+    Run a chunk through the given filters in the WS_TO_SOCK or SOCK_TO_WS direction.
+    Prefer a FilterChain, which compiles the filters once, on hot paths.
+    """
+    pipeline = compile_filters(filters, direction)
+    return data if pipeline is None else pipeline(data)
+
+
+def acts_on(filtr, direction):
+    """
+    Tells whether the filter acts on data flowing in the given direction
+    """
+    if filtr.direction is not None:
+        return filtr.direction in (direction, BOTH)
+    name = "ws_to_socket" if direction == WS_TO_SOCK else "socket_to_ws"
+    method, base = getattr(type(filtr), name), getattr(BaseFilter, name)
+    return getattr(method, "__func__", method) is not getattr(base, "__func__", base)
+
+
+class FilterStats(object):
+    """
+    Calls, bytes and time spent by a filter in a direction. Only one call every sample_every is timed:
+    time_total is then the time of the sampled calls, estimated scales it to every call.
+    """
+    __slots__ = ("calls", "sampled", "bytes_in", "bytes_out", "time_total", "time_max")
+
+    def __init__(self):
+        self.calls = 0
+        self.sampled = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.time_total = 0.0
+        self.time_max = 0.0
+
+    @property
+    def estimated(self):
+        return self.time_total * self.calls / self.sampled if self.sampled else 0.0
+
+
+class FilterProfile(object):
+    """
+    Collects the FilterStats of the filters of the chains instrumented with it, for each proxy, filter and
+    direction. Timing one call every sample_every keeps the overhead low on busy proxies.
+    """
+
+    def __init__(self, sample_every=1):
+        self.sample_every = max(int(sample_every), 1)
+        self.stats = {}
+
+    def get(self, proxy, filtr, direction):
+        key = (proxy, filtr.__class__.__name__, "ws_to_socket" if direction == WS_TO_SOCK else "socket_to_ws")
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = FilterStats()
+        return stats
+
+    def items(self):
+        return sorted(self.stats.items(), key=lambda item: tuple(str(k) for k in item[0]))
+
+    def report(self):
+        """
+        Return a line for each filter, slowest first
+        """
+        lines = []
+        for (proxy, name, direction), stats in sorted(self.stats.items(), key=lambda item: -item[1].estimated):
+            lines.append("%s %s %s: %d calls, %d bytes in, %d bytes out, %.6fs total (estimated), %.6fs max" %
+                         (proxy, name, direction, stats.calls, stats.bytes_in, stats.bytes_out, stats.estimated,
+                          stats.time_max))
+        return lines
+
+    def instrument(self, method, passthrough, inplace, stats):
+        """
+        Wrap a filter method so that its calls are accounted in stats
+        """
+        sample_every = self.sample_every
+        timer = timeit.default_timer
+
+        def instrumented(data):
+            stats.calls += 1
+            size = 0 if data is None else len(data)
+            stats.bytes_in += size
+            if stats.calls % sample_every:
+                result = method(data=data)
+            else:
+                started = timer()
+                result = method(data=data)
+                elapsed = timer() - started
+                stats.sampled += 1
+                stats.time_total += elapsed
+                if elapsed > stats.time_max:
+                    stats.time_max = elapsed
+            if passthrough or (inplace and result is None):
+                stats.bytes_out += size
+            elif result is not None:
+                stats.bytes_out += len(result)
+            return result
+
+        return instrumented
+
+
+def compile_filters(filters, direction, profile=None, proxy=None):
+    """
+    Compile the filters acting on the given direction into a single callable taking and returning a chunk.
+    Filters run in list order, except encoding filters: they run last on SOCK_TO_WS chunks and first, in reverse
+    order, on WS_TO_SOCK ones.
+    Returns None when no filter acts on that direction, so that filtering can be skipped altogether.
+    The chunk is copied only when moving from immutable bytes to the first of a run of in place filters,
+    and back when a plain filter follows them. With a FilterProfile, each filter call is accounted to proxy.
+    """
+    acting = [filtr for filtr in filters if acts_on(filtr, direction)]
+    encoding = [filtr for filtr in acting if filtr.encoding]
+    if encoding:
+        plain = [filtr for filtr in acting if not filtr.encoding]
+        acting = encoding[::-1] + plain if direction == WS_TO_SOCK else plain + encoding
+    steps = tuple((filtr.ws_to_socket if direction == WS_TO_SOCK else filtr.socket_to_ws,
+                   filtr.passthrough,
+                   filtr.inplace) for filtr in acting)
+    if profile is not None:
+        steps = tuple((profile.instrument(method, passthrough, inplace, profile.get(proxy, filtr, direction)),
+                       passthrough, inplace) for filtr, (method, passthrough, inplace) in zip(acting, steps))
+    if not steps:
+        return None
+    if len(steps) == 1 and not steps[0][1] and not steps[0][2]:
+        method = steps[0][0]
+        return lambda data: method(data=to_bytes(data))
+
+    def pipeline(data):
+        for method, passthrough, inplace in steps:
+            if passthrough:
+                method(data=data)
+            elif inplace:
+                if data is not None and not isinstance(data, bytearray):
+                    data = bytearray(data)
+                result = method(data=data)
+                data = data if result is None else result
+            else:
+                data = method(data=to_bytes(data))
+        return data
+
+    return pipeline
+
+
+class FilterChain(list):
+    """
+    A list of filters compiled into one callable for each direction, available as ws_to_socket and socket_to_ws
+    attributes (None when no filter acts on that direction). The chain is recompiled by append, insert, extend
+    and remove; call compile after any other change to the list.
+    """
+
+    def __init__(self, filters=()):
+        super(FilterChain, self).__init__(filters)
+        self.profile = None
+        self.proxy = None
+        self.shared = None
+        self.compile()
+
+    def compile(self):
+        self.ws_to_socket = compile_filters(self, WS_TO_SOCK, self.profile, self.proxy)
+        self.socket_to_ws = compile_filters(self, SOCK_TO_WS, self.profile, self.proxy)
+
+    def instrument(self, profile, proxy):
+        """
+        Account the filter calls of this chain to the given proxy of a FilterProfile
+        """
+        self.profile = profile
+        self.proxy = proxy
+        self.compile()
+
+    def for_connection(self, connection_id=None):
+        """
+        Return the chain a new connection goes through: this one, unless some filter has a per connection filter
+        or skips the connection. Per connection chains do not follow later changes to this one.
+        """
+        connection_id = next(_connection_ids) if connection_id is None else connection_id
+        filters = [filtr.for_connection(connection_id) for filtr in self]
+        if all(own is filtr for own, filtr in zip(filters, self)):
+            return self
+        chain = FilterChain([filtr for filtr in filters if filtr is not None])
+        chain.shared = self
+        if self.profile is not None:
+            chain.instrument(self.profile, self.proxy)
+        return chain
+
+    def close(self):
+        """
+        Close the per connection filters of the chain, once its connection is closed
+        """
+        if self.shared is not None:
+            for filtr in self:
+                if not any(filtr is shared for shared in self.shared):
+                    filtr.close()
+            self.shared = None
+
+    def append(self, filtr):
+        super(FilterChain, self).append(filtr)
+        self.compile()
+
+    def insert(self, index, filtr):
+        super(FilterChain, self).insert(index, filtr)
+        self.compile()
+
+    def extend(self, filters):
+        super(FilterChain, self).extend(filters)
+        self.compile()
+
+    def remove(self, filtr):
+        super(FilterChain, self).remove(filtr)
+        self.compile()
+
+
+_connection_ids = itertools.count(1)
+
+
+def filter_chain(filters):
+    """
+    Return the given filters as a FilterChain, wrapping them only if needed
+    """
+    return filters if isinstance(filters, FilterChain) else FilterChain(filters or ())
+
+
+DROP = "drop"
+SAMPLE = "sample"
+BLOCK = "block"
+DUMP_QUEUE_SIZE = 1024
+
 
 class DumpFilter(BaseFilter):
     """
-    Dump data on the given filepath or stdout
+    Dump data on the given filepath or stdout.
+    Chunks are queued and dumped by a background thread, so that a slow disk never stalls forwarding. When the
+    queue is full, the policy tells whether chunks are dropped, blocked on or, with sample, only one every
+    sample_every is kept once the queue is half full. Dropped chunks are counted in dropped.
     """
     default_conf = {
         "version": 1,
@@ -82,8 +369,13 @@ class DumpFilter(BaseFilter):
             }
         }
     }
+    passthrough = True
+    policy = DROP
+    queue_size = DUMP_QUEUE_SIZE
+    sample_every = 10
 
-    def __init__(self, handler=None, fmt=None, conf_file=None, **kwargs):
+    def __init__(self, handler=None, fmt=None, conf_file=None, policy=None, queue_size=None, sample_every=None,
+                 **kwargs):
         super(DumpFilter, self).__init__()
 
         if conf_file:
@@ -98,19 +390,483 @@ class DumpFilter(BaseFilter):
 
         logging.config.dictConfig(conf)
         self.logger = logging.getLogger(__name__)
+        self.policy = policy or self.policy
+        if self.policy not in (DROP, SAMPLE, BLOCK):
+            raise ValueError("Unknown dump policy %s, expected one of drop, sample or block" % self.policy)
+        self.queue = queue.Queue(queue_size or self.queue_size)
+        self.sample_every = sample_every or self.sample_every
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self._skipped = 0
+        self._thread = None
+        self._pid = None
 
     def ws_to_socket(self, data, **kwargs):
-        try:
-            self.logger.info("[-->] From WebSocket endpoint\n{}".format(hex_dump(data)))
-        except Exception as e:
-            #Ignore errors... DumpFilter should not interpose the protocol flow
-            sys.stderr.write("Unable to log filter dump: %s" % str(e))
+        self.enqueue("[-->] From WebSocket endpoint", data)
         return data
 
     def socket_to_ws(self, data, **kwargs):
+        self.enqueue("[<--] To WebSocket endpoint", data)
+        return data
+
+    def enqueue(self, header, data):
+        """
+        Queue a chunk to be dumped, applying the policy when the queue is full
+        """
+        if data is None:
+            return
+        if self._thread is None or self._pid != os.getpid():
+            self.start()
+        if self.policy == SAMPLE and self.queue.qsize() * 2 >= self.queue.maxsize:
+            self._skipped += 1
+            if self._skipped % self.sample_every:
+                self.dropped += 1
+                return
+        # Chunks may be bytearrays modified in place by the following filters
+        chunk = (header, data if isinstance(data, bytes_type) else bytes_type(data))
+        try:
+            self.queue.put(chunk, block=self.policy == BLOCK)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """
+        Start the thread dumping the queued chunks, in the current process
+        """
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self.run, name="DumpFilter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    return
+                self.dump(*chunk)
+            finally:
+                self.queue.task_done()
+
+    def dump(self, header, data):
         try:
-            self.logger.info("[<--] To WebSocket endpoint\n{}".format(hex_dump(data)))
+            self.logger.info("{}\n{}".format(header, hex_dump(data)))
+            self.written += 1
         except Exception as e:
             #Ignore errors... DumpFilter should not interpose the protocol flow
             sys.stderr.write("Unable to log filter dump: %s" % str(e))
+
+    def flush(self):
+        """
+        Wait until every queued chunk has been dumped
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        """
+        Dump the queued chunks and stop the thread
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.put(None)
+            self._thread.join()
+        self._thread = None
+        if self.dropped:
+            self.logger.warning("%d chunks were not dumped" % self.dropped)
+
+
+CAPTURE_MAGIC = b"WSTCAP01"
+CAPTURE_PATH = "logs/capture-{pid}.ring"
+CAPTURE_CAPACITY = 64 * 1024 * 1024
+
+# magic, capacity, head, tail and number of records
+_CAPTURE_HEADER = struct.Struct("!8sQQQQ")
+# timestamp, connection id, direction, captured and original length
+_CAPTURE_RECORD = struct.Struct("!dIBII")
+_WRAP = 0xff
+
+CaptureRecord = collections.namedtuple("CaptureRecord", "timestamp connection_id direction payload length")
+
+
+def _iter_records(buff, capacity, tail, count):
+    position = tail
+    while count:
+        if capacity - position < _CAPTURE_RECORD.size:
+            position = 0
+            continue
+        timestamp, connection_id, direction, size, length = _CAPTURE_RECORD.unpack_from(
+            buff, _CAPTURE_HEADER.size + position)
+        if direction == _WRAP:
+            if not position:
+                raise ValueError("Corrupted capture ring")
+            position = 0
+            continue
+        start = _CAPTURE_HEADER.size + position + _CAPTURE_RECORD.size
+        yield CaptureRecord(timestamp, connection_id, direction, buff[start:start + size], length)
+        position += _CAPTURE_RECORD.size + size
+        count -= 1
+
+
+class CaptureRing(object):
+    """
+    Capture records in a fixed size ring, memory mapped from a file. When full, the oldest records are
+    overwritten. Records never wrap around the end of the ring: a marker sends readers back to its start.
+    The file is locked, where fcntl is available, so a ring already open in another process is refused.
+    """
+
+    def __init__(self, path, capacity=CAPTURE_CAPACITY):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = _CAPTURE_HEADER.size + capacity
+        exists = os.path.exists(path) and os.path.getsize(path) == size
+        self.path = path
+        self.capacity = capacity
+        self.file = open(path, "r+b" if exists else "w+b")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                self.file.close()
+                raise FilterException("Capture ring %s is open in another process" % path)
+        if not exists:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        magic, capacity, self.head, self.tail, self.count = _CAPTURE_HEADER.unpack_from(self.map)
+        if magic != CAPTURE_MAGIC or capacity != self.capacity:
+            self.head = self.tail = self.count = 0
+            self._sync()
+
+    def _sync(self):
+        _CAPTURE_HEADER.pack_into(self.map, 0, CAPTURE_MAGIC, self.capacity, self.head, self.tail, self.count)
+
+    def _drop_oldest(self):
+        direction, size = _CAPTURE_RECORD.unpack_from(self.map, _CAPTURE_HEADER.size + self.tail)[2:4]
+        if direction == _WRAP:
+            self.tail = 0
+            return
+        self.tail += _CAPTURE_RECORD.size + size
+        self.count -= 1
+        if not self.count:
+            self.tail = self.head
+        elif self.capacity - self.tail < _CAPTURE_RECORD.size:
+            self.tail = 0
+
+    def write(self, connection_id, direction, data, length=None):
+        """
+        Append a record of data, the first bytes of a chunk of length bytes, dropping the oldest records if needed
+        """
+        length = len(data) if length is None else length
+        data = data[:self.capacity - _CAPTURE_RECORD.size]
+        size = _CAPTURE_RECORD.size + len(data)
+        if self.head + size > self.capacity:
+            while self.count and self.tail >= self.head:
+                self._drop_oldest()
+            if self.capacity - self.head >= _CAPTURE_RECORD.size:
+                _CAPTURE_RECORD.pack_into(self.map, _CAPTURE_HEADER.size + self.head, 0, 0, _WRAP, 0, 0)
+            self.head = 0
+            if not self.count:
+                self.tail = 0
+        while self.count and self.head <= self.tail < self.head + size:
+            self._drop_oldest()
+        position = _CAPTURE_HEADER.size + self.head
+        _CAPTURE_RECORD.pack_into(self.map, position, time.time(), connection_id, direction, len(data), length)
+        self.map[position + _CAPTURE_RECORD.size:position + size] = data
+        self.head += size
+        self.count += 1
+        self._sync()
+
+    def records(self):
+        """
+        Return the records in the ring, oldest first
+        """
+        return _iter_records(self.map, self.capacity, self.tail, self.count)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def read_capture(path):
+    """
+    Return the records of a capture ring file, oldest first
+    """
+    with open(path, "rb") as f:
+        buff = f.read()
+    magic, capacity, head, tail, count = _CAPTURE_HEADER.unpack_from(buff)
+    if magic != CAPTURE_MAGIC:
+        raise ValueError("%s is not a capture ring" % path)
+    return list(_iter_records(buff, capacity, tail, count))
+
+
+_PCAP_HEADER = struct.Struct("<IHHiIII")
+_PCAP_RECORD = struct.Struct("<IIII")
+_IPV4 = struct.Struct("!BBHHHBBH4s4s")
+_TCP = struct.Struct("!HHIIBBHHH")
+_PCAP_SEGMENT = 65535 - _IPV4.size - _TCP.size
+# LINKTYPE_RAW, packets start with the IP header
+_LINKTYPE_RAW = 101
+_TUNNEL_ADDRESS = b"\x0a\x00\x00\x01"
+_SERVICE_ADDRESS = b"\x0a\x00\x00\x02"
+_SERVICE_PORT = 80
+
+
+def _ip_checksum(header):
+    words = struct.unpack("!%dH" % (len(header) // 2), header)
+    total = sum(words)
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def export_pcap(path, output):
+    """
+    Export a capture ring file as a pcap file. Each connection is shown as a TCP stream between 10.0.0.1, on a port
+    derived from the connection id, and 10.0.0.2:80, the mapped service. Bytes beyond the per connection cap show
+    as gaps in the sequence numbers.
+    """
+    sequences = {}
+    with open(output, "wb") as f:
+        f.write(_PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, _LINKTYPE_RAW))
+        for record in read_capture(path):
+            port = 1024 + record.connection_id % 64511
+            if record.direction == WS_TO_SOCK:
+                source, destination = (_TUNNEL_ADDRESS, port), (_SERVICE_ADDRESS, _SERVICE_PORT)
+            else:
+                source, destination = (_SERVICE_ADDRESS, _SERVICE_PORT), (_TUNNEL_ADDRESS, port)
+            key = (record.connection_id, record.direction)
+            seq = sequences.get(key, 1)
+            ack = sequences.get((record.connection_id, 1 - record.direction), 1)
+            seconds, fraction = divmod(record.timestamp, 1)
+            for offset in range(0, len(record.payload), _PCAP_SEGMENT):
+                segment = record.payload[offset:offset + _PCAP_SEGMENT]
+                total = _IPV4.size + _TCP.size + len(segment)
+                ip = _IPV4.pack(0x45, 0, total, 0, 0x4000, 64, 6, 0, source[0], destination[0])
+                ip = ip[:10] + struct.pack("!H", _ip_checksum(ip)) + ip[12:]
+                # PSH + ACK, the TCP checksum is left to 0
+                tcp = _TCP.pack(source[1], destination[1], (seq + offset) & 0xffffffff, ack & 0xffffffff,
+                                _TCP.size << 2, 0x18, 65535, 0, 0)
+                f.write(_PCAP_RECORD.pack(int(seconds), int(fraction * 1000000), total, total))
+                f.write(ip + tcp + bytes_type(segment))
+            sequences[key] = seq + record.length
+
+
+class CaptureFilter(BaseFilter):
+    """
+    Capture chunks as timestamped binary records into a memory mapped ring file: writes are plain copies and the
+    file never grows beyond capacity. Only one connection every sample_every is captured, each one up to max_bytes.
+    The path contains {pid} by default, as each worker process needs a ring of its own: when a ring is open in
+    another process, nothing is captured in this one. Use export_pcap to analyze a capture.
+    """
+    passthrough = True
+
+    def __init__(self, path=CAPTURE_PATH, capacity=CAPTURE_CAPACITY, max_bytes=None, sample_every=1, **kwargs):
+        super(CaptureFilter, self).__init__()
+        self.path = path
+        self.capacity = int(capacity)
+        self.max_bytes = max_bytes
+        self.sample_every = max(int(sample_every), 1)
+        self.connections = 0
+        self._ring = None
+        self._pid = None
+
+    @property
+    def ring(self):
+        """
+        The ring of the current process, opened on first use, or None when it is open in another process
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            try:
+                self._ring = CaptureRing(self.path.format(pid=self._pid), self.capacity)
+            except FilterException as e:
+                self._ring = None
+                logging.getLogger(__name__).error("%s, nothing is captured by process %d", e, self._pid)
+        return self._ring
+
+    def for_connection(self, connection_id):
+        self.connections += 1
+        if (self.connections - 1) % self.sample_every:
+            return None
+        return ConnectionCapture(self, connection_id)
+
+    def ws_to_socket(self, data):
+        ring = self.ring
+        if data and ring is not None:
+            ring.write(0, WS_TO_SOCK, data)
+        return data
+
+    def socket_to_ws(self, data):
+        ring = self.ring
+        if data and ring is not None:
+            ring.write(0, SOCK_TO_WS, data)
         return data
+
+
+class ConnectionCapture(BaseFilter):
+    """
+    Captures the chunks of a connection, up to the byte cap of its CaptureFilter
+    """
+    passthrough = True
+
+    def __init__(self, capture, connection_id):
+        super(ConnectionCapture, self).__init__()
+        self.capture = capture
+        self.connection_id = connection_id
+        self.remaining = capture.max_bytes
+
+    def write(self, direction, data):
+        ring = self.capture.ring
+        if not data or ring is None:
+            return
+        if self.remaining is None:
+            ring.write(self.connection_id, direction, data)
+        elif self.remaining > 0:
+            captured = memoryview(data)[:self.remaining]
+            ring.write(self.connection_id, direction, captured, len(data))
+            self.remaining -= len(captured)
+
+    def ws_to_socket(self, data):
+        self.write(WS_TO_SOCK, data)
+        return data
+
+    def socket_to_ws(self, data):
+        self.write(SOCK_TO_WS, data)
+        return data
+
+
+ZDICT_SIZE = 32 * 1024
+ZLIB_MAX_SIZE = 10 * 1024 * 1024
+ZDICT_SEGMENT = 16
+
+
+def train_zdict(samples, size=ZDICT_SIZE, segment=ZDICT_SEGMENT):
+    """
+    Build a preset dictionary for ZlibFilter out of sample chunks, e.g. the payloads of a capture.
+    The dictionary is made of the segment bytes long strings found in most samples, the most common last since
+    zlib encodes closer matches in fewer bits.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        sample = bytes_type(sample)
+        counts.update(set(sample[i:i + segment] for i in range(len(sample) - segment + 1)))
+    chosen = []
+    length = 0
+    for string, count in counts.most_common():
+        if count < 2 or length >= size:
+            break
+        before = sum(map(len, chosen))
+        _merge_segment(chosen, string, segment // 2)
+        length += sum(map(len, chosen)) - before
+    return b"".join(reversed(chosen))[-size:]
+
+
+def _merge_segment(chosen, string, min_overlap):
+    """
+    Add string to the chosen strings, extending the one it overlaps by at least min_overlap bytes if any
+    """
+    for i, other in enumerate(chosen):
+        if string in other:
+            return
+        for overlap in range(len(string) - 1, min_overlap - 1, -1):
+            if other.endswith(string[:overlap]):
+                chosen[i] = other + string[overlap:]
+                return
+            if other.startswith(string[-overlap:]):
+                chosen[i] = string[:-overlap] + other
+                return
+    chosen.append(string)
+
+
+class ZlibFilter(BaseFilter):
+    """
+    Deflate the data sent over the WebSocket and inflate the received one, keeping a zlib stream for each
+    connection and direction so that chunks compress against the history of their connection. Install it on
+    both endpoints with the same options, anywhere in the chains as it is an encoding filter. A preset dictionary
+    (zdict bytes or a zdict_file, see train_zdict) primes every stream, helping the small messages of chatty protocols.
+    Chunks are sync flushed, so they can be split or merged in transit without breaking the stream. Received chunks
+    inflating to more than max_size bytes are rejected.
+    """
+    encoding = True
+
+    def __init__(self, level=6, window_bits=15, mem_level=8, zdict=None, zdict_file=None, max_size=ZLIB_MAX_SIZE,
+                 **kwargs):
+        super(ZlibFilter, self).__init__()
+        if zdict_file is not None:
+            with open(zdict_file, "rb") as f:
+                zdict = f.read()
+        if zdict and sys.version_info < (3, 3):
+            raise FilterException("Preset dictionaries need Python 3.3 or later")
+        self.level = level
+        self.window_bits = min(max(window_bits, 9), 15)
+        self.mem_level = mem_level
+        self.zdict = zdict or None
+        self.max_size = int(max_size)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def ratio(self):
+        return float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0
+
+    def compressor(self):
+        options = {"zdict": self.zdict} if self.zdict else {}
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.window_bits, self.mem_level,
+                                zlib.Z_DEFAULT_STRATEGY, **options)
+
+    def decompressor(self):
+        options = {"zdict": self.zdict} if self.zdict else {}
+        return zlib.decompressobj(-self.window_bits, **options)
+
+    def for_connection(self, connection_id):
+        return ZlibConnection(self)
+
+    def compress(self, compressor, data):
+        if data is None:
+            return data
+        payload = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_in += len(data)
+        self.bytes_out += len(payload)
+        return payload
+
+    def decompress(self, decompressor, data):
+        # None tells the WebSocket got closed
+        if data is None:
+            return data
+        try:
+            data = decompressor.decompress(data, self.max_size)
+        except zlib.error as e:
+            raise FilterException("Malformed compressed chunk: %s" % e)
+        if decompressor.unconsumed_tail:
+            raise FilterException("Compressed chunk inflating over %d bytes" % self.max_size)
+        return data
+
+    def ws_to_socket(self, data):
+        return self.decompress(self.decompressor(), data)
+
+    def socket_to_ws(self, data):
+        return self.compress(self.compressor(), data)
+
+
+class ZlibConnection(BaseFilter):
+    """
+    The zlib streams of a connection, accounting the compression ratio to its ZlibFilter
+    """
+    encoding = True
+
+    def __init__(self, zlib_filter):
+        super(ZlibConnection, self).__init__()
+        self.zlib_filter = zlib_filter
+        self._compressor = zlib_filter.compressor()
+        self._decompressor = zlib_filter.decompressor()
+
+    def ws_to_socket(self, data):
+        return self.zlib_filter.decompress(self._decompressor, data)
+
+    def socket_to_ws(self, data):
+        return self.zlib_filter.compress(self._compressor, data)
+
+    def close(self):
+        self._compressor = self._decompressor = None
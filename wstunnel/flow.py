@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import logging
+from tornado.iostream import StreamClosedError
+from wstunnel.compat import on_write_flushed, pause_reading, resume_reading, write_buffer_size
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+DEFAULT_COALESCE_BYTES = 16 * 1024
+DEFAULT_QUANTUM = 16 * 1024
+DEFAULT_TURN_BYTES = 64 * 1024
+
+INTERACTIVE = "interactive"
+DEFAULT = "default"
+BULK = "bulk"
+# Priority classes, lower levels are served first
+PRIORITY_CLASSES = {INTERACTIVE: 0, DEFAULT: 1, BULK: 2}
+
+_SCHEDULED = "scheduled"
+_SHAPED = "shaped"
+
+WS_TO_SOCKET = "ws_to_socket"
+SOCKET_TO_WS = "socket_to_ws"
+
+
+class BackPressure(object):
+    """
+    Stops reading from a source stream once the write buffer of the sink stream, where data read from the source
+    ends up, grows over the high watermark. Reading is resumed as soon as the sink reports the buffer flushed.
+    A high watermark of 0 disables the throttling.
+    """
+
+    def __init__(self, source, sink, high_watermark=DEFAULT_HIGH_WATERMARK):
+        self.source = source
+        self.sink = sink
+        self.high_watermark = high_watermark
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self._paused_at = None
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    def check(self):
+        """
+        Call after each write on the sink: pauses the source if the sink buffer went over the high watermark
+        """
+        if self.high_watermark and not self.paused and write_buffer_size(self.sink) > self.high_watermark:
+            pause_reading(self.source)
+            self.throttled += 1
+            self._paused_at = self.sink.io_loop.time()
+            logger.debug("Throttling reads, %d bytes waiting to be written", write_buffer_size(self.sink))
+            on_write_flushed(self.sink, self.resume)
+
+    def resume(self):
+        if self.paused:
+            self.throttled_time += self.sink.io_loop.time() - self._paused_at
+            self._paused_at = None
+            resume_reading(self.source)
+
+
+class Coalescer(object):
+    """
+    Gathers small chunks into a single write. A chunk arriving after an idle period longer than max_delay is written
+    at once, so sporadic interactive traffic is never delayed. Chunks following each other closer than that are
+    gathered until max_bytes are pending or the first of them has waited max_delay seconds.
+    Timer resolution of the IOLoop poller (usually a millisecond) bounds how short max_delay can be.
+    """
+
+    def __init__(self, write, io_loop, max_delay=0.0005, max_bytes=DEFAULT_COALESCE_BYTES):
+        self._write = write
+        self.io_loop = io_loop
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.chunks = 0
+        self.writes = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self._pending = []
+        self._pending_size = 0
+        self._first_at = None
+        self._last_write_at = 0
+        self._timeout = None
+
+    @property
+    def frames_saved(self):
+        return self.chunks - len(self._pending) - self.writes
+
+    def write(self, data):
+        self.chunks += 1
+        now = self.io_loop.time()
+        if not self._pending and (len(data) >= self.max_bytes or now - self._last_write_at > self.max_delay):
+            self.writes += 1
+            self._last_write_at = now
+            self._write(data)
+            return
+        if not self._pending:
+            self._first_at = now
+            self._timeout = self.io_loop.add_timeout(now + self.max_delay, self.close)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pending chunks, if any
+        """
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._pending:
+            return
+        now = self.io_loop.time()
+        delay = now - self._first_at
+        self.delay_total += delay
+        self.delay_max = max(self.delay_max, delay)
+        data = self._pending[0] if len(self._pending) == 1 else b"".join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self.writes += 1
+        self._last_write_at = now
+        self._write(data)
+
+    def close(self):
+        """
+        Write the pending chunks, dropping them if the stream has been closed in the meanwhile
+        """
+        try:
+            self.flush()
+        except StreamClosedError:
+            logger.debug("Dropping coalesced data, stream closed")
+
+
+def priority_level(priority):
+    """
+    Return the level of a priority class given by name or level, lower levels being served first
+    """
+    if priority is None:
+        return PRIORITY_CLASSES[DEFAULT]
+    if priority in PRIORITY_CLASSES:
+        return PRIORITY_CLASSES[priority]
+    try:
+        return int(priority)
+    except (TypeError, ValueError):
+        raise ValueError("Unknown priority class %r, use one of %s or a level" %
+                         (priority, ", ".join(sorted(PRIORITY_CLASSES, key=PRIORITY_CLASSES.get))))
+
+
+class Scheduler(object):
+    """
+    Shares the IOLoop among the connections of every proxy. A connection forwards at once the chunks up to its
+    quantum (quantum bytes times its weight) while no connection of a higher class is waiting; bigger chunks and
+    the following ones are queued and reads from the connection are paused. Once per IOLoop turn, queued connections
+    are served highest class first and round robin inside a class, each one forwarding up to its quantum, until
+    turn_bytes have been forwarded. A bulk transfer thus delays an interactive chunk by at most a turn.
+    """
+
+    def __init__(self, quantum=DEFAULT_QUANTUM, turn_bytes=DEFAULT_TURN_BYTES):
+        self.quantum = quantum
+        self.turn_bytes = turn_bytes
+        self.queues = {}
+        self.turns = 0
+        self.deferred = 0
+        self._io_loop = None
+
+    def flow(self, source, forward, priority=None, weight=1, split=True):
+        """
+        Return the ScheduledFlow forwarding the chunks read from the source stream with the forward callable.
+        Chunks that must be forwarded whole, like WebSocket messages, are not split: a connection forwarding a
+        chunk bigger than its quantum skips its following turns instead.
+        """
+        return ScheduledFlow(self, source, forward, priority_level(priority), weight, split)
+
+    def waiting(self, level):
+        """
+        Tells whether connections of a class higher than level are queued
+        """
+        return any(queue for other, queue in self.queues.items() if other < level)
+
+    def enqueue(self, flow):
+        self.queues.setdefault(flow.level, collections.deque()).append(flow)
+        if self._io_loop is None:
+            self._io_loop = flow.source.io_loop
+            self._io_loop.add_callback(self.run)
+
+    def run(self):
+        """
+        Serve the queued connections for a turn
+        """
+        self._io_loop, io_loop = None, self._io_loop
+        self.turns += 1
+        budget = self.turn_bytes
+        try:
+            for level in sorted(self.queues):
+                queue = self.queues[level]
+                for _ in range(len(queue)):
+                    if budget <= 0:
+                        break
+                    flow = queue.popleft()
+                    try:
+                        budget -= flow.drain()
+                    except Exception:
+                        logger.exception("Unable to forward a scheduled chunk, closing its connection")
+                        flow.abort()
+                        continue
+                    if flow.pending:
+                        queue.append(flow)
+                    else:
+                        flow.resume()
+                if not queue:
+                    del self.queues[level]
+        finally:
+            if self.queues and self._io_loop is None:
+                self._io_loop = io_loop
+                io_loop.add_callback(self.run)
+
+
+class ScheduledFlow(object):
+    """
+    The chunks read from a stream, forwarded when the Scheduler allows
+    """
+
+    def __init__(self, scheduler, source, forward, level, weight=1, split=True):
+        self.scheduler = scheduler
+        self.source = source
+        self.forward = forward
+        self.level = level
+        self.split = split
+        self.quantum = max(int(scheduler.quantum * weight), 1)
+        self.backlog = collections.deque()
+        self.pending = 0
+        self.deficit = 0
+        self.queued = False
+        self.closed = False
+
+    def write(self, data):
+        """
+        Forward a chunk read from the source, or queue it if the connection has to wait for its turn.
+        None, telling the WebSocket has been closed, is forwarded after the queued chunks.
+        """
+        if data is None:
+            self.close()
+            self.forward(data)
+            return
+        if self.closed or not self.queued and len(data) <= self.quantum and not self.scheduler.waiting(self.level):
+            self.forward(data)
+            return
+        self.backlog.append(data)
+        self.pending += len(data)
+        self.scheduler.deferred += len(data)
+        if not self.queued:
+            self.queued = True
+            pause_reading(self.source, _SCHEDULED)
+            self.scheduler.enqueue(self)
+
+    def drain(self):
+        """
+        Forward up to the quantum of the connection, returning the bytes forwarded
+        """
+        self.deficit += self.quantum
+        sent = 0
+        while self.backlog and self.deficit > 0 and not self.closed:
+            data = self.backlog.popleft()
+            if self.split and len(data) > self.deficit:
+                self.backlog.appendleft(data[self.deficit:])
+                data = data[:self.deficit]
+            self.deficit -= len(data)
+            self.pending -= len(data)
+            sent += len(data)
+            self.forward(data)
+        if not self.backlog or self.closed:
+            self.deficit = min(self.deficit, 0)
+        return sent
+
+    def resume(self):
+        self.queued = False
+        resume_reading(self.source, _SCHEDULED)
+
+    def abort(self):
+        """
+        Drop the queued chunks and close the source, once forwarding failed
+        """
+        self.closed = True
+        self.queued = False
+        self.backlog.clear()
+        self.pending = 0
+        self.deficit = 0
+        self.source.close()
+
+    def close(self):
+        """
+        Forward the queued chunks at once, when the connection is closing
+        """
+        if self.closed:
+            return
+        self.closed = True
+        backlog, self.backlog = self.backlog, collections.deque()
+        self.pending = 0
+        try:
+            for data in backlog:
+                self.forward(data)
+        except StreamClosedError:
+            logger.debug("Dropping scheduled data, stream closed")
+
+
+class TokenBucket(object):
+    """
+    Allows rate bytes per second on average, in bursts of up to burst bytes (a second worth of rate by default).
+    Forwarded bytes are taken from the bucket, which can go in debt: consumers then wait until it refills, all
+    woken by a single timer.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self.waiters = []
+        self._updated = None
+        self._throttled_at = None
+        self._timeout = None
+        self._io_loop = None
+
+    def consume(self, size, io_loop):
+        """
+        Take size tokens, returning False when the bucket went in debt
+        """
+        now = io_loop.time()
+        if self._updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= size
+        return self.tokens >= 0
+
+    def wait(self, callback, io_loop):
+        """
+        Call back once the debt of the bucket has been paid off
+        """
+        self.waiters.append(callback)
+        if self._timeout is None:
+            self.throttled += 1
+            self._throttled_at = io_loop.time()
+            self._io_loop = io_loop
+            self._schedule()
+
+    def _schedule(self):
+        self._timeout = self._io_loop.add_timeout(self._io_loop.time() - self.tokens / self.rate, self._wake)
+
+    def _wake(self):
+        self._timeout = None
+        if not self.consume(0, self._io_loop):
+            self._schedule()
+            return
+        self.throttled_time += self._io_loop.time() - self._throttled_at
+        waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            callback()
+
+
+class Shaper(object):
+    """
+    Takes the bytes forwarded in a direction of a connection from its token buckets, pausing reads from the source
+    stream while any of them is in debt. Throttling is accounted to the metrics of the resource.
+    """
+
+    def __init__(self, source, buckets, metrics=None):
+        self.source = source
+        self.buckets = buckets
+        self.metrics = metrics
+        self.throttled = 0
+        self.throttled_time = 0.0
+        self._waiting = 0
+        self._paused_at = None
+
+    def consume(self, size):
+        """
+        Call after forwarding size bytes read from the source
+        """
+        io_loop = self.source.io_loop
+        in_debt = [bucket for bucket in self.buckets if not bucket.consume(size, io_loop)]
+        if not in_debt or self._waiting:
+            return
+        self.throttled += 1
+        self._waiting = len(in_debt)
+        self._paused_at = io_loop.time()
+        pause_reading(self.source, _SHAPED)
+        for bucket in in_debt:
+            bucket.wait(self.resume, io_loop)
+
+    def resume(self):
+        self._waiting -= 1
+        if self._waiting:
+            return
+        elapsed = self.source.io_loop.time() - self._paused_at
+        self._paused_at = None
+        self.throttled_time += elapsed
+        if self.metrics is not None:
+            self.metrics.shaping_throttled += 1
+            self.metrics.shaping_throttled_us += int(elapsed * 1000000)
+        resume_reading(self.source, _SHAPED)
+
+
+def _limits(option):
+    """
+    Return the (rate, burst) limit of each direction given by a limit option: a mapping with rate and burst
+    for both directions, or a mapping of directions to such limits
+    """
+    if not option:
+        return {}
+    if "rate" in option:
+        return {WS_TO_SOCKET: option, SOCKET_TO_WS: option}
+    unknown = set(option) - set((WS_TO_SOCKET, SOCKET_TO_WS))
+    if unknown:
+        raise ValueError("Unknown shaping directions: %s" % ", ".join(sorted(unknown)))
+    return dict((direction, limit) for direction, limit in option.items() if limit)
+
+
+class Shaping(object):
+    """
+    The bandwidth limits of a proxy: the proxy limits are shared by all its connections (in a process), the
+    connection limits apply to each connection. Limits are given for both directions, or separately for the
+    ws_to_socket and socket_to_ws ones.
+    """
+
+    def __init__(self, proxy=None, connection=None):
+        self.proxy_limits = _limits(proxy)
+        self.connection_limits = _limits(connection)
+        self.buckets = dict((direction, TokenBucket(limit["rate"], limit.get("burst")))
+                            for direction, limit in self.proxy_limits.items())
+
+    def shaper(self, direction, source, metrics=None):
+        """
+        Return the Shaper of a new connection for the given direction, None when that direction is not limited
+        """
+        buckets = [self.buckets[direction]] if direction in self.buckets else []
+        limit = self.connection_limits.get(direction)
+        if limit:
+            buckets.append(TokenBucket(limit["rate"], limit.get("burst")))
+        return Shaper(source, buckets, metrics) if buckets else None
+
+
+def shaping(option):
+    """
+    Return the Shaping given by the shaping setting of a proxy: a Shaping or a mapping of its arguments
+    """
+    return Shaping(**option) if isinstance(option, dict) else option
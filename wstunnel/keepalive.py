@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import struct
+from wstunnel.compat import is_reading_paused
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 30
+DEFAULT_TIMEOUT = 10
+# Weight of the last sample in the smoothed round trip time, as in RFC 6298
+RTT_ALPHA = 0.125
+
+PING_STRUCT = struct.Struct("!Q")
+
+
+class KeepAlive(object):
+    """
+    Pings the peer of a WebSocket after interval seconds without messages from it, calling on_timeout when no pong
+    comes back within timeout seconds. Messages mark the connection active, so no pings are sent while data flows,
+    and pings are held back while reads from the WebSocket stream are paused, as pongs could not be read anyway.
+    The round trip times of pongs are kept in rtt, the last one, rtt_min, rtt_max and srtt, the smoothed one.
+    """
+
+    def __init__(self, stream, ping, on_timeout, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT, metrics=None):
+        self.stream = stream
+        self.io_loop = stream.io_loop
+        self.ping = ping
+        self.on_timeout = on_timeout
+        self.interval = float(interval)
+        self.timeout = float(timeout)
+        self.metrics = metrics
+        self.active = False
+        self.pings = 0
+        self.pongs = 0
+        self.rtt = None
+        self.rtt_min = None
+        self.rtt_max = None
+        self.srtt = None
+        self._sequence = 0
+        self._ping_data = None
+        self._ping_at = None
+        self._timeout = None
+
+    def start(self):
+        self._schedule(self.io_loop.time() + self.interval)
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule(self, deadline):
+        self._timeout = self.io_loop.add_timeout(deadline, self._check)
+
+    def _check(self):
+        self._timeout = None
+        now = self.io_loop.time()
+        if self.active or is_reading_paused(self.stream):
+            self.active = False
+            self._ping_at = None
+            self._schedule(now + self.interval)
+        elif self._ping_at is not None:
+            logger.warning("No pong received in %.1f seconds, the peer is gone", now - self._ping_at)
+            if self.metrics is not None:
+                self.metrics.keepalive_timeouts += 1
+            self.on_timeout()
+        else:
+            self._sequence += 1
+            self._ping_data = PING_STRUCT.pack(self._sequence)
+            self._ping_at = now
+            self.pings += 1
+            self.ping(self._ping_data)
+            self._schedule(now + self.timeout)
+
+    def on_pong(self, data):
+        """
+        Record the round trip time of the pong answering the last ping
+        """
+        if self._ping_at is None or data != self._ping_data:
+            return
+        rtt = self.io_loop.time() - self._ping_at
+        self.pongs += 1
+        self.rtt = rtt
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.rtt_max = rtt if self.rtt_max is None else max(self.rtt_max, rtt)
+        self.srtt = rtt if self.srtt is None else self.srtt + RTT_ALPHA * (rtt - self.srtt)
+        self.stop()
+        self._schedule(self._ping_at + self.interval)
+        self._ping_at = None
+
+
+def keep_alive_options(option):
+    """
+    Return the KeepAlive arguments given by the keep_alive setting of a proxy: yes, the ping interval in seconds
+    or a mapping with interval and timeout
+    """
+    if not option:
+        return None
+    if isinstance(option, dict):
+        return option
+    return {} if option is True else {"interval": option}
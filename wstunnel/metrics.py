@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per resource metrics of the tunnel endpoints, exposed in the Prometheus text format.
+
+Metrics are plain attributes of a ResourceMetrics object updated in place by the handlers, so that
+the hot path only pays an integer addition. The exposition is built when metrics are scraped.
+"""
+import bisect
+import logging
+from tornado.web import RequestHandler
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# From 0.5ms to about 16s, doubling at each bucket
+LATENCY_BUCKETS = tuple(0.0005 * 2 ** i for i in range(16))
+
+
+class Histogram(object):
+    """
+    Counts observations in fixed buckets, the last one counting values above every bound
+    """
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return the (upper bound, cumulative count) pairs, ending with +Inf
+        """
+        total = 0
+        bounds = [_format_value(b) for b in self.buckets] + ["+Inf"]
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+COUNTERS = ("connections_active", "connections_total", "bytes_ws_to_socket", "bytes_socket_to_ws",
+            "handshake_failures", "connect_failures", "shaping_throttled", "shaping_throttled_us",
+            "keepalive_timeouts")
+
+# The counters measuring a current level rather than accumulating
+GAUGES = ("connections_active",)
+
+
+class ResourceMetrics(object):
+    """
+    The metrics of a proxied resource
+    """
+    __slots__ = COUNTERS + ("connect_latency",)
+
+    def __init__(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.connect_latency = Histogram()
+
+    @property
+    def shaping_throttled_seconds(self):
+        return self.shaping_throttled_us / 1000000.0
+
+
+# (name, type, help, attribute, labels)
+FAMILIES = [
+    ("wstunnel_connections_active", "gauge", "WebSocket connections currently open",
+     "connections_active", None),
+    ("wstunnel_connections_total", "counter", "WebSocket connections opened",
+     "connections_total", None),
+    ("wstunnel_bytes_total", "counter", "Bytes carried by WebSocket messages",
+     "bytes_ws_to_socket", 'direction="ws_to_socket"'),
+    ("wstunnel_bytes_total", "counter", None,
+     "bytes_socket_to_ws", 'direction="socket_to_ws"'),
+    ("wstunnel_handshake_failures_total", "counter", "WebSocket upgrades rejected",
+     "handshake_failures", None),
+    ("wstunnel_backend_connect_failures_total", "counter", "Failed connections to the mapped service",
+     "connect_failures", None),
+    ("wstunnel_shaping_throttled_total", "counter", "Times reads were paused by bandwidth limits",
+     "shaping_throttled", None),
+    ("wstunnel_shaping_throttled_seconds_total", "counter", "Time reads were paused by bandwidth limits",
+     "shaping_throttled_seconds", None),
+    ("wstunnel_keepalive_timeouts_total", "counter", "WebSocket connections closed as pongs stopped arriving",
+     "keepalive_timeouts", None),
+]
+
+LATENCY_FAMILY = ("wstunnel_backend_connect_seconds", "Time to connect to the mapped service")
+
+# (name, type, help, FilterStats attribute)
+FILTER_FAMILIES = [
+    ("wstunnel_filter_calls_total", "counter", "Filter calls", "calls"),
+    ("wstunnel_filter_bytes_in_total", "counter", "Bytes passed to filters", "bytes_in"),
+    ("wstunnel_filter_bytes_out_total", "counter", "Bytes returned by filters", "bytes_out"),
+    ("wstunnel_filter_seconds_total", "counter", "Time spent in filters, estimated from the sampled calls",
+     "estimated"),
+    ("wstunnel_filter_seconds_max", "gauge", "Longest sampled filter call", "time_max"),
+]
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class TunnelMetrics(object):
+    """
+    The metrics of every resource of a tunnel endpoint.
+    Once bound to a shared stats region, metrics are updated in the slots of a worker and read as totals.
+    """
+
+    def __init__(self):
+        self.resources = {}
+        self.region = None
+        self.filter_profile = None
+
+    def resource(self, name):
+        """
+        Return the metrics of the given resource, creating them if needed
+        """
+        metrics = self.resources.get(name)
+        if metrics is None:
+            metrics = self.resources[name] = ResourceMetrics()
+        return metrics
+
+    def bind(self, region, worker):
+        """
+        Update the metrics of every resource in the slots of the given worker of a shared stats region.
+        The gauges are reset, as a respawned worker takes over the slots left by the dead one.
+        """
+        self.region = region
+        region.reset(worker)
+        for name in region.resources:
+            self.resources[name] = region.slot(name, worker)
+
+    def items(self):
+        """
+        Return the sorted (resource, metrics) pairs, summed over the workers when shared
+        """
+        if self.region is not None:
+            return [(name, self.region.total(name)) for name in sorted(self.region.resources)]
+        return sorted(self.resources.items())
+
+    def exposition(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        items = self.items()
+        for name, kind, help_text, attribute, labels in FAMILIES:
+            if help_text is not None:
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, kind))
+            for resource, metrics in items:
+                label = 'resource="%s"' % _escape(str(resource)) + ("," + labels if labels else "")
+                lines.append("%s{%s} %s" % (name, label, _format_value(getattr(metrics, attribute))))
+        name, help_text = LATENCY_FAMILY
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s histogram" % name)
+        for resource, metrics in items:
+            label = 'resource="%s"' % _escape(str(resource))
+            histogram = metrics.connect_latency
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, label, bound, count))
+            lines.append("%s_sum{%s} %s" % (name, label, _format_value(histogram.sum)))
+            lines.append("%s_count{%s} %d" % (name, label, histogram.count))
+        if self.filter_profile is not None:
+            lines.extend(self.filter_exposition())
+        return "\n".join(lines) + "\n"
+
+    def filter_exposition(self):
+        """
+        Return the exposition lines of the filter profile
+        """
+        lines = []
+        items = self.filter_profile.items()
+        for name, kind, help_text, attribute in FILTER_FAMILIES:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for (resource, filter_name, direction), stats in items:
+                label = 'resource="%s",filter="%s",direction="%s"' % (_escape(str(resource)), _escape(filter_name),
+                                                                      direction)
+                lines.append("%s{%s} %s" % (name, label, _format_value(getattr(stats, attribute))))
+        return lines
+
+
+class MetricsHandler(RequestHandler):
+    """
+    Serves the tunnel metrics to Prometheus
+    """
+
+    def initialize(self, metrics):
+        self.metrics = metrics
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(self.metrics.exposition())
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Multiplexing of several TCP streams over a single WebSocket connection.
+
+Each WebSocket binary message carries one frame made of a 5 bytes header (frame type and channel id)
+followed by the frame payload:
+
+* OPEN   - a new channel is requested, payload is the initial flow control window
+* DATA   - payload is channel data
+* CLOSE  - the channel has been closed
+* WINDOW - payload is the number of bytes the receiver has consumed (flow control credit)
+"""
+import logging
+import struct
+from tornado.iostream import StreamClosedError
+from wstunnel.compat import pause_reading, resume_reading, is_reading_paused
+from wstunnel.exception import ChainedException
+from wstunnel.filters import FilterException, filter_chain, to_bytes
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+MUX_SUBPROTOCOL = "wstunnel-mux"
+
+OPEN = 1
+DATA = 2
+CLOSE = 3
+WINDOW = 4
+
+DEFAULT_WINDOW = 256 * 1024
+
+_HEADER = struct.Struct("!BI")
+WINDOW_STRUCT = struct.Struct("!I")
+
+
+class MultiplexException(ChainedException):
+    """
+    Exception raised when a malformed multiplexing frame is received
+    """
+
+    def __init__(self, message="Malformed multiplexing frame", *args, **kwargs):
+        super(MultiplexException, self).__init__(message, *args, **kwargs)
+
+
+def pack_frame(frame_type, channel_id, payload=b""):
+    """
+    Build a multiplexing frame
+    """
+    return _HEADER.pack(frame_type, channel_id) + payload
+
+
+def unpack_frame(message):
+    """
+    Split a multiplexing frame into a (frame type, channel id, payload) tuple
+    """
+    if message is None or len(message) < _HEADER.size:
+        raise MultiplexException()
+    frame_type, channel_id = _HEADER.unpack_from(message)
+    return frame_type, channel_id, message[_HEADER.size:]
+
+
+class Channel(object):
+    """
+    A TCP stream carried as a logical channel over a multiplexed WebSocket.
+    The stream can be attached later, once connected: data received in the meanwhile is kept until then.
+    """
+
+    def __init__(self, session, channel_id, io_stream=None, window=DEFAULT_WINDOW, filters=None):
+        self.session = session
+        self.channel_id = channel_id
+        self.io_stream = None
+        self.window = window
+        self.send_window = window
+        self.filters = filter_chain(filters).for_connection()
+        self.closed = False
+        self._credit = 0
+        self._backlog = []
+        if io_stream is not None:
+            self.attach(io_stream)
+
+    def attach(self, io_stream):
+        """
+        Bind the TCP stream, writing the data received so far
+        """
+        self.io_stream = io_stream
+        self.io_stream.set_close_callback(self.on_close)
+        backlog, self._backlog = self._backlog, []
+        for payload in backlog:
+            self.write(payload)
+        if self.closed:
+            self.filters.close()
+            self._close_when_flushed()
+
+    def start(self):
+        """
+        Start forwarding data read from the TCP stream
+        """
+        self.io_stream.read_until_close(self.on_close, streaming_callback=self.on_peer_message)
+
+    def on_peer_message(self, message):
+        """
+        On data received from the TCP stream, forward it as DATA frames consuming the send window
+        """
+        try:
+            data = message if self.filters.socket_to_ws is None else to_bytes(self.filters.socket_to_ws(message))
+            if data:
+                self.send_window -= len(data)
+                self.session.send_frame(DATA, self.channel_id, data)
+                if self.send_window <= 0:
+                    pause_reading(self.io_stream)
+        except FilterException as e:
+            logger.exception(e)
+            self.on_close()
+
+    def on_data(self, payload):
+        """
+        On a DATA frame, write its content to the TCP stream. Credit is given back once written.
+        """
+        self._credit += len(payload)
+        if self.io_stream is None:
+            self._backlog.append(payload)
+        else:
+            self.write(payload)
+
+    def write(self, payload):
+        try:
+            data = payload if self.filters.ws_to_socket is None else to_bytes(self.filters.ws_to_socket(payload))
+            if data:
+                self.io_stream.write(data, self._on_flushed)
+            else:
+                self._on_flushed()
+        except FilterException as e:
+            logger.exception(e)
+            self.on_close()
+        except StreamClosedError:
+            self.on_close()
+
+    def _on_flushed(self):
+        """
+        Give credit back to the sender. Small credits are coalesced until a quarter of the window is consumed.
+        """
+        if not self.closed and self._credit >= self.window // 4:
+            self.session.send_frame(WINDOW, self.channel_id, WINDOW_STRUCT.pack(self._credit))
+            self._credit = 0
+
+    def on_window(self, payload):
+        """
+        On a WINDOW frame, grow the send window and resume reading if it was exhausted
+        """
+        self.send_window += WINDOW_STRUCT.unpack(payload)[0]
+        if self.send_window > 0 and is_reading_paused(self.io_stream):
+            resume_reading(self.io_stream)
+
+    def on_close(self, *args, **kwargs):
+        """
+        Handles the close event from the TCP stream, notifying the peer
+        """
+        if not self.closed:
+            self.closed = True
+            self.session.send_frame(CLOSE, self.channel_id)
+            self.session.remove_channel(self.channel_id)
+            self.filters.close()
+        if self.io_stream is not None and not self.io_stream.closed():
+            self.io_stream.close()
+
+    def on_remote_close(self):
+        """
+        On a CLOSE frame, close the TCP stream once pending data has been written
+        """
+        self.closed = True
+        self.session.remove_channel(self.channel_id)
+        if self.io_stream is not None:
+            self.filters.close()
+            self._close_when_flushed()
+
+    def _close_when_flushed(self):
+        if self.io_stream.closed():
+            return
+        if self.io_stream.writing():
+            self.io_stream.write(b"", self.io_stream.close)
+        else:
+            self.io_stream.close()
+
+
+class MultiplexedSession(object):
+    """
+    The set of channels sharing a WebSocket connection. Subclasses provide the way frames are written.
+    """
+
+    def __init__(self, filters=None, window=DEFAULT_WINDOW):
+        self.filters = filter_chain(filters)
+        self.window = window
+        self.channels = {}
+
+    def write_frame(self, frame):
+        """
+        Override to write a frame over the WebSocket
+        """
+        raise NotImplementedError
+
+    def send_frame(self, frame_type, channel_id, payload=b""):
+        self.write_frame(pack_frame(frame_type, channel_id, payload))
+
+    def remove_channel(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+    def on_open(self, channel_id, payload):
+        """
+        Override to handle an OPEN frame
+        """
+        raise MultiplexException("Unexpected OPEN frame for channel %d" % channel_id)
+
+    def on_frame(self, message):
+        """
+        Dispatch a frame received from the WebSocket to its channel
+        """
+        frame_type, channel_id, payload = unpack_frame(message)
+        if frame_type == OPEN:
+            self.on_open(channel_id, payload)
+            return
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            logger.debug("Discarding frame %d for unknown channel %d", frame_type, channel_id)
+        elif frame_type == DATA:
+            channel.on_data(payload)
+        elif frame_type == WINDOW:
+            channel.on_window(payload)
+        elif frame_type == CLOSE:
+            channel.on_remote_close()
+        else:
+            raise MultiplexException("Unknown frame type %d" % frame_type)
+
+    def close(self):
+        """
+        Close every channel of this session
+        """
+        for channel in list(self.channels.values()):
+            channel.on_remote_close()
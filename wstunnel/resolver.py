@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Name resolution and dual stack connects shared by client and server endpoints.
+"""
+import collections
+import functools
+import logging
+import socket
+import sys
+import time
+from tornado.concurrent import TracebackFuture
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import Resolver, ThreadedResolver, is_valid_ip
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_SIZE = 1024
+DEFAULT_THREADS = 10
+CONNECT_DELAY = 0.25
+DEFAULT_CONNECT_TIMEOUT = 10
+
+
+def configure_resolver(ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, threads=DEFAULT_THREADS):
+    """
+    Set how long resolved names are cached, how many of them and how many threads perform lookups, installing
+    CachingResolver as the tornado resolver, which the WebSocket client connections are created with
+    """
+    CachingResolver.ttl = ttl
+    CachingResolver.max_size = max_size
+    CachingResolver.threads = threads
+    Resolver.configure(CachingResolver)
+
+
+class CachingResolver(Resolver):
+    """
+    Non blocking resolver running lookups in a thread pool. Results are cached for ttl seconds in a cache shared
+    by every instance, holding at most max_size names and evicting the least recently used first.
+    Concurrent lookups of the same name are merged.
+    """
+    ttl = DEFAULT_TTL
+    max_size = DEFAULT_MAX_SIZE
+    threads = DEFAULT_THREADS
+    _cache = collections.OrderedDict()
+    _pending = {}
+
+    def initialize(self, io_loop=None):
+        self.io_loop = io_loop or IOLoop.current()
+        self.resolver = ThreadedResolver(io_loop=self.io_loop, num_threads=self.threads)
+
+    @classmethod
+    def shared(cls, io_loop):
+        """
+        Return the resolver shared by the connects running on io_loop, creating it on first use
+        """
+        resolver = getattr(io_loop, "_caching_resolver", None)
+        if resolver is None:
+            resolver = io_loop._caching_resolver = cls(io_loop=io_loop)
+        return resolver
+
+    def close(self):
+        self.resolver.close()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        future = TracebackFuture()
+        if callback is not None:
+            self.io_loop.add_future(future, lambda f: callback(f.result()))
+        if is_valid_ip(host):
+            try:
+                future.set_result([(af, address) for af, _, _, _, address in
+                                   socket.getaddrinfo(host, port, family, socket.SOCK_STREAM, 0,
+                                                      socket.AI_NUMERICHOST)])
+            except socket.error:
+                future.set_exc_info(sys.exc_info())
+            return future
+        key = (host, port, family)
+        entry = self._cache.pop(key, None)
+        if entry is not None and entry[0] > time.time():
+            self._cache[key] = entry
+            future.set_result(entry[1])
+            return future
+        waiters = self._pending.setdefault((self.io_loop, key), [])
+        waiters.append(future)
+        if len(waiters) == 1:
+            self.io_loop.add_future(self.resolver.resolve(host, port, family),
+                                    functools.partial(self._on_resolve, key))
+        return future
+
+    def _on_resolve(self, key, lookup):
+        waiters = self._pending.pop((self.io_loop, key), [])
+        try:
+            addrinfo = lookup.result()
+        except Exception:
+            logger.debug("Unable to resolve %s:%s", key[0], key[1])
+            for future in waiters:
+                future.set_exc_info(sys.exc_info())
+            return
+        self._cache[key] = (time.time() + self.ttl, addrinfo)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        for future in waiters:
+            future.set_result(addrinfo)
+
+
+def interleave(addrinfo):
+    """
+    Order (family, address) pairs alternating address families, starting with the first returned one
+    """
+    families = collections.OrderedDict()
+    for family, address in addrinfo:
+        families.setdefault(family, collections.deque()).append((family, address))
+    ordered = []
+    while families:
+        for family in list(families):
+            ordered.append(families[family].popleft())
+            if not families[family]:
+                del families[family]
+    return ordered
+
+
+class HappyEyeballs(object):
+    """
+    Connects to the first reachable of several (family, address) pairs, alternating address families.
+    A new attempt is started every delay seconds, or as soon as the previous one fails, without cancelling
+    the pending ones (RFC 8305). The connected stream is handed to callback, the last error to errback.
+    Attempts still pending at the deadline, if given, are given up.
+    """
+
+    def __init__(self, addrinfo, create_stream, callback, errback, io_loop=None, delay=CONNECT_DELAY, deadline=None,
+                 **kwargs):
+        self.addresses = collections.deque(interleave(addrinfo))
+        self.create_stream = create_stream
+        self.callback = callback
+        self.errback = errback
+        self.io_loop = io_loop or IOLoop.current()
+        self.delay = delay
+        self.deadline = deadline
+        self.connect_options = kwargs
+        self.streams = set()
+        self.error = None
+        self.done = False
+        self._timeout = None
+        self._deadline_timeout = None
+
+    def start(self):
+        if self.deadline is not None:
+            self._deadline_timeout = self.io_loop.add_timeout(self.deadline, self.on_timeout)
+        self.try_next()
+        return self
+
+    def try_next(self):
+        """
+        Start connecting to the next address
+        """
+        self._clear_timeout()
+        if self.done or not self.addresses:
+            return
+        family, address = self.addresses.popleft()
+        try:
+            stream = self.create_stream(family)
+        except socket.error as e:
+            logger.debug("Unable to create socket for %s: %s", address, e)
+            self.error = e
+            self.on_close(None)
+            return
+        self.streams.add(stream)
+        stream.set_close_callback(functools.partial(self.on_close, stream))
+        stream.connect(address, functools.partial(self.on_connect, stream), **self.connect_options)
+        if self.addresses:
+            self._timeout = self.io_loop.add_timeout(self.io_loop.time() + self.delay, self.try_next)
+
+    def on_connect(self, stream):
+        self.done = True
+        self._clear_timeout()
+        self.streams.discard(stream)
+        self._close_streams()
+        stream.set_close_callback(None)
+        self.callback(stream)
+
+    def on_timeout(self):
+        self._deadline_timeout = None
+        if self.done:
+            return
+        self.done = True
+        self._clear_timeout()
+        self._close_streams()
+        self.errback(socket.timeout("Timed out connecting"))
+
+    def on_close(self, stream):
+        if stream is not None:
+            self.streams.discard(stream)
+            self.error = stream.error or self.error
+        if self.done:
+            return
+        if self.addresses:
+            self.try_next()
+        elif not self.streams:
+            self.done = True
+            self._clear_timeout()
+            self.errback(self.error or socket.error("Unable to connect"))
+
+    def _close_streams(self):
+        for stream in self.streams:
+            stream.set_close_callback(None)
+            stream.close()
+        self.streams.clear()
+
+    def _clear_timeout(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self.done and self._deadline_timeout is not None:
+            self.io_loop.remove_timeout(self._deadline_timeout)
+            self._deadline_timeout = None
+
+
+def connect_stream(address, callback, errback, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM, io_loop=None,
+                   timeout=DEFAULT_CONNECT_TIMEOUT):
+    """
+    Resolve a (host, port) address and connect an IOStream to it, racing its addresses.
+    The lookup and the connect fail once timeout seconds have elapsed, unless timeout is None.
+    """
+    io_loop = io_loop or IOLoop.current()
+    deadline = io_loop.time() + timeout if timeout else None
+    timed_out = []
+
+    def on_timeout():
+        timed_out.append(True)
+        errback(socket.timeout("Timed out resolving %s" % address[0]))
+
+    lookup_timeout = io_loop.add_timeout(deadline, on_timeout) if deadline is not None else None
+
+    def on_resolve(future):
+        if timed_out:
+            return
+        if lookup_timeout is not None:
+            io_loop.remove_timeout(lookup_timeout)
+        try:
+            addrinfo = future.result()
+        except Exception as e:
+            errback(e)
+            return
+        HappyEyeballs(addrinfo, lambda af: IOStream(socket.socket(af, type, 0), io_loop=io_loop),
+                      callback, errback, io_loop=io_loop, deadline=deadline).start()
+
+    io_loop.add_future(CachingResolver.shared(io_loop).resolve(address[0], address[1], family), on_resolve)
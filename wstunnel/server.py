@@ -13,20 +13,79 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import functools
 import logging
 import socket
+import time
 from tornado.httpserver import HTTPServer
-from tornado.iostream import IOStream
+from tornado.process import cpu_count, fork_processes
 from tornado.web import Application
-from tornado.websocket import WebSocketHandler
-from wstunnel.filters import FilterException
-from wstunnel.toolbox import random_free_port, tuple_to_address
+from wstunnel.compat import WebSocketHandler
+from wstunnel.compression import CompressionException, message_deflate, DEFLATE_SUBPROTOCOL, \
+    MUX_DEFLATE_SUBPROTOCOL
+from wstunnel.exception import MappedServiceNotAvailableException
+from wstunnel.filters import FilterException, filter_chain, to_bytes
+from wstunnel.flow import BackPressure, Coalescer, DEFAULT_HIGH_WATERMARK, DEFAULT_COALESCE_BYTES, SOCKET_TO_WS, \
+    WS_TO_SOCKET, shaping
+from wstunnel.keepalive import KeepAlive, keep_alive_options
+from wstunnel.metrics import MetricsHandler, ResourceMetrics, TunnelMetrics, METRICS_PATH
+from wstunnel.mux import MultiplexedSession, MultiplexException, Channel, MUX_SUBPROTOCOL, WINDOW_STRUCT
+from wstunnel.resolver import DEFAULT_CONNECT_TIMEOUT, connect_stream
+from wstunnel.stats import StatsRegion
+from wstunnel.toolbox import random_free_port, tuple_to_address, bind_sockets
 
 __author__ = 'fabio'
 
 logger = logging.getLogger(__name__)
 
 
+class MultiplexedServerSession(MultiplexedSession):
+    """
+    Fans the channels of a multiplexed WebSocket out to connections with the mapped service
+    """
+
+    def __init__(self, handler, address, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM, deflate=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, **kwargs):
+        super(MultiplexedServerSession, self).__init__(**kwargs)
+        self.handler = handler
+        self.deflate = deflate
+        self.address = address
+        self.family = family
+        self.type = type
+        self.connect_timeout = connect_timeout
+
+    def write_frame(self, frame):
+        if self.handler.ws_connection is not None:
+            message = self.deflate.compress(frame) if self.deflate else frame
+            self.handler.metrics.bytes_socket_to_ws += len(message)
+            self.handler.write_message(message, binary=True)
+
+    def on_open(self, channel_id, payload):
+        if channel_id in self.channels:
+            raise MultiplexException("Channel %d is already open" % channel_id)
+        window = WINDOW_STRUCT.unpack(payload)[0] if payload else self.window
+        channel = Channel(self, channel_id, window=window, filters=self.filters)
+        self.channels[channel_id] = channel
+        logger.info("Forwarding channel %d to server %s" % (channel_id, tuple_to_address(self.address)))
+        connect_stream(self.address,
+                       functools.partial(self.on_channel_connect, channel, time.time()),
+                       functools.partial(self.on_channel_error, channel),
+                       family=self.family,
+                       type=self.type,
+                       timeout=self.connect_timeout)
+
+    def on_channel_connect(self, channel, started, io_stream):
+        self.handler.metrics.connect_latency.observe(time.time() - started)
+        channel.attach(io_stream)
+        if not channel.closed:
+            channel.start()
+
+    def on_channel_error(self, channel, error):
+        self.handler.metrics.connect_failures += 1
+        logger.error("Closing channel %d: %s" % (channel.channel_id, MappedServiceNotAvailableException(cause=error)))
+        channel.on_close()
+
+
 class WebSocketProxyHandler(WebSocketHandler):
     """
     Proxy a websocket connection to a service listening on a given (host, port) pair
@@ -34,29 +93,174 @@ class WebSocketProxyHandler(WebSocketHandler):
 
     def initialize(self, **kwargs):
         self.remote_address = kwargs.get("address")
-        self.io_stream = IOStream(socket.socket(kwargs.get("family", socket.AF_INET),
-                                                kwargs.get("type", socket.SOCK_STREAM),
-                                                0))
-        self.filters = kwargs.get("filters", [])
+        self.family = kwargs.get("family", socket.AF_UNSPEC)
+        self.type = kwargs.get("type", socket.SOCK_STREAM)
+        self.connect_timeout = kwargs.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)
+        self.filters = filter_chain(kwargs.get("filters"))
+        self.high_watermark = kwargs.get("high_watermark", DEFAULT_HIGH_WATERMARK)
+        self.coalesce_delay = kwargs.get("coalesce_delay", 0)
+        self.coalesce_bytes = kwargs.get("coalesce_bytes", DEFAULT_COALESCE_BYTES)
+        self.compression = kwargs.get("compression")
+        self.scheduler = kwargs.get("scheduler")
+        self.priority = kwargs.get("priority")
+        self.weight = kwargs.get("weight", 1)
+        self.shaping = kwargs.get("shaping")
+        self.keep_alive = kwargs.get("keep_alive")
+        self.metrics = kwargs.get("metrics") or ResourceMetrics()
+        self.io_stream = None
+        self.mux_session = None
+        self.deflate = None
+        self.to_ws_flow = None
+        self.to_socket_flow = None
+        self.to_ws_coalescer = None
+        self.to_socket_coalescer = None
+        self.to_ws_queue = None
+        self.to_socket_queue = None
+        self.to_ws_shaper = None
+        self.to_socket_shaper = None
+        self.keep_alive_timer = None
+        self._connect_started = None
+        self._counted = False
+        self._client_closed = False
+
+    def select_subprotocol(self, subprotocols):
+        """
+        Accept the multiplexing and compression subprotocols when the client asks for them.
+        Compression is accepted only if enabled for this proxy.
+        """
+        for protocol in subprotocols:
+            compressed = protocol in (DEFLATE_SUBPROTOCOL, MUX_DEFLATE_SUBPROTOCOL)
+            if compressed and not self.compression:
+                continue
+            deflate = message_deflate(self.compression) if compressed else None
+            if protocol in (MUX_SUBPROTOCOL, MUX_DEFLATE_SUBPROTOCOL):
+                self.mux_session = MultiplexedServerSession(self, self.remote_address,
+                                                            family=self.family,
+                                                            type=self.type,
+                                                            connect_timeout=self.connect_timeout,
+                                                            filters=self.filters,
+                                                            deflate=deflate)
+                return protocol
+            if protocol == DEFLATE_SUBPROTOCOL:
+                self.deflate = deflate
+                return protocol
+        return None
+
+    def is_forwarding_request(self):
+        """
+        Tell whether the request is a valid upgrade to a WebSocket forwarding a single connection to the service
+        """
+        headers = self.request.headers
+        connection = [s.strip().lower() for s in headers.get("Connection", "").split(",")]
+        protocols = [s.strip() for s in headers.get("Sec-WebSocket-Protocol", "").split(",")]
+        return self.request.method == "GET" \
+            and headers.get("Upgrade", "").lower() == "websocket" \
+            and "upgrade" in connection \
+            and headers.get("Sec-WebSocket-Version") in ("7", "8", "13") \
+            and MUX_SUBPROTOCOL not in protocols and MUX_DEFLATE_SUBPROTOCOL not in protocols
+
+    def before_upgrade(self, callback):
+        """
+        Connect to the service before completing the WebSocket upgrade, so that a client is rejected
+        before the handshake when the service is not available
+        """
+        if not self.is_forwarding_request():
+            callback()
+            return
+        logger.info("Forwarding connection to server %s" % tuple_to_address(self.remote_address))
+        self._connect_started = time.time()
+        connect_stream(self.remote_address,
+                       functools.partial(self.on_service_connect, callback),
+                       self.on_service_not_available,
+                       family=self.family,
+                       type=self.type,
+                       timeout=self.connect_timeout)
+
+    def on_service_connect(self, callback, io_stream):
+        """
+        Complete the WebSocket upgrade once connected to the service
+        """
+        self.metrics.connect_latency.observe(time.time() - self._connect_started)
+        self.io_stream = io_stream
         self.io_stream.set_close_callback(self.on_close)
+        if self._client_closed:
+            self.io_stream.close()
+            return
+        callback()
+
+    def on_service_not_available(self, error):
+        """
+        Reject the WebSocket upgrade with 502 Bad Gateway when the service cannot be connected
+        """
+        e = MappedServiceNotAvailableException(cause=error)
+        self.metrics.connect_failures += 1
+        self.metrics.handshake_failures += 1
+        logger.error("Rejecting upgrade for %s: %s" % (tuple_to_address(self.remote_address), e))
+        if not self._client_closed:
+            self.reject(502, str(e))
+
+    def on_connection_close(self):
+        self._client_closed = True
+        super(WebSocketProxyHandler, self).on_connection_close()
 
     def open(self):
         """
-        Open the connection to the service when the WebSocket connection has been established
+        Start forwarding data when the WebSocket connection has been established
         """
-        logger.info("Forwarding connection to server %s" % tuple_to_address(self.remote_address))
-        self.io_stream.connect(self.remote_address, self.on_connect)
+        if self.mux_session:
+            logger.info("Multiplexing connections to server %s" % tuple_to_address(self.remote_address))
+        elif self.io_stream is None:
+            logger.error("No subprotocol agreed with a multiplexing client, closing")
+            self.metrics.handshake_failures += 1
+            self.close()
+            return
+        else:
+            self.on_connect()
+        self.metrics.connections_active += 1
+        self.metrics.connections_total += 1
+        self._counted = True
+        if self.keep_alive is not None:
+            self.keep_alive_timer = KeepAlive(self.stream, self.ping, self.on_keep_alive_timeout, metrics=self.metrics,
+                                              **self.keep_alive)
+            self.keep_alive_timer.start()
 
     def on_message(self, message):
         """
         On message received from WebSocket, forward data to the service
         """
+        self.metrics.bytes_ws_to_socket += len(message)
+        if self.keep_alive_timer:
+            self.keep_alive_timer.active = True
+        if self.mux_session:
+            try:
+                deflate = self.mux_session.deflate
+                self.mux_session.on_frame(deflate.decompress(message) if deflate else message)
+            except (MultiplexException, CompressionException) as e:
+                logger.exception(e)
+                self.on_close()
+            return
+        if self.to_socket_queue:
+            self.to_socket_queue.write(message)
+        else:
+            self.forward_to_socket(message)
+
+    def forward_to_socket(self, message):
+        """
+        Forward a message received from WebSocket to the service
+        """
         try:
-            data = None if message is None else bytes(message)
-            for filtr in self.filters:
-                data = filtr.ws_to_socket(data=data)
+            if self.deflate:
+                message = self.deflate.decompress(message)
+            data = message if self.filters.ws_to_socket is None else to_bytes(self.filters.ws_to_socket(message))
             if data:
-                self.io_stream.write(data)
+                if self.to_socket_coalescer:
+                    self.to_socket_coalescer.write(data)
+                else:
+                    self.io_stream.write(data)
+                if self.to_socket_flow:
+                    self.to_socket_flow.check()
+                if self.to_socket_shaper:
+                    self.to_socket_shaper.consume(len(data))
         except Exception as e:
             logger.exception(e)
             self.close()
@@ -67,45 +271,113 @@ class WebSocketProxyHandler(WebSocketHandler):
         """
         logger.info("Closing connection with peer at %s" % tuple_to_address(self.remote_address))
         logger.debug("Received args %s and %s", args, kwargs)
-        #if not self.io_stream._closed:
-        for message in args:
-            self.on_peer_message(message)
-        if not self.io_stream.closed():
-            self.io_stream.close()
+        if self._counted:
+            self.metrics.connections_active -= 1
+            self._counted = False
+        if self.mux_session:
+            self.mux_session.close()
+        elif self.io_stream:
+            #if not self.io_stream._closed:
+            if self.to_ws_queue:
+                self.to_ws_queue.close()
+                self.to_socket_queue.close()
+            # Data the service sent before closing is forwarded, unless the WebSocket is gone and the filters closed
+            if self.ws_connection is not None:
+                for message in args:
+                    self.on_peer_message(message)
+            if self.to_ws_coalescer:
+                self.to_ws_coalescer.close()
+                self.to_socket_coalescer.close()
+            self.filters.close()
+            if not self.io_stream.closed():
+                self.io_stream.close()
         self.close()
 
+    def close(self, code=None, reason=None):
+        if self.keep_alive_timer:
+            self.keep_alive_timer.stop()
+        if code is None and reason is None:
+            # tornado 3.x closes without a code nor a reason
+            super(WebSocketProxyHandler, self).close()
+        else:
+            super(WebSocketProxyHandler, self).close(code, reason)
+
+    def on_pong(self, data):
+        if self.keep_alive_timer:
+            self.keep_alive_timer.on_pong(data)
+
+    def on_keep_alive_timeout(self):
+        """
+        The client stopped answering pings: tear down the WebSocket, which closes the service connection too
+        """
+        self.stream.close()
+
     def on_connect(self):
         """
-        Callback invoked on connection with mapped service
+        Start forwarding data between the WebSocket and the mapped service
         """
         logger.info("Connection established with peer at %s" % tuple_to_address(self.remote_address))
-        self.io_stream.read_until_close(self.on_close, self.on_peer_message)
+        self.filters = self.filters.for_connection()
+        self.to_ws_flow = BackPressure(self.io_stream, self.stream, self.high_watermark)
+        self.to_socket_flow = BackPressure(self.stream, self.io_stream, self.high_watermark)
+        if self.coalesce_delay:
+            max_delay = self.coalesce_delay / 1000000.0
+            self.to_ws_coalescer = Coalescer(self.write_to_ws, self.stream.io_loop, max_delay, self.coalesce_bytes)
+            self.to_socket_coalescer = Coalescer(self.io_stream.write, self.io_stream.io_loop, max_delay,
+                                                 self.coalesce_bytes)
+        if self.shaping:
+            self.to_ws_shaper = self.shaping.shaper(SOCKET_TO_WS, self.io_stream, self.metrics)
+            self.to_socket_shaper = self.shaping.shaper(WS_TO_SOCKET, self.stream, self.metrics)
+        on_peer_message = self.on_peer_message
+        if self.scheduler:
+            self.to_ws_queue = self.scheduler.flow(self.io_stream, self.on_peer_message, self.priority, self.weight)
+            self.to_socket_queue = self.scheduler.flow(self.stream, self.forward_to_socket, self.priority,
+                                                       self.weight, split=False)
+            on_peer_message = self.to_ws_queue.write
+        self.io_stream.read_until_close(self.on_close, on_peer_message)
 
     def on_peer_message(self, message):
         """
         On message received from peer service, send back to client through WebSocket
         """
         try:
-            data = None if message is None else bytes(message)
-            for filtr in self.filters:
-                data = filtr.socket_to_ws(data=data)
+            data = message if self.filters.socket_to_ws is None else to_bytes(self.filters.socket_to_ws(message))
             if data:
-                self.write_message(data, binary=True)
+                if self.to_ws_coalescer:
+                    self.to_ws_coalescer.write(data)
+                else:
+                    self.write_to_ws(data)
+                self.to_ws_flow.check()
+                if self.to_ws_shaper:
+                    self.to_ws_shaper.consume(len(data))
         except FilterException as e:
             logger.exception(e)
             self.on_close()
 
+    def write_to_ws(self, data):
+        message = self.deflate.compress(data) if self.deflate else data
+        self.metrics.bytes_socket_to_ws += len(message)
+        self.write_message(message, binary=True)
+
 
 class WSTunnelServer(object):
     """
     WebSocket tunnel remote endpoint.
-    Handles several proxy services on different paths
+    Handles several proxy services on different paths.
+    Metrics are served when enabled, on a path of the tunnel port or on a separate port when given a dict
+    with path, port and address. Filters are profiled when given a FilterProfile.
     """
 
-    def __init__(self, port=0, address='', proxies=None, io_loop=None, ssl_options=None, **kwargs):
+    def __init__(self, port=0, address='', proxies=None, io_loop=None, ssl_options=None, reuse_port=False,
+                 metrics=None, filter_profile=None, **kwargs):
         self.port = port
         self.address = address
+        self.reuse_port = reuse_port
         self.proxies = {}
+        self.metrics = TunnelMetrics()
+        self.metrics.filter_profile = self.filter_profile = filter_profile
+        self.metrics_options = metrics if isinstance(metrics, dict) else ({} if metrics else None)
+        self.metrics_server = None
 
         self.tunnel_options = {
             "io_loop": io_loop,
@@ -127,6 +399,13 @@ class WSTunnelServer(object):
 
     def add_proxy(self, key, ws_proxy):
         logger.info("Adding {0} as proxy for {1}".format(ws_proxy, key))
+        if isinstance(ws_proxy, dict):
+            ws_proxy["filters"] = filter_chain(ws_proxy.get("filters"))
+            ws_proxy["metrics"] = self.metrics.resource(key)
+            ws_proxy["shaping"] = shaping(ws_proxy.get("shaping"))
+            ws_proxy["keep_alive"] = keep_alive_options(ws_proxy.get("keep_alive"))
+            if self.filter_profile is not None:
+                ws_proxy["filters"].instrument(self.filter_profile, key)
         self.proxies[key] = ws_proxy
 
     def remove_proxy(self, key):
@@ -144,7 +423,7 @@ class WSTunnelServer(object):
             if ws_proxy.get("filters") is not None:
                 ws_proxy.get("filters").append(filtr)
             else:
-                ws_proxy["filters"] = [filtr]
+                ws_proxy["filters"] = filter_chain([filtr])
 
     def uninstall_filter(self, filtr):
         """
@@ -158,13 +437,47 @@ class WSTunnelServer(object):
     def handlers(self):
         return [(key, WebSocketProxyHandler, ws_proxy) for key, ws_proxy in self.proxies.items()]
 
-    def start(self, num_processes=1):
+    def start(self, num_processes=1, dispatcher=None):
         logger.info("Starting {0} {1} processes".format(num_processes, self.__class__.__name__))
-        self.app = Application(self.handlers, self.app_settings)
+        handlers = self.handlers
+        metrics_sockets = []
+        if self.metrics_options is not None:
+            metrics_handler = (self.metrics_options.get("path", METRICS_PATH), MetricsHandler,
+                               {"metrics": self.metrics})
+            if self.metrics_options.get("port") is None:
+                handlers.append(metrics_handler)
+            else:
+                self.metrics_server = HTTPServer(Application([metrics_handler]),
+                                                 io_loop=self.tunnel_options["io_loop"])
+                logger.info("Serving metrics on port {}".format(self.metrics_options["port"]))
+                metrics_sockets = bind_sockets(self.metrics_options["port"],
+                                               address=self.metrics_options.get("address"),
+                                               reuse_port=self.reuse_port)
+        self.app = Application(handlers, self.app_settings)
         self.server = HTTPServer(self.app, **self.tunnel_options)
         logger.info("Binding on port {}".format(self.port))
-        self.server.bind(self.port)
-        self.server.start(num_processes)
+        sockets = bind_sockets(self.port, reuse_port=self.reuse_port)
+        workers = num_processes or cpu_count()
+        region = StatsRegion(self.proxies, workers) if workers > 1 else None
+        if dispatcher is not None:
+            dispatcher.add_server(self.server, sockets)
+            if self.metrics_server:
+                dispatcher.add_server(self.metrics_server, metrics_sockets)
+            self.bind_stats(region, dispatcher.start(workers))
+            return
+        if workers > 1:
+            self.bind_stats(region, fork_processes(workers))
+        self.server.add_sockets(sockets)
+        if self.metrics_server:
+            self.metrics_server.add_sockets(metrics_sockets)
+
+    def bind_stats(self, region, worker):
+        """
+        Make a forked worker account the metrics of its proxies in its slots of the shared stats region
+        """
+        self.metrics.bind(region, worker)
+        for key, ws_proxy in self.proxies.items():
+            ws_proxy["metrics"] = self.metrics.resource(key)
 
     def stop(self):
         pass
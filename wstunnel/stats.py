@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Fabio Falcinelli
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Statistics shared by the forked worker processes of an endpoint.
+
+A stats region is an anonymous shared memory mapping, created before forking, holding one fixed layout slot for
+each worker and resource. Each worker only writes its own slots, so no lock is needed, while any process can read
+every slot and sum them.
+"""
+import ctypes
+import logging
+import mmap
+from wstunnel.metrics import COUNTERS, GAUGES, LATENCY_BUCKETS, Histogram, ResourceMetrics
+
+__author__ = 'fabio'
+logger = logging.getLogger(__name__)
+
+
+class SharedHistogram(Histogram):
+    """
+    A latency histogram stored in a slot
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.buckets = LATENCY_BUCKETS
+        self.counts = slot.latency_counts
+
+    @property
+    def sum(self):
+        return self.slot.latency_sum
+
+    @sum.setter
+    def sum(self, value):
+        self.slot.latency_sum = value
+
+    @property
+    def count(self):
+        return self.slot.latency_count
+
+    @count.setter
+    def count(self, value):
+        self.slot.latency_count = value
+
+
+class Slot(ctypes.Structure):
+    """
+    The metrics of a resource in a worker, laid out as ResourceMetrics in shared memory
+    """
+    _fields_ = [(counter, ctypes.c_int64) for counter in COUNTERS] + [
+        ("latency_counts", ctypes.c_int64 * (len(LATENCY_BUCKETS) + 1)),
+        ("latency_sum", ctypes.c_double),
+        ("latency_count", ctypes.c_int64),
+    ]
+
+    @property
+    def connect_latency(self):
+        return SharedHistogram(self)
+
+
+class StatsRegion(object):
+    """
+    Shared memory holding a slot for each worker and resource
+    """
+
+    def __init__(self, resources, workers):
+        self.resources = list(resources)
+        self.workers = workers
+        self._index = dict((name, i) for i, name in enumerate(self.resources))
+        count = workers * len(self.resources)
+        self.mmap = mmap.mmap(-1, max(ctypes.sizeof(Slot) * count, 1))
+        array = (Slot * count).from_buffer(self.mmap)
+        self.slots = [array[i] for i in range(count)]
+
+    def slot(self, resource, worker):
+        """
+        Return the slot the given worker writes the metrics of a resource to
+        """
+        return self.slots[worker * len(self.resources) + self._index[resource]]
+
+    def reset(self, worker):
+        """
+        Zero the gauges in the slots of the given worker, keeping its counters
+        """
+        for resource in self.resources:
+            slot = self.slot(resource, worker)
+            for gauge in GAUGES:
+                setattr(slot, gauge, 0)
+
+    def total(self, resource):
+        """
+        Return the metrics of a resource summed over every worker
+        """
+        total = ResourceMetrics()
+        histogram = total.connect_latency
+        for worker in range(self.workers):
+            slot = self.slot(resource, worker)
+            for counter in COUNTERS:
+                setattr(total, counter, getattr(total, counter) + getattr(slot, counter))
+            for i, count in enumerate(slot.latency_counts):
+                histogram.counts[i] += count
+            histogram.sum += slot.latency_sum
+            histogram.count += slot.latency_count
+        return total
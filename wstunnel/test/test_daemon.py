@@ -26,7 +26,11 @@ if not sys.platform.startswith("win"):
     import yaml
     from tornado.ioloop import IOLoop
     from wstunnel.toolbox import random_free_port
-    from wstunnel.daemon import WSTunnelClientDaemon, WSTunnelServerDaemon, Daemon, wstuncltd, wstunsrvd
+    import signal
+    import tempfile
+    import time
+    from wstunnel.stats import StatsRegion
+    from wstunnel.daemon import WSTunnelClientDaemon, WSTunnelServerDaemon, Daemon, Supervisor, wstuncltd, wstunsrvd
 
     class DaemonTestCase(unittest.TestCase):
         """
@@ -197,6 +201,19 @@ if not sys.platform.startswith("win"):
             """
             self.assertTrue(os.path.exists(os.path.dirname(self.log_file)))
 
+        def test_worker_stats(self):
+            """
+            Tests a supervised worker accounts its metrics in its slots of the stats region, reset on respawn
+            """
+            self.daemon.stats_region = StatsRegion(self.daemon.stats_resources(), 2)
+            slot = self.daemon.stats_region.slot("/telnet", 1)
+            slot.connections_active, slot.connections_total = 3, 5
+            self.daemon.serve(worker=1)
+            self.assertIs(self.daemon.stats_region, self.daemon._srv.metrics.region)
+            self.assertIs(slot, self.daemon._srv.get_proxy("/telnet")["metrics"])
+            self.assertEqual(0, slot.connections_active)
+            self.assertEqual(5, slot.connections_total)
+
     class WSTunnelSSLClientDaemonTestCase(DaemonTestCase):
         """
         TestCase for the ssl client tunnel endpoint in daemon mode
@@ -241,6 +258,66 @@ if not sys.platform.startswith("win"):
             self.daemon = WSTunnelServerDaemon(self.tun_conf)
             self.daemon.hush = lambda **kwargs: 0
 
+    class SupervisorTestCase(unittest.TestCase):
+        """
+        TestCase for the supervisor of worker processes
+        """
+
+        def setUp(self):
+            self.sigterm = signal.getsignal(signal.SIGTERM)
+            fd, self.runs_file = tempfile.mkstemp()
+            os.close(fd)
+
+        def tearDown(self):
+            signal.signal(signal.SIGTERM, self.sigterm)
+            os.remove(self.runs_file)
+
+        def worker(self, index):
+            with open(self.runs_file, "a") as f:
+                f.write("%d\n" % index)
+            with open(self.runs_file) as f:
+                runs = len(f.readlines())
+            if runs < 2:
+                raise Exception("Crashed")
+            os.kill(os.getppid(), signal.SIGTERM)
+            time.sleep(60)
+
+        def signaled_worker(self, index):
+            signaled = []
+            signal.signal(signal.SIGUSR1, lambda *args: signaled.append(os.getpid()))
+            for _ in range(50):
+                if signaled:
+                    break
+                os.kill(os.getppid(), signal.SIGUSR1)
+                time.sleep(0.1)
+            with open(self.runs_file, "a") as f:
+                f.write("%s\n" % bool(signaled))
+            os.kill(os.getppid(), signal.SIGTERM)
+            time.sleep(60)
+
+        def test_forward_signals(self):
+            """
+            Tests the given signals are forwarded to the workers
+            """
+            sigusr1 = signal.getsignal(signal.SIGUSR1)
+            try:
+                Supervisor(self.signaled_worker, 1, respawn_delay=0, signals=(signal.SIGUSR1,)).run()
+            finally:
+                signal.signal(signal.SIGUSR1, sigusr1)
+            with open(self.runs_file) as f:
+                self.assertEqual(["True\n"], f.readlines())
+
+        def test_respawn_and_terminate(self):
+            """
+            Tests a crashed worker is respawned and SIGTERM is forwarded to workers
+            """
+            supervisor = Supervisor(self.worker, 1, respawn_delay=0)
+            supervisor.run()
+            with open(self.runs_file) as f:
+                self.assertEqual(["0\n", "0\n"], f.readlines())
+            self.assertTrue(supervisor.stopping)
+            self.assertEqual({}, supervisor.children)
+
     class MainTestCase(unittest.TestCase):
         """
         TestCase for the main method parsing command line arguments
@@ -13,14 +13,43 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import signal
 import socket
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from tempfile import NamedTemporaryFile
-from wstunnel.factory import load_filter
-from wstunnel.filters import DumpFilter
-from wstunnel.toolbox import address_to_tuple, tuple_to_address, hex_dump, random_free_port, get_config, printable
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.netutil import Resolver
+from tornado.testing import AsyncTestCase
+from wstunnel.benchmark import engines, micro, replay
+from wstunnel.benchmark.tunnel import SINK, TunnelBenchmark, make_payload
+from wstunnel.compat import READ_STATE, TORNADO_VERSION, is_reading_paused, on_write_flushed, pause_reading, \
+    resume_reading, write_buffer_size
+from wstunnel.compression import MessageDeflate, CompressionException, RAW
+from wstunnel.dispatcher import Dispatcher, Worker, WorkerHandle, get_policy, least_bytes, send_socket
+from wstunnel.engine import CALLBACK, TORNADO, available_engines, available_event_loops, configure_engine, \
+    event_loop_class
+from wstunnel.factory import create_filter, load_filter, warn_ignored_options
+from wstunnel.filters import DumpFilter, BaseFilter, CaptureFilter, CaptureRing, FilterChain, FilterProfile, \
+    FilterException, ZlibFilter, export_pcap, filter_data, read_capture, to_bytes, train_zdict, SOCK_TO_WS, \
+    WS_TO_SOCK, BOTH, CAPTURE_PATH
+from wstunnel.metrics import Histogram, TunnelMetrics
+from wstunnel.resolver import CachingResolver, HappyEyeballs, configure_resolver, connect_stream, interleave
+from wstunnel.stats import StatsRegion
+from wstunnel.toolbox import address_to_tuple, tuple_to_address, hex_dump, iter_hex_dump, random_free_port, \
+    get_config, printable, bind_sockets
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __author__ = 'fabio'
 DELETE_TMP = not sys.platform.startswith("win")
@@ -111,6 +140,21 @@ class ToolBoxTestCase(unittest.TestCase):
         result = "0000  ff fd 18 ff fd 1f ff fd  23 ff fd 27 ff fd 24       ........ #..'..$"
         self.assertEqual(hex_dump(data, size), result)
 
+    def test_hex_dump_buffers(self):
+        """
+        Tests bytes like buffers are dumped alike, keeping single digit hex values, and line by line when streamed
+        """
+        data = bytes(bytearray(range(40)))
+        result = hex_dump(data)
+        self.assertTrue(result.startswith("0000  0 1 2 3 4 5 6 7  8 9 a b c d e f"))
+        self.assertEqual(result, hex_dump(bytearray(data)))
+        self.assertEqual(result, hex_dump(memoryview(data)))
+        self.assertEqual(result, hex_dump(data.decode("latin-1")))
+        lines = list(iter_hex_dump(data))
+        self.assertEqual(3, len(lines))
+        self.assertEqual(result, "\n".join(lines))
+        self.assertEqual("", hex_dump(b""))
+
     def _test_random_free_port(self, address, family, type):
         port = random_free_port(family=family, type=type)
         sock = socket.socket(family=family, type=type)
@@ -128,6 +172,20 @@ class ToolBoxTestCase(unittest.TestCase):
         """
         self._test_random_free_port("::1", socket.AF_INET6, socket.SOCK_STREAM)
 
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT not supported")
+    def test_bind_sockets_reuse_port(self):
+        """
+        Tests several sockets can listen on the same port with SO_REUSEPORT
+        """
+        port = random_free_port()
+        sockets = bind_sockets(port, "127.0.0.1", reuse_port=True) + bind_sockets(port, "127.0.0.1", reuse_port=True)
+        self.assertEqual(2, len(sockets))
+        for s in sockets:
+            self.assertEqual(port, s.getsockname()[1])
+            if fcntl is not None:
+                self.assertTrue(fcntl.fcntl(s.fileno(), fcntl.F_GETFD) & fcntl.FD_CLOEXEC)
+            s.close()
+
     def test_load_filter(self):
         """
         Test loading a filter given the fully qualified class name
@@ -136,4 +194,820 @@ class ToolBoxTestCase(unittest.TestCase):
             filter_name = "wstunnel.filters.DumpFilter"
             DumpFilter.default_conf["handlers"]["dump_file_handler"]["filename"] = dumpf.name
             f = load_filter(filter_name)
-            self.assertIsInstance(f, DumpFilter)
\ No newline at end of file
+            self.assertIsInstance(f, DumpFilter)
+
+    def test_event_loops(self):
+        """
+        Tests event loops are looked up by name
+        """
+        self.assertIn(TORNADO, available_event_loops())
+        self.assertTrue(event_loop_class(TORNADO))
+        self.assertRaises(ValueError, event_loop_class, "unknown")
+        self.assertIn(CALLBACK, available_engines())
+        self.assertFalse(configure_engine(CALLBACK))
+        self.assertRaises(ValueError, configure_engine, "unknown")
+
+    def test_async_ignored_options(self):
+        """
+        Tests the options the async engine does not implement are reported, set globally or per proxy
+        """
+        config = {"keep_alive": {"interval": 10},
+                  "proxies": {"/a": {"port": 1, "multiplex": True, "weight": 1}, "/b": {"port": 2, "shaping": None}}}
+        self.assertEqual({"keep_alive", "multiplex", "weight"}, warn_ignored_options(config))
+        self.assertFalse(warn_ignored_options({"proxies": {"/a": {"port": 1, "filters": []}}}))
+
+    def test_engines_benchmark(self):
+        """
+        Tests a short run comparing the engines on each event loop
+        """
+        results = engines.run(connections=2, volume=256 * 1024)
+        self.assertEqual(set(available_engines()), set(result["engine"] for result in results))
+        for result in results:
+            self.assertEqual(2, result["connections"])
+            self.assertGreater(result["throughput"], 0)
+
+    def test_tunnel_benchmark(self):
+        """
+        Tests a short end to end benchmark run through a tunnel to a sink service
+        """
+        self.assertEqual(b"The q", make_payload(5, "text"))
+        self.assertRaises(ValueError, make_payload, 5, "unknown")
+        results = TunnelBenchmark(concurrency=2, messages=5, connects=4, payload_size=128, backend=SINK,
+                                  timeout=10).run()
+        self.assertEqual(10, results["round_trips"])
+        self.assertEqual(0, results["errors"])
+        self.assertFalse(results["timed_out"])
+        self.assertGreater(results["connections_per_second"], 0)
+        self.assertIn("rss", results["server"])
+
+    def test_microbenchmarks(self):
+        """
+        Tests microbenchmarks are timed and compared with a baseline
+        """
+        results = micro.run(["address_to_tuple_port", "forward_to_ws"], repeat=3, warmup=0, min_time=0.001)
+        self.assertEqual(["address_to_tuple_port", "forward_to_ws", "forward_to_ws_filtered"], list(results))
+        stats = results["forward_to_ws"]
+        self.assertTrue(stats["min"] <= stats["median"] <= stats["max"])
+        baseline = {"forward_to_ws": dict(stats, median=stats["median"] / 2)}
+        rows = micro.compare(results, baseline, threshold=50)
+        self.assertEqual(1, len(rows))
+        self.assertTrue(rows[0]["regression"])
+        self.assertFalse(micro.compare(results, baseline, threshold=150)[0]["regression"])
+
+
+class UpperFilter(BaseFilter):
+    """
+    Upper case the first byte of data in place
+    """
+    inplace = True
+
+    def socket_to_ws(self, data):
+        data[0:1] = data[0:1].upper()
+
+
+class ObserverFilter(BaseFilter):
+    """
+    Records data without changing it
+    """
+    passthrough = True
+
+    def __init__(self):
+        super(ObserverFilter, self).__init__()
+        self.seen = []
+
+    def ws_to_socket(self, data):
+        self.seen.append(data)
+        return b"ignored"
+
+
+class SlowDumpFilter(DumpFilter):
+    """
+    Dumps chunks once released, recording them
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SlowDumpFilter, self).__init__(*args, **kwargs)
+        self.released = threading.Event()
+        self.dumped = []
+
+    def dump(self, header, data):
+        self.released.wait()
+        self.dumped.append(data)
+
+
+class DumpFilterTestCase(unittest.TestCase):
+    """
+    Test cases for the dump filter queue
+    """
+
+    def setUp(self):
+        self.dumpf = NamedTemporaryFile(delete=DELETE_TMP)
+
+    def tearDown(self):
+        self.dumpf.close()
+
+    def test_drop_when_full(self):
+        """
+        Tests chunks are dropped and counted while the queue is full, the others are dumped in order
+        """
+        dump = SlowDumpFilter(handler={"filename": self.dumpf.name}, queue_size=2)
+        for i in range(6):
+            self.assertEqual(b"%d" % i, dump.socket_to_ws(b"%d" % i))
+        self.assertGreaterEqual(dump.dropped, 3)
+        self.assertEqual(6, dump.queued + dump.dropped)
+        dump.released.set()
+        dump.close()
+        self.assertEqual(dump.queued, len(dump.dumped))
+        self.assertEqual(b"0", dump.dumped[0])
+
+    def test_sample_when_half_full(self):
+        """
+        Tests only one chunk every sample_every is queued once the queue is half full
+        """
+        dump = SlowDumpFilter(handler={"filename": self.dumpf.name}, policy="sample", queue_size=100,
+                              sample_every=10)
+        for i in range(100):
+            dump.ws_to_socket(b"x")
+        self.assertLess(dump.queued, 70)
+        self.assertEqual(100, dump.queued + dump.dropped)
+        dump.released.set()
+        dump.close()
+
+    def test_dump_snapshot(self):
+        """
+        Tests a chunk modified after being filtered is dumped as it was
+        """
+        dump = DumpFilter(handler={"filename": self.dumpf.name}, policy="block")
+        data = bytearray(b"Hello")
+        dump.socket_to_ws(data)
+        data[0:1] = b"J"
+        dump.flush()
+        self.assertIn(hex_dump(b"Hello"), self.dumpf.read().decode("utf-8"))
+        dump.close()
+        self.assertEqual((1, 0), (dump.written, dump.dropped))
+        self.assertRaises(ValueError, DumpFilter, handler={"filename": self.dumpf.name}, policy="unknown")
+
+
+class CaptureTestCase(unittest.TestCase):
+    """
+    Test cases for the capture ring and filter
+    """
+
+    def setUp(self):
+        self.ringf = NamedTemporaryFile(delete=False)
+        self.ringf.close()
+
+    def tearDown(self):
+        os.remove(self.ringf.name)
+
+    def test_ring_keeps_latest_records(self):
+        """
+        Tests the ring overwrites its oldest records, keeping the latest ones in order across reopening
+        """
+        ring = CaptureRing(self.ringf.name, capacity=1000)
+        written = []
+        for i in range(200):
+            payload = bytes(bytearray([i % 256])) * (i * 7 % 90)
+            ring.write(i, i % 2, payload)
+            written.append(payload)
+        records = list(ring.records())
+        self.assertEqual(written[-len(records):], [record.payload for record in records])
+        self.assertEqual(list(range(200 - len(records), 200)), [record.connection_id for record in records])
+        self.assertGreater(len(records), 10)
+        ring.close()
+        self.assertEqual(records, read_capture(self.ringf.name))
+        ring = CaptureRing(self.ringf.name, capacity=1000)
+        ring.write(200, WS_TO_SOCK, b"last")
+        self.assertEqual(b"last", list(ring.records())[-1].payload)
+        ring.close()
+
+    @unittest.skipIf(fcntl is None, "Rings are locked only where fcntl is available")
+    def test_ring_open_elsewhere(self):
+        """
+        Tests a ring already open is refused, and nothing is captured through it
+        """
+        ring = CaptureRing(self.ringf.name, capacity=1000)
+        try:
+            self.assertRaises(FilterException, CaptureRing, self.ringf.name, capacity=1000)
+            capture = CaptureFilter(self.ringf.name, capacity=1000)
+            self.assertIsNone(capture.ring)
+            self.assertEqual(b"Hello", capture.ws_to_socket(b"Hello"))
+            capture.for_connection(1).socket_to_ws(b"World")
+            self.assertEqual([], list(ring.records()))
+        finally:
+            ring.close()
+        self.assertEqual("logs/capture-{pid}.ring", CAPTURE_PATH)
+
+    def test_connection_capture(self):
+        """
+        Tests connections are sampled, capped and exported as pcap
+        """
+        capture = CaptureFilter(self.ringf.name, capacity=4096, max_bytes=6, sample_every=2)
+        chain = FilterChain([capture])
+        first, second = chain.for_connection(1), chain.for_connection(2)
+        self.assertIsNot(chain, first)
+        self.assertEqual(0, len(second))
+        self.assertEqual(b"Hello", first.ws_to_socket(b"Hello"))
+        first.socket_to_ws(b"World!")
+        first.close()
+        records = list(capture.ring.records())
+        self.assertEqual([(1, WS_TO_SOCK, b"Hello", 5), (1, SOCK_TO_WS, b"W", 6)],
+                         [(r.connection_id, r.direction, r.payload, r.length) for r in records])
+        pcap = self.ringf.name + ".pcap"
+        try:
+            export_pcap(self.ringf.name, pcap)
+            with open(pcap, "rb") as f:
+                content = f.read()
+            self.assertEqual(24 + 2 * (16 + 40) + 6, len(content))
+            self.assertTrue(content.endswith(b"W"))
+        finally:
+            os.remove(pcap)
+
+    def test_replay(self):
+        """
+        Tests captured sessions and dumps are loaded and replayed through a tunnel
+        """
+        ring = CaptureRing(self.ringf.name, capacity=65536)
+        for connection_id in (1, 2):
+            ring.write(connection_id, SOCK_TO_WS, b"GET / HTTP/1.0\r\n\r\n")
+            ring.write(connection_id, WS_TO_SOCK, b"HTTP/1.0 200 OK\r\n\r\n" + b"x" * 3000)
+        ring.close()
+        sessions = replay.load_sessions(self.ringf.name)
+        self.assertEqual([1, 2], [session.connection_id for session in sessions])
+        self.assertEqual((18, 3019), (sessions[0].size(True), sessions[0].size(False)))
+        self.assertEqual((3019, 18), (replay.load_sessions(self.ringf.name, replay.SERVER)[0].size(True),
+                                      replay.load_sessions(self.ringf.name, replay.SERVER)[0].size(False)))
+        results = replay.Replay(sessions, speed=0, copies=3, timeout=10).run()
+        self.assertEqual(6, results["completed"])
+        self.assertEqual(0, results["failed"])
+        self.assertFalse(results["timed_out"])
+        self.assertEqual(6 * (18 + 3019), results["bytes"])
+
+        with open(self.ringf.name, "w") as f:
+            f.write("[2026-10-18 10:00:00,000] wstunnel.filters - [<--] To WebSocket endpoint\n")
+            f.write("\n".join(iter_hex_dump(b"Hello, World!\x00\x01   end")) + "\n")
+            f.write("[2026-10-18 10:00:00,250] wstunnel.filters - [-->] From WebSocket endpoint\n")
+            f.write(hex_dump(b"Hi") + "\n")
+        sessions = replay.load_sessions(self.ringf.name)
+        self.assertEqual([(0.0, True, b"Hello, World!\x00\x01   end"), (0.25, False, b"Hi")],
+                         [tuple(event) for event in sessions[0].events])
+
+
+class FilterDataTestCase(unittest.TestCase):
+    """
+    Test cases for the filter chain data path
+    """
+
+    def test_no_copy_without_filters(self):
+        """
+        Tests a chunk goes through an empty or passthrough filter chain without being copied
+        """
+        data = b"Hello World"
+        observer = ObserverFilter()
+        self.assertIs(data, filter_data([], data, SOCK_TO_WS))
+        self.assertIs(data, filter_data([observer], data, WS_TO_SOCK))
+        self.assertEqual([data], observer.seen)
+
+    def test_inplace_filters_share_copy(self):
+        """
+        Tests consecutive in place filters work on the same mutable copy of the chunk
+        """
+        result = filter_data([UpperFilter(), UpperFilter()], b"hello", SOCK_TO_WS)
+        self.assertIsInstance(result, bytearray)
+        self.assertEqual(b"Hello", to_bytes(result))
+
+    def test_plain_filter_gets_bytes(self):
+        """
+        Tests a plain filter following in place ones still receives bytes
+        """
+        received = []
+
+        class PlainFilter(BaseFilter):
+            def socket_to_ws(self, data):
+                received.append(data)
+                return data
+
+        filter_data([UpperFilter(), PlainFilter()], b"hello", SOCK_TO_WS)
+        self.assertIsInstance(received[0], bytes)
+
+    def test_chain_skips_identity_direction(self):
+        """
+        Tests a compiled chain drops the filters not acting on a direction, and the direction when none does
+        """
+        chain = FilterChain([UpperFilter()])
+        self.assertIsNone(chain.ws_to_socket)
+        self.assertEqual(b"Hello", to_bytes(chain.socket_to_ws(b"hello")))
+        chain.append(BaseFilter())
+        self.assertIsNone(chain.ws_to_socket)
+        observer = ObserverFilter()
+        chain.append(observer)
+        self.assertIsNotNone(chain.ws_to_socket)
+        chain.remove(observer)
+        self.assertIsNone(chain.ws_to_socket)
+
+    def test_chain_declared_direction(self):
+        """
+        Tests a filter declaring its direction is compiled in that direction only
+        """
+        observer = ObserverFilter()
+        observer.direction = SOCK_TO_WS
+        self.assertIsNone(FilterChain([observer]).ws_to_socket)
+        observer.direction = BOTH
+        self.assertIsNotNone(FilterChain([observer]).ws_to_socket)
+
+    def test_filter_profile(self):
+        """
+        Tests an instrumented chain accounts calls and bytes for each filter, timing one call every sample_every
+        """
+        profile = FilterProfile(sample_every=2)
+        observer = ObserverFilter()
+        chain = FilterChain([observer, UpperFilter()])
+        chain.instrument(profile, "/test")
+        for _ in range(3):
+            self.assertEqual(b"Hello", to_bytes(chain.socket_to_ws(b"hello")))
+            chain.ws_to_socket(b"hi")
+        upper = profile.stats[("/test", "UpperFilter", "socket_to_ws")]
+        self.assertEqual((3, 1, 15, 15), (upper.calls, upper.sampled, upper.bytes_in, upper.bytes_out))
+        observed = profile.stats[("/test", "ObserverFilter", "ws_to_socket")]
+        self.assertEqual((3, 6, 6), (observed.calls, observed.bytes_in, observed.bytes_out))
+        self.assertEqual([b"hi"] * 3, observer.seen)
+        self.assertEqual(2, len(profile.report()))
+        self.assertAlmostEqual(upper.time_total * 3, upper.estimated)
+
+    def test_zlib_filter(self):
+        """
+        Tests chunks are deflated against the history of their connection, even when merged in transit
+        """
+        messages = [b'{"op": "get", "key": "user:%d", "fields": ["name", "email"]}' % i for i in range(20)]
+        sender, receiver = ZlibFilter(), ZlibFilter()
+        chain = FilterChain([sender]).for_connection()
+        peer = FilterChain([receiver]).for_connection()
+        chunks = [chain.socket_to_ws(message) for message in messages]
+        self.assertLess(sum(map(len, chunks[1:])), sum(map(len, messages[1:])) / 3)
+        self.assertEqual(messages[:2], [peer.ws_to_socket(chunk) for chunk in chunks[:2]])
+        self.assertEqual(b"".join(messages[2:]), peer.ws_to_socket(b"".join(chunks[2:])))
+        self.assertLess(sender.ratio, 0.5)
+        self.assertIsNone(peer.ws_to_socket(None))
+        chain.close()
+        peer.close()
+        self.assertRaises(FilterException, FilterChain([receiver]).for_connection().ws_to_socket, b"\xff" * 8)
+
+    def test_filter_order(self):
+        """
+        Tests filters run in list order both ways, encoding filters last on sent chunks and first on received ones
+        """
+        class TagFilter(BaseFilter):
+            def __init__(self, tag):
+                super(TagFilter, self).__init__()
+                self.tag = tag
+
+            def ws_to_socket(self, data):
+                return data + self.tag
+
+            def socket_to_ws(self, data):
+                return data + self.tag
+
+        tags = [TagFilter(b"a"), TagFilter(b"b")]
+        self.assertEqual(b"-ab", filter_data(tags, b"-", SOCK_TO_WS))
+        self.assertEqual(b"-ab", filter_data(tags, b"-", WS_TO_SOCK))
+        before, after = ObserverFilter(), ObserverFilter()
+        chain = FilterChain([ZlibFilter(), UpperFilter()]).for_connection()
+        peer = FilterChain([before, ZlibFilter(), after]).for_connection()
+        self.assertEqual(b"Hello", peer.ws_to_socket(chain.socket_to_ws(b"hello")))
+        self.assertEqual([b"Hello"], before.seen)
+        self.assertEqual([b"Hello"], after.seen)
+
+    def test_zlib_filter_max_size(self):
+        """
+        Tests a received chunk inflating over max_size is rejected
+        """
+        chunk = FilterChain([ZlibFilter()]).for_connection().socket_to_ws(b"\x00" * 4096)
+        bounded = FilterChain([ZlibFilter(max_size=4096)]).for_connection()
+        self.assertEqual(b"\x00" * 4096, bounded.ws_to_socket(chunk))
+        too_small = FilterChain([ZlibFilter(max_size=4095)]).for_connection()
+        self.assertRaises(FilterException, too_small.ws_to_socket, chunk)
+
+    @unittest.skipIf(sys.version_info < (3, 3), "zdict needs Python 3.3")
+    def test_zlib_filter_zdict(self):
+        """
+        Tests a trained preset dictionary shrinks the first chunks of a connection
+        """
+        messages = [b'{"op": "get", "key": "user:%d", "fields": ["name", "email"]}' % i for i in range(20)]
+        zdict = train_zdict(messages[:10], size=256)
+        self.assertLessEqual(len(zdict), 256)
+        self.assertIn(b'"fields": ["name",', zdict)
+        plain = FilterChain([ZlibFilter()]).for_connection()
+        primed = FilterChain([ZlibFilter(zdict=zdict)]).for_connection()
+        peer = FilterChain([ZlibFilter(zdict=zdict)]).for_connection()
+        chunk = primed.socket_to_ws(messages[15])
+        self.assertLess(len(chunk), len(plain.socket_to_ws(messages[15])) / 2)
+        self.assertEqual(messages[15], peer.ws_to_socket(chunk))
+        with NamedTemporaryFile(delete=False) as f:
+            f.write(zdict)
+        try:
+            zlib_filter = create_filter({"class": "wstunnel.filters.ZlibFilter", "zdict_file": f.name, "level": 9})
+            self.assertEqual((zdict, 9), (zlib_filter.zdict, zlib_filter.level))
+        finally:
+            os.remove(f.name)
+
+
+class MessageDeflateTestCase(unittest.TestCase):
+    """
+    Test cases for per message compression
+    """
+
+    def test_round_trip(self):
+        """
+        Tests messages are decompressed back, with and without context takeover
+        """
+        for context_takeover in (True, False):
+            sender = MessageDeflate(level=9, window_bits=10, context_takeover=context_takeover)
+            receiver = MessageDeflate()
+            for data in (b"login: ", b"login: fabio\r\n" * 100, b"x"):
+                self.assertEqual(data, receiver.decompress(sender.compress(data)))
+            self.assertLess(sender.ratio, 0.5)
+
+    def test_adaptive_incompressible(self):
+        """
+        Tests compression stops on incompressible data and is tried again after the backoff
+        """
+        sender = MessageDeflate(sample_size=4096, backoff=8192)
+        receiver = MessageDeflate()
+        for _ in range(2):
+            data = os.urandom(4096)
+            self.assertEqual(data, receiver.decompress(sender.compress(data)))
+        self.assertFalse(sender.compressing)
+        self.assertEqual(RAW + data, sender.compress(data))
+        self.assertTrue(sender.compressing)
+
+    def test_malformed_message(self):
+        """
+        Tests an exception is raised on a message that cannot be decoded
+        """
+        self.assertRaises(CompressionException, MessageDeflate().decompress, b"\x01garbage")
+        self.assertRaises(CompressionException, MessageDeflate().decompress, b"\x07")
+
+    def test_decompression_bomb(self):
+        """
+        Tests a message inflating over max_size is rejected
+        """
+        message = MessageDeflate().compress(b"\x00" * 1024 * 1024)
+        self.assertLess(len(message), 2048)
+        self.assertEqual(1024 * 1024, len(MessageDeflate(max_size=1024 * 1024).decompress(message)))
+        self.assertRaises(CompressionException, MessageDeflate(max_size=64 * 1024).decompress, message)
+
+
+class CompatTestCase(AsyncTestCase):
+    """
+    Test cases for the IOStream hooks depending on tornado internals, run on each supported tornado version
+    """
+
+    def setUp(self):
+        super(CompatTestCase, self).setUp()
+        left, right = socket.socketpair()
+        self.stream = IOStream(left, io_loop=self.io_loop)
+        self.peer = IOStream(right, io_loop=self.io_loop)
+
+    def tearDown(self):
+        self.stream.close()
+        self.peer.close()
+        super(CompatTestCase, self).tearDown()
+
+    def spin(self, seconds=0.05):
+        self.io_loop.add_timeout(self.io_loop.time() + seconds, self.stop)
+        self.wait()
+
+    def test_stream_internals(self):
+        """
+        Tests the IOStream of this tornado version has the internals the hooks rely on
+        """
+        self.assertTrue(callable(getattr(IOStream, "_try_inline_read", None)), TORNADO_VERSION)
+        self.assertTrue(callable(getattr(IOStream, "_add_io_state", None)), TORNADO_VERSION)
+        for attr, value in READ_STATE.items():
+            self.assertEqual(value, getattr(self.stream, attr), attr)
+        self.assertEqual(0, write_buffer_size(self.stream))
+
+    def test_pause_reading(self):
+        """
+        Tests reads started before and while paused complete only once every reason to pause is gone
+        """
+        received = []
+        self.stream.read_bytes(5, received.append)
+        pause_reading(self.stream, "first")
+        pause_reading(self.stream, "second")
+        self.peer.write(b"HelloWorld")
+        self.spin()
+        self.assertEqual([], received)
+        resume_reading(self.stream, "first")
+        self.spin()
+        self.assertTrue(is_reading_paused(self.stream))
+        self.assertEqual([], received)
+        resume_reading(self.stream, "second")
+        self.spin()
+        self.assertFalse(is_reading_paused(self.stream))
+        self.assertEqual([b"Hello"], received)
+        pause_reading(self.stream)
+        self.stream.read_bytes(5, received.append)
+        self.spin()
+        self.assertEqual([b"Hello"], received)
+        resume_reading(self.stream)
+        self.spin()
+        self.assertEqual([b"Hello", b"World"], received)
+
+    def test_write_flushed(self):
+        """
+        Tests queued writes are counted until flushed to the socket
+        """
+        data = b"x" * (8 * 1024 * 1024)
+        self.stream.write(data)
+        self.assertGreater(write_buffer_size(self.stream), 0)
+        flushed = []
+        on_write_flushed(self.stream, lambda: flushed.append(write_buffer_size(self.stream)))
+        self.peer.read_bytes(len(data), self.stop)
+        self.assertEqual(len(data), len(self.wait()))
+        self.spin()
+        self.assertEqual([0], flushed)
+
+
+class ResolverTestCase(AsyncTestCase):
+    """
+    Test cases for name resolution and dual stack connects
+    """
+
+    def setUp(self):
+        super(ResolverTestCase, self).setUp()
+        self.resolver_configuration = Resolver._save_configuration()
+
+    def tearDown(self):
+        Resolver._restore_configuration(self.resolver_configuration)
+        super(ResolverTestCase, self).tearDown()
+
+    def test_cached_resolution(self):
+        """
+        Tests resolved names are cached
+        """
+        resolver = CachingResolver(io_loop=self.io_loop)
+        CachingResolver._cache.clear()
+        resolver.resolve("localhost", 80, socket.AF_INET, callback=self.stop)
+        addrinfo = self.wait()
+        self.assertIn((socket.AF_INET, ("127.0.0.1", 80)), addrinfo)
+        self.assertIn(("localhost", 80, socket.AF_INET), CachingResolver._cache)
+        resolver.resolve("localhost", 80, socket.AF_INET, callback=self.stop)
+        self.assertEqual(addrinfo, self.wait())
+
+    def test_configure_resolver(self):
+        """
+        Tests CachingResolver is installed as the tornado resolver
+        """
+        try:
+            configure_resolver(ttl=5)
+            self.assertIsInstance(Resolver(io_loop=self.io_loop), CachingResolver)
+            self.assertEqual(5, CachingResolver.ttl)
+        finally:
+            configure_resolver()
+
+    def test_shared_resolver(self):
+        """
+        Tests the connects running on an io_loop share a single resolver
+        """
+        resolver = CachingResolver.shared(self.io_loop)
+        self.assertIs(resolver, CachingResolver.shared(self.io_loop))
+        self.assertIs(self.io_loop, resolver.io_loop)
+
+    def test_connect_lookup_failure(self):
+        """
+        Tests any error of the lookup is handed to the errback
+        """
+        lookup = Future()
+        lookup.set_exception(ValueError("unexpected"))
+        CachingResolver.shared(self.io_loop).resolve = lambda host, port, family: lookup
+        connect_stream(("example.com", 80), self.stop, self.stop, io_loop=self.io_loop)
+        self.assertIsInstance(self.wait(), ValueError)
+
+    def test_connect_lookup_timeout(self):
+        """
+        Tests the connect timeout covers the name lookup
+        """
+        CachingResolver.shared(self.io_loop).resolve = lambda host, port, family: Future()
+        connect_stream(("example.com", 80), self.stop, self.stop, io_loop=self.io_loop, timeout=0.05)
+        self.assertIsInstance(self.wait(), socket.timeout)
+
+    def test_interleave(self):
+        """
+        Tests addresses are ordered alternating families
+        """
+        addrinfo = [(socket.AF_INET6, "a"), (socket.AF_INET6, "b"), (socket.AF_INET, "c"), (socket.AF_INET, "d")]
+        self.assertEqual(["a", "c", "b", "d"], [address for _, address in interleave(addrinfo)])
+
+    def test_happy_eyeballs_fallback(self):
+        """
+        Tests the connect falls back to the next address when the first one is refused
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        addrinfo = [(socket.AF_INET, ("127.0.0.1", random_free_port())), (socket.AF_INET, listener.getsockname())]
+        HappyEyeballs(addrinfo, lambda af: IOStream(socket.socket(af), io_loop=self.io_loop), self.stop, self.stop,
+                      io_loop=self.io_loop, delay=10).start()
+        stream = self.wait()
+        self.assertIsInstance(stream, IOStream)
+        self.assertEqual(listener.getsockname(), stream.socket.getpeername())
+        stream.close()
+        listener.close()
+
+    def test_happy_eyeballs_deadline(self):
+        """
+        Tests connects still pending at the deadline are given up
+        """
+        streams = []
+        peer, sock = socket.socketpair()
+
+        def create_stream(af):
+            stream = IOStream(sock, io_loop=self.io_loop)
+            stream.connect = lambda address, callback: None
+            streams.append(stream)
+            return stream
+
+        HappyEyeballs([(socket.AF_INET, ("127.0.0.1", 9))], create_stream, self.stop, self.stop, io_loop=self.io_loop,
+                      deadline=self.io_loop.time() + 0.05).start()
+        self.assertIsInstance(self.wait(), socket.timeout)
+        self.assertTrue(streams[0].closed())
+        peer.close()
+
+
+class _StreamCollector(object):
+    ssl_options = None
+    max_buffer_size = None
+    io_loop = None
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def handle_stream(self, stream, address):
+        self.callback(stream)
+
+
+@unittest.skipIf(not hasattr(socket.socket, "sendmsg"), "Passing sockets requires sendmsg")
+class DispatcherTestCase(AsyncTestCase):
+    """
+    Test cases for dispatching connections to workers
+    """
+
+    def test_policies(self):
+        """
+        Tests the least loaded worker is picked
+        """
+        busy, idle = WorkerHandle(0, 1, None), WorkerHandle(1, 2, None)
+        busy.on_report(10, 100)
+        idle.on_report(2, 1000)
+        self.assertIs(idle, get_policy("connections")([busy, idle]))
+        self.assertIs(busy, get_policy("bytes")([busy, idle]))
+        self.assertIs(least_bytes, get_policy("wstunnel.dispatcher.least_bytes"))
+
+    def test_pass_connection(self):
+        """
+        Tests a socket passed to a worker is handed to its server and accounted
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        client = socket.create_connection(listener.getsockname())
+        connection, _ = listener.accept()
+        parent_channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        worker = Worker([None, _StreamCollector(self.stop)], worker_channel, io_loop=self.io_loop)
+        worker.start()
+        send_socket(parent_channel, 1, connection)
+        connection.close()
+        stream = self.wait()
+        self.assertEqual(1, worker.connections)
+        client.sendall(b"hello")
+        stream.read_bytes(5, self.stop)
+        self.assertEqual(b"hello", self.wait())
+        self.assertEqual(5, worker.bytes)
+        stream.close()
+        self.assertEqual(0, worker.connections)
+        worker.stop()
+        for sock in (client, listener, parent_channel):
+            sock.close()
+
+    def test_respawn_and_pin(self):
+        """
+        Tests a lost worker is respawned, pinned to its cpu, and SIGTERM terminates the dispatcher
+        """
+        cpus = sorted(os.sched_getaffinity(0))[-1:] if hasattr(os, "sched_getaffinity") else None
+        fd, runs_file = tempfile.mkstemp()
+        os.close(fd)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if IOLoop.initialized():
+                    del IOLoop._instance
+                IOLoop.clear_current()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                index = Dispatcher(cpus=cpus, respawn_delay=0).start(1)
+                affinity = sorted(os.sched_getaffinity(0)) if cpus else None
+                with open(runs_file, "a") as f:
+                    f.write("%d %s\n" % (index, affinity))
+                with open(runs_file) as f:
+                    if len(f.readlines()) > 1:
+                        os.kill(os.getppid(), signal.SIGTERM)
+                        time.sleep(60)
+            finally:
+                os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        with open(runs_file) as f:
+            runs = f.readlines()
+        os.remove(runs_file)
+        self.assertEqual(0, status)
+        self.assertEqual(["0 %s\n" % cpus] * 2, runs)
+
+    def test_forward_signals(self):
+        """
+        Tests the given signals are forwarded to the workers rather than handled by the dispatcher
+        """
+        fd, runs_file = tempfile.mkstemp()
+        os.close(fd)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if IOLoop.initialized():
+                    del IOLoop._instance
+                IOLoop.clear_current()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signaled = []
+                signal.signal(signal.SIGUSR1, lambda *args: signaled.append(os.getpid()))
+                Dispatcher(respawn_delay=0, signals=(signal.SIGUSR1,)).start(1)
+                for _ in range(50):
+                    if signaled:
+                        break
+                    os.kill(os.getppid(), signal.SIGUSR1)
+                    time.sleep(0.1)
+                with open(runs_file, "a") as f:
+                    f.write("%s\n" % (signaled == [os.getpid()]))
+                os.kill(os.getppid(), signal.SIGTERM)
+                time.sleep(60)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        with open(runs_file) as f:
+            runs = f.readlines()
+        os.remove(runs_file)
+        self.assertEqual(["True\n"], runs)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """
+    Test cases for the tunnel metrics
+    """
+
+    def test_histogram(self):
+        """
+        Tests observations are counted in cumulative buckets
+        """
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual([("0.1", 2), ("1.0", 3), ("+Inf", 4)], histogram.cumulative())
+        self.assertEqual(4, histogram.count)
+        self.assertAlmostEqual(2.65, histogram.sum)
+
+    def test_exposition(self):
+        """
+        Tests the Prometheus text format
+        """
+        metrics = TunnelMetrics()
+        resource = metrics.resource('/a"b')
+        resource.bytes_socket_to_ws += 10
+        resource.connect_latency.observe(0.001)
+        lines = metrics.exposition().splitlines()
+        self.assertIn("# TYPE wstunnel_bytes_total counter", lines)
+        self.assertEqual(1, lines.count("# TYPE wstunnel_bytes_total counter"))
+        self.assertIn('wstunnel_bytes_total{resource="/a\\"b",direction="socket_to_ws"} 10', lines)
+        self.assertIn('wstunnel_backend_connect_seconds_bucket{resource="/a\\"b",le="0.001"} 1', lines)
+        self.assertIn('wstunnel_backend_connect_seconds_count{resource="/a\\"b"} 1', lines)
+        metrics.filter_profile = FilterProfile()
+        FilterChain([ObserverFilter()]).instrument(metrics.filter_profile, "/f")
+        self.assertIn('wstunnel_filter_calls_total{resource="/f",filter="ObserverFilter",direction="ws_to_socket"} 0',
+                      metrics.exposition().splitlines())
+
+    def test_shared_region(self):
+        """
+        Tests workers write their own slots and readers get the totals
+        """
+        region = StatsRegion(["/a", "/b"], 2)
+        metrics = TunnelMetrics()
+        pid = os.fork()
+        if pid == 0:
+            metrics.bind(region, 1)
+            metrics.resource("/a").bytes_ws_to_socket += 100
+            metrics.resource("/a").connect_latency.observe(0.001)
+            os._exit(0)
+        metrics.bind(region, 0)
+        metrics.resource("/a").bytes_ws_to_socket += 20
+        metrics.resource("/b").connections_total += 1
+        os.waitpid(pid, 0)
+        self.assertEqual(120, region.total("/a").bytes_ws_to_socket)
+        self.assertEqual(1, region.total("/a").connect_latency.count)
+        self.assertEqual(1, region.total("/b").connections_total)
+        self.assertIn('wstunnel_bytes_total{resource="/a",direction="ws_to_socket"} 120',
+                      metrics.exposition().splitlines())
@@ -13,15 +13,25 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import binascii
+import gc
 import socket
+import unittest
 from tempfile import NamedTemporaryFile
 import os
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.iostream import StreamClosedError
 from tornado.testing import AsyncTestCase, LogTrapTestCase
-from wstunnel.filters import DumpFilter, FilterException
+from wstunnel.engine import ASYNC, ASYNCIO, UVLOOP, AsyncTunnelClient, AsyncTunnelServer, available_engines, \
+    event_loop_class, new_event_loop
+from wstunnel.filters import CaptureFilter, DumpFilter, FilterException, ZlibFilter, SOCK_TO_WS, WS_TO_SOCK, \
+    read_capture
+from wstunnel.flow import BULK, INTERACTIVE, Coalescer, Scheduler, Shaping, TokenBucket
 from wstunnel.test import EchoServer, EchoClient, RaiseFromWSFilter, RaiseToWSFilter, setup_logging, clean_logging, \
     fixture, DELETE_TMPFILE
-from wstunnel.client import WSTunnelClient, WebSocketProxy
-from wstunnel.server import WSTunnelServer
+from wstunnel.client import WSTunnelClient, WebSocketProxy, websocket_connect
+from wstunnel.server import WSTunnelServer, WebSocketProxyHandler
+from wstunnel.compat import TORNADO_VERSION, is_reading_paused, pause_reading, resume_reading
 from wstunnel.toolbox import hex_dump, random_free_port
 
 
@@ -132,6 +142,8 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
             srv.stop()
 
         super(WSTunnelTestCase, self).tearDown()
+        # The loop closes the fds still registered: release their sockets before the numbers get reused
+        gc.collect()
         clean_logging([self.log_file, self.pid_file])
 
     def on_response_received(self, response):
@@ -141,6 +153,15 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
         self.assertEqual(self.message.upper(), response)
         self.stop()
 
+    def wait_until(self, condition, timeout=ASYNC_TIMEOUT):
+        def check():
+            if condition():
+                self.stop()
+            else:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.01, check)
+        check()
+        self.wait(timeout=timeout)
+
     def on_response_resend(self, response):
         """
         Callback invoked when response is received. It resends the message, so that there will be an infinite loop.
@@ -155,6 +176,23 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
         self.client.send_message(self.message, self.on_response_received)
         self.wait(timeout=ASYNC_TIMEOUT)
 
+    def test_metrics(self):
+        """
+        Test the endpoints count connections and bytes of each resource
+        """
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        metrics = self.srv_tun.metrics.resource("/test")
+        self.assertGreaterEqual(metrics.connections_total, 1)
+        self.assertGreaterEqual(metrics.connections_active, 1)
+        self.assertGreater(metrics.bytes_ws_to_socket, 0)
+        self.assertGreater(metrics.bytes_socket_to_ws, 0)
+        self.assertGreaterEqual(metrics.connect_latency.count, 1)
+        metrics = self.clt_tun.metrics.resource(0)
+        self.assertGreaterEqual(metrics.connections_total, 1)
+        self.assertGreater(metrics.bytes_ws_to_socket, 0)
+        self.assertGreater(metrics.bytes_socket_to_ws, 0)
+
     def test_request_response_binary(self):
         """
         Test a simple request/response chat through the websocket tunnel. Message contains
@@ -176,6 +214,7 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
             self.client.send_message(self.message, self.on_response_received)
             self.wait(timeout=ASYNC_TIMEOUT)
 
+            client_filter.flush()
             content = logf.read()
             for line in hex_dump(self.message).splitlines():
                 self.assertIn(line, content.decode("utf-8"))
@@ -193,12 +232,69 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
             self.client.send_message(self.message, self.on_response_received)
             self.wait(timeout=ASYNC_TIMEOUT)
 
+            server_filter.flush()
             content = logf.read()
             for line in hex_dump(self.message).splitlines():
                 self.assertIn(line, content.decode("utf-8"))
 
             self.srv_tun.uninstall_filter(server_filter)
 
+    def test_client_capture_filter(self):
+        """
+        Test capturing the chunks of each client connection
+        """
+        ringf = NamedTemporaryFile(delete=False)
+        ringf.close()
+        try:
+            client_filter = CaptureFilter(ringf.name, capacity=4096)
+            self.clt_tun.install_filter(client_filter)
+
+            self.client.send_message(self.message, self.on_response_received)
+            self.wait(timeout=ASYNC_TIMEOUT)
+
+            records = read_capture(ringf.name)
+            self.assertEqual([SOCK_TO_WS, WS_TO_SOCK], [record.direction for record in records])
+            self.assertEqual([self.message, self.message.upper()], [record.payload for record in records])
+            self.assertEqual(1, len(set(record.connection_id for record in records)))
+            self.clt_tun.uninstall_filter(client_filter)
+        finally:
+            os.remove(ringf.name)
+
+    def test_zlib_filter(self):
+        """
+        Test compressing the data carried over the WebSocket with a zlib stream per connection
+        """
+        client_filter, server_filter = ZlibFilter(), ZlibFilter()
+        self.clt_tun.install_filter(client_filter)
+        self.srv_tun.install_filter(server_filter)
+
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+
+        self.assertEqual(len(self.message), client_filter.bytes_in)
+        self.assertEqual(len(self.message), server_filter.bytes_in)
+        self.clt_tun.uninstall_filter(client_filter)
+        self.srv_tun.uninstall_filter(server_filter)
+
+    def test_zlib_filter_close(self):
+        """
+        Test the WebSocket closing goes through ZlibFilter
+        """
+        self.clt_tun.install_filter(ZlibFilter())
+        self.srv_tun.install_filter(ZlibFilter())
+
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+
+        proxy = list(self.clt_tun.proxies.values())[0]
+        ws_conn = proxy.mux_sessions[0].ws_conn if proxy.multiplex else proxy.ws_conn.ws_conn
+        metrics = self.srv_tun.metrics.resource("/test")
+        closed = metrics.connections_total - metrics.connections_active + 1
+        ws_conn.close()
+        self.wait_until(lambda: metrics.connections_total - metrics.connections_active == closed)
+        self.client.io_stream.close()
+        self.wait_until(lambda: proxy.metrics.connections_active == 0)
+
     def test_raise_filter_exception_from_ws(self):
         """
         Tests the behaviour when a filter raises exception reading from websocket
@@ -245,6 +341,18 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
             self.srv_tun.remove_proxy(key)
             self.assertEqual(0, len(self.srv_tun.proxies))
 
+    def test_upgrade_rejected_without_service(self):
+        """
+        Tests the WebSocket upgrade is rejected with 502 when the mapped service is not available
+        """
+        self.srv.stop()
+        ws_url = list(self.clt_tun.proxies.values())[0].ws_url
+        websocket_connect(ws_url, self.io_loop, callback=self.stop, validate_cert=False)
+        future = self.wait()
+        with self.assertRaises(HTTPError) as cm:
+            future.result()
+        self.assertEqual(502, cm.exception.code)
+
     def test_server_peer_connection_drop_issue_6(self):
         """
         Tests dropping peer connection server side. This test addresses issue #6
@@ -282,6 +390,672 @@ class WSTunnelTestCase(AsyncTestCase, LogTrapTestCase):
             self.assertTrue(str(e).lower() in ("closed", "async operation timed out after %d seconds" % ASYNC_TIMEOUT))
 
 
+class WSTunnelMultiplexTestCase(WSTunnelTestCase):
+    """
+    Tests for a client tunnel multiplexing connections over a shared WebSocket
+    """
+
+    def setUp(self):
+        super(WSTunnelMultiplexTestCase, self).setUp()
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      multiplex=True)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+
+    def test_connections_share_websocket(self):
+        """
+        Tests several client connections are carried as channels of the same WebSocket
+        """
+        responses = []
+
+        def on_response(response):
+            self.assertEqual(self.message.upper(), response)
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+
+        clients = [EchoClient(self.clt_tun.address_list[0]) for _ in range(3)]
+        for client in clients:
+            client.send_message(self.message, on_response)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        ws_proxy = list(self.clt_tun.proxies.values())[0]
+        self.assertEqual(1, len(ws_proxy.mux_sessions))
+
+    def test_channel_flow_control(self):
+        """
+        Tests a payload larger than the channel window is fully transferred
+        """
+        self.message = binascii.hexlify(os.urandom(1024)) * 512
+        received = []
+
+        def on_response(response):
+            received.append(response)
+            if sum(map(len, received)) == len(self.message):
+                self.assertEqual(self.message.upper(), b"".join(received))
+                self.stop()
+
+        self.client.send_message(self.message, on_response)
+        self.wait(timeout=ASYNC_TIMEOUT * 5)
+
+
+class WSTunnelPoolTestCase(WSTunnelTestCase):
+    """
+    Tests for a client tunnel taking handshaked WebSockets from a pool
+    """
+
+    def setUp(self):
+        super(WSTunnelPoolTestCase, self).setUp()
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      pool_min_idle=2,
+                                      pool_max_idle=3)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+        self.pool = list(self.clt_tun.proxies.values())[0].pool
+        self.wait_for_pool(2)
+
+    def wait_for_pool(self, size):
+        def check():
+            if len(self.pool.idle) >= size:
+                self.stop()
+            else:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.05, check)
+        check()
+        self.wait(timeout=ASYNC_TIMEOUT)
+
+    def test_pooled_websocket(self):
+        """
+        Tests a client connection uses an idle WebSocket from the pool, which is then refilled
+        """
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        self.assertEqual(1, self.pool.hits)
+        self.wait_for_pool(2)
+
+    def test_expired_websocket(self):
+        """
+        Tests idle WebSockets older than max age are not used
+        """
+        self.pool.max_age = 0
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        self.assertEqual(0, self.pool.hits)
+        self.assertEqual(1, self.pool.misses)
+
+    def test_server_peer_connection_drop_issue_6(self):
+        """
+        Tests stopping the service listener does not affect pooled WebSockets, since they are
+        already connected to the service
+        """
+        responses = []
+
+        def on_response(response):
+            self.assertEqual(self.message.upper(), response)
+            responses.append(response)
+            if len(responses) == 3:
+                self.stop()
+            else:
+                self.client.write(self.message)
+
+        self.client.send_message(self.message, handle_response=on_response)
+        self.srv.stop()
+        self.wait(timeout=ASYNC_TIMEOUT)
+
+
+class WSTunnelBackPressureTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints throttling reads when write buffers grow over the high watermark
+    """
+
+    def setUp(self):
+        super(WSTunnelBackPressureTestCase, self).setUp()
+        self.srv_tun.get_proxy("/test").update(high_watermark=4096)
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      high_watermark=4096)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+
+    def test_throttled_transfer(self):
+        """
+        Tests a payload much larger than the watermarks is fully transferred while being throttled
+        """
+        self.message = binascii.hexlify(os.urandom(1024)) * 2048
+        received = []
+
+        def on_response(response):
+            received.append(response)
+            if sum(map(len, received)) == len(self.message):
+                self.assertEqual(self.message.upper(), b"".join(received))
+                self.stop()
+
+        self.client.send_message(self.message, on_response)
+        self.wait(timeout=ASYNC_TIMEOUT * 5)
+        ws_conn = list(self.clt_tun.proxies.values())[0].ws_conn
+        self.assertGreater(ws_conn.to_ws_flow.throttled + ws_conn.to_socket_flow.throttled, 0)
+
+
+class WSTunnelCoalesceTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints coalescing small writes
+    """
+
+    def setUp(self):
+        super(WSTunnelCoalesceTestCase, self).setUp()
+        self.srv_tun.get_proxy("/test").update(coalesce_delay=2000)
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      coalesce_delay=2000)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+
+    def test_coalesced_writes(self):
+        """
+        Tests chunks following each other are written at once, while the first one after idle is not delayed
+        """
+        written = []
+        coalescer = Coalescer(written.append, self.io_loop, max_delay=0.01, max_bytes=8)
+        for chunk in (b"a", b"b", b"c"):
+            coalescer.write(chunk)
+        self.assertEqual([b"a"], written)
+        self.io_loop.add_timeout(self.io_loop.time() + 0.05, self.stop)
+        self.wait()
+        self.assertEqual([b"a", b"bc"], written)
+        for chunk in (b"d", b"e" * 4, b"f" * 4):
+            coalescer.write(chunk)
+        self.assertEqual([b"a", b"bc", b"d", b"eeeeffff"], written)
+        self.assertEqual(2, coalescer.frames_saved)
+        self.assertGreater(coalescer.delay_max, 0)
+
+
+class WSTunnelCompressionTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints compressing WebSocket messages
+    """
+
+    def setUp(self):
+        super(WSTunnelCompressionTestCase, self).setUp()
+        self.srv_tun.get_proxy("/test").update(compression={"level": 9})
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      compression=True)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+
+    def test_compressed_transfer(self):
+        """
+        Tests a compressible payload is sent compressed
+        """
+        self.message = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n" * 100
+        received = []
+
+        def on_response(response):
+            received.append(response)
+            if sum(map(len, received)) == len(self.message):
+                self.assertEqual(self.message.upper(), b"".join(received))
+                self.stop()
+
+        self.client.send_message(self.message, on_response)
+        self.wait()
+        deflate = list(self.clt_tun.proxies.values())[0].ws_conn.deflate
+        self.assertIsNotNone(deflate)
+        self.assertLess(deflate.ratio, 0.5)
+
+
+class SourceStream(object):
+    """
+    Stands for an IOStream being read
+    """
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self._state = None
+        self._closed = False
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def reading(self):
+        return False
+
+
+class WSTunnelSchedulerTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints sharing the IOLoop through a scheduler
+    """
+
+    def setUp(self):
+        super(WSTunnelSchedulerTestCase, self).setUp()
+        self.scheduler = Scheduler(quantum=1024, turn_bytes=4096)
+        self.srv_tun.get_proxy("/test").update(scheduler=self.scheduler, priority=BULK, compression=True)
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      scheduler=self.scheduler,
+                                      priority=BULK,
+                                      compression=True)
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+
+    def test_scheduled_transfer(self):
+        """
+        Tests a payload much larger than the quantum is fully transferred a turn at a time
+        """
+        self.message = binascii.hexlify(os.urandom(1024)) * 256
+        received = []
+
+        def on_response(response):
+            received.append(response)
+            if sum(map(len, received)) == len(self.message):
+                self.assertEqual(self.message.upper(), b"".join(received))
+                self.stop()
+
+        self.client.send_message(self.message, on_response)
+        self.wait(timeout=ASYNC_TIMEOUT * 5)
+        self.assertGreater(self.scheduler.turns, 1)
+        self.assertGreater(self.scheduler.deferred, 0)
+
+    def test_priority_classes(self):
+        """
+        Tests higher classes are served first and connections of a class share their turns by weight
+        """
+        sent = []
+        scheduler = Scheduler(quantum=4, turn_bytes=12)
+        light = scheduler.flow(SourceStream(self.io_loop), lambda data: sent.append(("light", data)), BULK)
+        heavy = scheduler.flow(SourceStream(self.io_loop), lambda data: sent.append(("heavy", data)), BULK, weight=2)
+        normal = scheduler.flow(SourceStream(self.io_loop), lambda data: sent.append(("normal", data)))
+        interactive = scheduler.flow(SourceStream(self.io_loop), lambda data: sent.append(("interactive", data)),
+                                     INTERACTIVE)
+        light.write(b"l" * 10)
+        heavy.write(b"h" * 20)
+        interactive.write(b"i")
+        normal.write(b"n" * 2)
+        self.assertEqual([("interactive", b"i"), ("normal", b"nn")], sent)
+        self.assertTrue(is_reading_paused(light.source))
+        interactive.write(b"i" * 6)
+        normal.write(b"n")
+        self.assertEqual(2, len(sent))
+        scheduler.run()
+        self.assertEqual([("interactive", b"iiii"), ("normal", b"n"), ("light", b"llll"), ("heavy", b"h" * 8)],
+                         sent[2:])
+        self.assertFalse(is_reading_paused(normal.source))
+        del sent[:]
+        scheduler.run()
+        self.assertEqual([("interactive", b"ii"), ("light", b"llll"), ("heavy", b"h" * 8)], sent)
+        self.assertFalse(is_reading_paused(interactive.source))
+        self.assertTrue(is_reading_paused(heavy.source))
+        del sent[:]
+        heavy.close()
+        self.assertEqual([("heavy", b"hhhh")], sent)
+        self.assertEqual(2, light.pending)
+
+    def test_failed_forward(self):
+        """
+        Tests a connection whose forward fails is closed, the other queued connections still being served
+        """
+        sent = []
+
+        def fail(data):
+            raise StreamClosedError()
+
+        scheduler = Scheduler(quantum=4, turn_bytes=64)
+        broken = scheduler.flow(SourceStream(self.io_loop), fail)
+        flows = [scheduler.flow(SourceStream(self.io_loop), sent.append) for _ in range(2)]
+        for flow in [broken] + flows:
+            flow.write(b"x" * 10)
+        self.wait_until(lambda: not any(flow.queued for flow in flows))
+        self.assertEqual(20, sum(map(len, sent)))
+        self.assertTrue(broken.source.closed())
+        self.assertEqual(0, broken.pending)
+
+
+class WSTunnelShapingTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints limiting the bandwidth of proxies and connections
+    """
+
+    def setUp(self):
+        super(WSTunnelShapingTestCase, self).setUp()
+        self.shaping = Shaping(proxy={"rate": 1000000, "burst": 20000},
+                               connection={"socket_to_ws": {"rate": 500000, "burst": 20000}})
+        self.srv_tun.get_proxy("/test").update(shaping=self.shaping)
+
+    def test_shaped_transfer(self):
+        """
+        Tests a transfer is slowed down to the connection rate, pausing reads
+        """
+        chunk = binascii.hexlify(os.urandom(8 * 1024))
+        self.message = chunk * 16
+        received = []
+
+        def on_response(response):
+            received.append(response)
+            if sum(map(len, received)) == len(self.message):
+                self.assertEqual(self.message.upper(), b"".join(received))
+                self.stop()
+
+        def send_chunk(count):
+            self.client.write(chunk)
+            if count > 1:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.002, lambda: send_chunk(count - 1))
+
+        started = self.io_loop.time()
+        self.client.send_message(chunk, on_response)
+        send_chunk(15)
+        self.wait(timeout=ASYNC_TIMEOUT * 5)
+        # A read resumed after a pause may drain the kernel buffer at once, so the elapsed time is only a lower bound
+        metrics = self.srv_tun.metrics.resource("/test")
+        self.assertGreater(metrics.shaping_throttled, 0)
+        self.assertGreater(metrics.shaping_throttled_seconds, 0.1)
+        self.assertGreater(self.io_loop.time() - started, 0.1)
+
+    def test_token_bucket(self):
+        """
+        Tests readers wait, paused, for the bucket to refill, woken by a single timer
+        """
+        bucket = TokenBucket(rate=1000, burst=100)
+        self.assertTrue(bucket.consume(60, self.io_loop))
+        self.assertFalse(bucket.consume(90, self.io_loop))
+        shaping = Shaping(proxy={"rate": 1000, "burst": 100})
+        sources = [SourceStream(self.io_loop), SourceStream(self.io_loop)]
+        shapers = [shaping.shaper("ws_to_socket", source) for source in sources]
+        self.assertIsNone(Shaping(connection={"socket_to_ws": {"rate": 1}}).shaper("ws_to_socket", sources[0]))
+        shapers[0].consume(120)
+        shapers[1].consume(10)
+        self.assertTrue(all(is_reading_paused(source) for source in sources))
+        self.assertEqual(2, len(shaping.buckets["ws_to_socket"].waiters))
+        self.io_loop.add_timeout(self.io_loop.time() + 0.2, self.stop)
+        self.wait()
+        self.assertFalse(any(is_reading_paused(source) for source in sources))
+        self.assertEqual(1, shaping.buckets["ws_to_socket"].throttled)
+        self.assertGreater(shapers[1].throttled_time, 0.02)
+
+
+class WSTunnelKeepAliveTestCase(WSTunnelTestCase):
+    """
+    Tests for tunnel endpoints pinging their peers to detect dead connections
+    """
+
+    def setUp(self):
+        super(WSTunnelKeepAliveTestCase, self).setUp()
+        self.srv_tun.get_proxy("/test").update(keep_alive={"interval": 0.05, "timeout": 0.1})
+        self.clt_tun.stop()
+        self.clt_tun = WSTunnelClient(proxies={0: "ws://localhost:{0}/test".format(self.srv_tun.port)},
+                                      address=self.srv_tun.address,
+                                      family=socket.AF_INET,
+                                      io_loop=self.io_loop,
+                                      ws_options={"validate_cert": False},
+                                      keep_alive={"interval": 0.05, "timeout": 0.1})
+        self.clt_tun.start()
+        self.client = EchoClient(self.clt_tun.address_list[0])
+        self.proxy = list(self.clt_tun.proxies.values())[0]
+
+    def test_idle_connection_pinged(self):
+        """
+        Tests pongs keep an idle connection open, recording their round trip time
+        """
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        keep_alive = self.proxy.ws_conn.keep_alive_timer
+        self.wait_until(lambda: keep_alive.pongs >= 2)
+        self.assertLess(keep_alive.rtt_min, 0.1)
+        self.assertGreaterEqual(keep_alive.rtt_max, keep_alive.rtt)
+        self.assertIsNotNone(keep_alive.srtt)
+        self.client.write(self.message)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        self.assertEqual(0, self.srv_tun.metrics.resource("/test").keepalive_timeouts)
+
+    def test_dead_server(self):
+        """
+        Tests the client tears down the tunnel when pongs stop arriving
+        """
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        self.proxy.ws_conn.keep_alive_timer.ping = lambda data: None
+        self.wait_until(lambda: self.client.is_closed)
+        self.assertEqual(1, self.proxy.metrics.keepalive_timeouts)
+        self.assertTrue(self.proxy.ws_conn.ws_conn.stream.closed())
+
+    def test_dead_client(self):
+        """
+        Tests the server tears down the tunnel when the client stops reading, the client holding its pings back
+        """
+        self.client.send_message(self.message, self.on_response_received)
+        self.wait(timeout=ASYNC_TIMEOUT)
+        ws_stream = self.proxy.ws_conn.ws_conn.stream
+        pause_reading(ws_stream, "test")
+        metrics = self.srv_tun.metrics.resource("/test")
+        self.wait_until(lambda: metrics.keepalive_timeouts == 1)
+        self.assertEqual(0, metrics.connections_active)
+        self.assertEqual(0, self.proxy.ws_conn.keep_alive_timer.pings)
+        resume_reading(ws_stream, "test")
+        self.wait_until(lambda: self.client.is_closed)
+
+    def test_handler_close(self):
+        """
+        Tests closing a proxy handler stops its keep alive timer and passes the close code and reason on
+        """
+        calls = []
+
+        class Recorder(object):
+            def __init__(self, name):
+                self.name = name
+
+            def __call__(self, *args):
+                calls.append((self.name,) + args)
+
+        handler = WebSocketProxyHandler.__new__(WebSocketProxyHandler)
+        handler.keep_alive_timer = type("Timer", (object,), {"stop": Recorder("stop")})()
+        handler.ws_connection = type("Connection", (object,), {"close": Recorder("close")})()
+        handler.close()
+        self.assertEqual("stop", calls[0][0])
+        self.assertEqual("close", calls[1][0])
+        if TORNADO_VERSION >= (4,):
+            del calls[:]
+            handler.ws_connection = type("Connection", (object,), {"close": Recorder("close")})()
+            handler.close(1001, "going away")
+            self.assertEqual([("stop",), ("close", 1001, "going away")], calls)
+
+
+class WSTunnelMetricsTestCase(AsyncTestCase, LogTrapTestCase):
+    """
+    Tests for the metrics endpoint
+    """
+
+    def test_metrics_endpoint(self):
+        """
+        Tests metrics are served on the tunnel port and on a separate one
+        """
+        srv_tun = WSTunnelServer(port=0, address="127.0.0.1", io_loop=self.io_loop, metrics=True,
+                                 proxies={"/test": ("127.0.0.1", random_free_port())})
+        admin_port = random_free_port()
+        admin_tun = WSTunnelServer(port=0, address="127.0.0.1", io_loop=self.io_loop,
+                                   metrics={"port": admin_port, "address": "127.0.0.1", "path": "/stats"},
+                                   proxies={"/test": ("127.0.0.1", random_free_port())})
+        srv_tun.start()
+        admin_tun.start()
+        try:
+            client = AsyncHTTPClient(self.io_loop)
+            for url in ("http://127.0.0.1:%d/metrics" % srv_tun.port, "http://127.0.0.1:%d/stats" % admin_port):
+                client.fetch(url, self.stop)
+                response = self.wait()
+                self.assertEqual(200, response.code)
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+                body = response.body.decode("utf-8")
+                self.assertIn('wstunnel_connections_active{resource="/test"} 0', body)
+                self.assertIn('wstunnel_backend_connect_seconds_bucket{resource="/test",le="+Inf"} 0', body)
+        finally:
+            for tun in srv_tun, admin_tun:
+                tun.server.stop()
+            admin_tun.metrics_server.stop()
+
+
+@unittest.skipIf(event_loop_class(ASYNCIO, strict=False) is None, "asyncio is not available")
+class WSTunnelAsyncIOTestCase(WSTunnelTestCase):
+    """
+    Tunneling tests running on the asyncio event loop
+    """
+
+    def get_new_ioloop(self):
+        return new_event_loop(ASYNCIO)
+
+
+@unittest.skipIf(event_loop_class(UVLOOP, strict=False) is None, "uvloop is not installed")
+class WSTunnelUVLoopTestCase(WSTunnelTestCase):
+    """
+    Tunneling tests running on the uvloop event loop
+    """
+
+    def get_new_ioloop(self):
+        return new_event_loop(UVLOOP)
+
+
+@unittest.skipIf(ASYNC not in available_engines(), "the async engine is not available")
+class WSTunnelAsyncEngineTestCase(AsyncTestCase, LogTrapTestCase):
+    """
+    Tunneling tests on the async engine, alone and facing the callback engine
+    """
+
+    def get_new_ioloop(self):
+        return new_event_loop(ASYNCIO)
+
+    def setUp(self):
+        super(WSTunnelAsyncEngineTestCase, self).setUp()
+        self.log_file, self.pid_file = setup_logging()
+        self.srv = EchoServer(port=0, address="127.0.0.1")
+        self.srv.start(1)
+        self.endpoints = [self.srv]
+        self.clients = []
+        self.message = "Hello World!".encode("utf-8")
+
+    def tearDown(self):
+        for endpoint in self.endpoints:
+            endpoint.stop()
+        # let the forwarding coroutines see the clients go before the loop is closed
+        for client in self.clients:
+            client.io_stream.close()
+        self.io_loop.add_timeout(self.io_loop.time() + 0.1, self.stop)
+        self.wait()
+        super(WSTunnelAsyncEngineTestCase, self).tearDown()
+        clean_logging([self.log_file, self.pid_file])
+        gc.collect()
+
+    def tunnel(self, server_class, client_class, service_address=None):
+        srv_tun = server_class(port=0, address="127.0.0.1",
+                               proxies={"/test": service_address or self.srv.address_list[0]}, io_loop=self.io_loop)
+        srv_tun.start()
+        clt_tun = client_class(proxies={0: "ws://127.0.0.1:{0}/test".format(srv_tun.port)}, address="127.0.0.1",
+                               family=socket.AF_INET, io_loop=self.io_loop)
+        clt_tun.start()
+        self.endpoints.extend([srv_tun, clt_tun])
+        return srv_tun, clt_tun
+
+    def echo(self, clt_tun, message):
+        received = []
+
+        def on_data(data):
+            received.append(data)
+            if sum(len(chunk) for chunk in received) >= len(message):
+                self.stop(b"".join(received))
+
+        client = EchoClient(clt_tun.address_list[0])
+        self.clients.append(client)
+        client.send_message(message, on_data)
+        return self.wait(timeout=ASYNC_TIMEOUT)
+
+    def test_request_response(self):
+        """
+        Test a request/response chat between async endpoints
+        """
+        srv_tun, clt_tun = self.tunnel(AsyncTunnelServer, AsyncTunnelClient)
+        self.assertEqual(self.message.upper(), self.echo(clt_tun, self.message))
+        metrics = srv_tun.metrics.resource("/test")
+        self.assertEqual(1, metrics.connections_total)
+        self.assertEqual(len(self.message), metrics.bytes_ws_to_socket)
+        self.assertEqual(1, metrics.connect_latency.count)
+
+    def test_routing(self):
+        """
+        Test the proxy keys are matched as regular expressions of the whole path, like the tornado routes
+        """
+        srv_tun = AsyncTunnelServer(port=0, address="127.0.0.1", proxies={"/test/[0-9]+": ("127.0.0.1", 1)},
+                                    io_loop=self.io_loop)
+        self.assertIs(srv_tun.proxies["/test/[0-9]+"], srv_tun.route("/test/42"))
+        self.assertIsNone(srv_tun.route("/test/42/more"))
+        self.assertIsNone(srv_tun.route("/test"))
+
+    def test_large_message(self):
+        """
+        Test messages longer than 64KB, sent with 64 bits lengths, are forwarded
+        """
+        _, clt_tun = self.tunnel(AsyncTunnelServer, AsyncTunnelClient)
+        message = b"x" * (300 * 1024)
+        self.assertEqual(message.upper(), self.echo(clt_tun, message))
+
+    def test_callback_client(self):
+        """
+        Test a callback engine client through an async server
+        """
+        _, clt_tun = self.tunnel(AsyncTunnelServer, WSTunnelClient)
+        self.assertEqual(self.message.upper(), self.echo(clt_tun, self.message))
+
+    def test_callback_server(self):
+        """
+        Test an async client through a callback engine server
+        """
+        _, clt_tun = self.tunnel(WSTunnelServer, AsyncTunnelClient)
+        self.assertEqual(self.message.upper(), self.echo(clt_tun, self.message))
+
+    def test_filters(self):
+        """
+        Test the filters installed into async endpoints transform the data
+        """
+        srv_tun, clt_tun = self.tunnel(AsyncTunnelServer, AsyncTunnelClient)
+        srv_tun.install_filter(ZlibFilter())
+        clt_tun.install_filter(ZlibFilter())
+        message = b"compress me " * 100
+        self.assertEqual(message.upper(), self.echo(clt_tun, message))
+        self.assertLess(srv_tun.metrics.resource("/test").bytes_ws_to_socket, len(message))
+
+    def test_service_not_available(self):
+        """
+        Test the upgrade is rejected with 502 when the service cannot be connected
+        """
+        srv_tun, _ = self.tunnel(AsyncTunnelServer, AsyncTunnelClient, ("127.0.0.1", random_free_port()))
+        websocket_connect("ws://127.0.0.1:{0}/test".format(srv_tun.port), self.io_loop, callback=self.stop)
+        with self.assertRaises(HTTPError) as cm:
+            self.wait(timeout=ASYNC_TIMEOUT).result()
+        self.assertEqual(502, cm.exception.code)
+        self.assertEqual(1, srv_tun.metrics.resource("/test").connect_failures)
+
+
 class WSTunnelSSLTestCase(WSTunnelTestCase):
     """
     Tests for SSL WebSocket tunnel
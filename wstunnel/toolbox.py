@@ -13,25 +13,40 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import errno
 import socket
 import string
 import os
-from wstunnel import unichr
+from tornado import netutil
+from wstunnel import bytes_type, unichr
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __author__ = 'fabio'
 
 
+_PRINTABLE = string.printable[:-6]
+_PRINTABLE_BYTES = _PRINTABLE.encode("UTF-8")
+
+
 def printable(x, encoding="UTF-8"):
     if isinstance(x, bytes):
-        return x if x in string.printable[:-6].encode(encoding) else b'.'
+        return x if x in (_PRINTABLE_BYTES if encoding == "UTF-8" else _PRINTABLE.encode(encoding)) else b'.'
     elif isinstance(x, int):
         return printable(unichr(x))
     else:
-        return x if x in string.printable[:-6] else u'.'
+        return x if x in _PRINTABLE else u'.'
 
 
 hex_value = lambda x: hex(x if isinstance(x, int) else ord(x))[2:]
 
+# hex_value and printable of every byte value
+_HEX = tuple(hex_value(c) for c in range(256))
+_PLAIN = bytes_type(bytearray(c if unichr(c) in _PRINTABLE else ord(".") for c in range(256)))
+
 
 def address_to_tuple(addr):
     """
@@ -68,20 +83,28 @@ def hex_dump(buff, size=16):
     """
     Dump the buffer in wireshark style
     """
-    out = []
+    return "\n".join(iter_hex_dump(buff, size))
+
+
+def iter_hex_dump(buff, size=16):
+    """
+    Yield the hex dump of the buffer line by line, so that huge buffers are never rendered as a single string.
+    Bytes like buffers are rendered a row at a time through lookup tables, other sequences char by char.
+    """
     half = int(size / 2)
-    if buff:
-        for i in range(0, len(buff), size):
+    binary = isinstance(buff, (bytes_type, bytearray, memoryview))
+    for i in range(0, len(buff) if buff else 0, size):
+        if binary:
+            row = bytearray(buff[i:i + size])
+            hexed = map(_HEX.__getitem__, row)
+            plain = row.translate(_PLAIN).decode("latin-1")
+        else:
             hexed, plain = zip(*[(hex_value(c), printable(c)) for c in buff[i:i + size]])
-            hexed = "{:04x}  {}  {}".format(i,
-                                            " ".join(hexed[:half]),
-                                            " ".join(hexed[half:size]))
-            plain = "{} {}".format("".join(plain[: half]),
-                                   "".join(plain[half:size]))
-            out.append("{0}   {1:>{2}}".format(hexed,
-                                               plain,
-                                               55 - (len(hexed) - len(plain))))
-    return "\n".join(out)
+            plain = "".join(plain)
+        hexed = list(hexed)
+        hexed = "{:04x}  {}  {}".format(i, " ".join(hexed[:half]), " ".join(hexed[half:size]))
+        plain = "{} {}".format(plain[:half], plain[half:size])
+        yield "{0}   {1:>{2}}".format(hexed, plain, 55 - (len(hexed) - len(plain)))
 
 
 def random_free_port(family=socket.AF_INET, type=socket.SOCK_STREAM):
@@ -97,6 +120,53 @@ def random_free_port(family=socket.AF_INET, type=socket.SOCK_STREAM):
         s.close()
 
 
+def pin_to_cpu(cpus, index):
+    """
+    Pin the current process to the index-th cpu of cpus round robin, if given and supported
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, [cpus[index % len(cpus)]])
+
+
+def set_close_exec(sock):
+    """
+    Keep the socket from leaking into the processes spawned by exec, where fcntl is available
+    """
+    if fcntl is not None:
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def bind_sockets(port, address=None, family=socket.AF_UNSPEC, backlog=128, reuse_port=False):
+    """
+    Same as tornado.netutil.bind_sockets, optionally enabling SO_REUSEPORT so that several processes can bind
+    the same port, the kernel balancing incoming connections among them
+    """
+    if not reuse_port:
+        return netutil.bind_sockets(port, address=address, family=family, backlog=backlog)
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    for af, socktype, proto, _, sockaddr in set(socket.getaddrinfo(address or None, port, family,
+                                                                   socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        try:
+            sock = socket.socket(af, socktype, proto)
+        except socket.error as e:
+            if e.args[0] == errno.EAFNOSUPPORT:
+                continue
+            raise
+        set_close_exec(sock)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
 def get_config(appname="wstunneld", filename="wstunneld.yml"):
     """
     Search for a configuration file in current, user home or /etc (not suitable for windows...) folders